@@ -1,15 +1,101 @@
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+import hashlib
+from typing import TYPE_CHECKING, Any, Callable, Optional
 from app.prompts.guard_rail_prompts import system_prompt
 from app.models.guard_rail_models import GuardRailAgentOutput
+from app.utils.cache import ResultCache
+from app.utils.guard_rail import classify_locally
+from app.utils.text_search import normalize_text
 
+if TYPE_CHECKING:
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.runnables import Runnable
 
-prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", system_prompt),
-    ]
-)
-model = ChatOpenAI(model="o4-mini-2025-04-16").with_structured_output(GuardRailAgentOutput)
 
+MODEL = "o4-mini-2025-04-16"
 
-guard_rail_agent = prompt | model
+
+def build_guard_rail_prompt() -> "ChatPromptTemplate":
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", system_prompt),
+        ]
+    )
+
+
+def build_guard_rail_chain() -> "Runnable":
+    """
+    The LLM chain of the guard rail. langchain and the OpenAI client are imported here, on
+    the first input the local checks cannot decide, instead of when the bot starts.
+    """
+    from langchain_openai import ChatOpenAI
+    model = ChatOpenAI(model=MODEL).with_structured_output(GuardRailAgentOutput)
+    return build_guard_rail_prompt() | model
+
+
+class GuardRail:
+    """
+    Guard rail that only calls the LLM chain when it has to.
+
+    Inputs are first looked up in a cache of previous LLM verdicts, keyed on the
+    normalised text and a digest of the history the chain judged it with (a "sim" means
+    something else in every conversation), then given to `classify_locally`; only the
+    inputs neither can decide reach `chain`. Has the same `ainvoke({"input", "history"})`
+    interface as the chain.
+
+    The chain can also be given as `build_chain`, called on its first use.
+    """
+
+    def __init__(self, chain: Optional["Runnable"], cache: ResultCache, build_chain: Optional[Callable[[], "Runnable"]] = None):
+        if chain is None and build_chain is None:
+            raise ValueError("Either chain or build_chain is required")
+        self._chain = chain
+        self.build_chain = build_chain
+        self.cache = cache
+        self.local_allowed = 0
+        self.local_blocked = 0
+        self.llm_calls = 0
+
+    @property
+    def chain(self) -> "Runnable":
+        if self._chain is None:
+            self._chain = self.build_chain()
+        return self._chain
+
+    @staticmethod
+    def cache_key(inputs: dict[str, Any]) -> tuple[str, str]:
+        history = hashlib.blake2b(str(inputs.get("history", "")).encode(), digest_size=16).hexdigest()
+        return normalize_text(inputs["input"]), history
+
+    async def ainvoke(self, inputs: dict[str, Any]) -> GuardRailAgentOutput:
+        key = self.cache_key(inputs)
+        verdict = self.cache.get(key)
+        if verdict is not None:
+            return verdict
+
+        rules_are_being_broken = classify_locally(inputs["input"])
+        if rules_are_being_broken is not None:
+            if rules_are_being_broken:
+                self.local_blocked += 1
+            else:
+                self.local_allowed += 1
+            return GuardRailAgentOutput(rules_are_being_broken=rules_are_being_broken)
+
+        self.llm_calls += 1
+        verdict = await self.chain.ainvoke(inputs)
+        self.cache.set(key, verdict)
+        return verdict
+
+    def stats(self) -> dict[str, int]:
+        checks = self.cache.hits + self.cache.misses
+        return {
+            "checks": checks,
+            "cache_hits": self.cache.hits,
+            "local_allowed": self.local_allowed,
+            "local_blocked": self.local_blocked,
+            "llm_calls": self.llm_calls,
+            "llm_calls_avoided": checks - self.llm_calls,
+        }
+
+
+guard_rail_agent = GuardRail(None, ResultCache(max_entries=10_000, ttl=24 * 3600), build_chain=build_guard_rail_chain)
@@ -1,24 +1,78 @@
-from pydantic_ai import Agent
+import asyncio
+import threading
+from typing import TYPE_CHECKING, Any, Optional
 from dotenv import load_dotenv
 from app.prompts.real_estate_prompts_fixed import system_prompt
 from app.models.real_estate_models import RealStateAgentOutput
 from app.models.user_models import UserInput
 
+if TYPE_CHECKING:
+    from pydantic_ai import Agent
+
 
 load_dotenv()
 
 
-real_state_agent = Agent(
-    "openai:o4-mini-2025-04-16",
-    deps_type=UserInput,
-    system_prompt=system_prompt,
-    output_type=RealStateAgentOutput,
-    model_settings={
-        "timeout": 60,
-    }
-)
+MODEL = "openai:o4-mini-2025-04-16"
+
+_build_lock = threading.RLock()
+_agent: Optional["Agent[UserInput, RealStateAgentOutput]"] = None
+_registering = False
+
+
+def build_real_state_agent() -> "Agent[UserInput, RealStateAgentOutput]":
+    from pydantic_ai import Agent
+    return Agent(
+        MODEL,
+        deps_type=UserInput,
+        system_prompt=system_prompt,
+        output_type=RealStateAgentOutput,
+        model_settings={
+            "timeout": 60,
+        },
+        defer_model_check=True,
+    )
+
+
+def __getattr__(name: str) -> Any:
+    """
+    `real_state_agent` is built on first access: pydantic_ai, the OpenAI client and the
+    tools take most of the startup time, and entry points only need them on the first turn.
+    """
+    global _agent, _registering
+    if name != "real_state_agent":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _build_lock:
+        if "real_state_agent" in globals():
+            return globals()["real_state_agent"]
+        # Kept across failed attempts, as the tools register only once, on import
+        if _agent is None:
+            _agent = build_real_state_agent()
+        if _registering:
+            # Re-entered by the modules imported below, which register on the agent
+            return _agent
+        _registering = True
+        try:
+            from app.tools import real_estate_tools
+            from app.prompts import real_estate_prompts_dynamic
+        finally:
+            _registering = False
+        # Published only once its tools and dynamic prompts are registered, so other
+        # threads never run a partial agent
+        globals()["real_state_agent"] = _agent
+    return globals()["real_state_agent"]
+
+
+def warm_up(loop: asyncio.AbstractEventLoop) -> "asyncio.Future[Agent[UserInput, RealStateAgentOutput]]":
+    """
+    Builds `real_state_agent` in a worker thread of `loop`, so the first turn does not wait
+    for it. A failed build is printed; the first turn then tries again and raises.
+    """
+    future = loop.run_in_executor(None, __getattr__, "real_state_agent")
 
+    def report(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Could not build the real estate agent: {future.exception()!r}")
 
-# Delayed/Local imports
-from app.tools import real_estate_tools
-from app.prompts import real_estate_prompts_dynamic
+    future.add_done_callback(report)
+    return future
@@ -0,0 +1,29 @@
+from pydantic import BaseModel
+from pydantic import Field
+from typing import Literal, Optional
+
+BookingStatus = Literal[
+    "booked",
+    "cancelled",
+    "already_booked",
+    "already_yours",
+    "not_booked",
+    "not_owner",
+    "slot_not_found",
+    "property_not_found",
+    "conflict",
+]
+
+class BookingResult(BaseModel):
+    status: BookingStatus = Field(..., description="Outcome of the booking or cancellation")
+    property_id: str = Field(..., description="The property of the slot")
+    slot_start: str = Field(..., description="The start time of the slot")
+    booked_by: Optional[str] = Field(None, description="Who holds the slot after the operation, if anyone")
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ("booked", "already_yours", "cancelled")
+
+class SlotRequest(BaseModel):
+    property_id: str = Field(..., description="The unique identifier of the property")
+    slot_start: str = Field(..., description="The start time of the slot, in 'YYYY-MM-DD HH:MM:SS' format")
@@ -4,5 +4,5 @@ from typing import Optional
 
 class RealStateAgentOutput(BaseModel):
     response: str = Field(..., description="Agent response")
-    properties: Optional[str] = Field(None, description="Properties found by the `search_properties` tool")
-    slots: Optional[str] = Field(None, description="Slots found by the `get_property_slots` tool")
+    properties: Optional[str] = Field(None, description="Properties found by the `search_properties`, `search_nearby_properties` or `find_similar_properties` tools")
+    slots: Optional[str] = Field(None, description="Slots found by the `get_property_slots`, `get_slots_for_properties` or `plan_visit_itinerary` tools")
@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+from pydantic import Field
+from typing import Optional
+from pydantic_ai.messages import ModelMessage
+
+class ChatSession(BaseModel):
+    message_history: list[ModelMessage] = Field(default_factory=list, description="Compacted conversation history passed to the agent")
+    last_shown_properties: Optional[str] = Field(None, description="Properties table last sent to the chat")
+    last_shown_slots: Optional[str] = Field(None, description="Slots table last sent to the chat")
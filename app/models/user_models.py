@@ -1,10 +1,39 @@
 from pydantic import BaseModel
 from pydantic import Field
+from pydantic import model_validator
+from typing import Optional
+import asyncio
 import duckdb
+from app.utils.database import Database
+from app.utils.guard_rail import GuardRailViolation
 
 class UserInput(BaseModel):
     class Config:
         arbitrary_types_allowed = True
         
     user_name: str = Field(..., description="The name of the user")
-    connection: duckdb.DuckDBPyConnection = Field(..., description="Connection with the database")
\ No newline at end of file
+    user_id: Optional[str] = Field(None, description="Stable identifier of the user, recorded on bookings. Defaults to `user_name`")
+    connection: Optional[duckdb.DuckDBPyConnection] = Field(None, description="Connection with the database, unless `database` queries another process")
+    database: Optional[Database] = Field(None, description="Async query layer over `connection`, shared per connection")
+    guard_rail_verdict: Optional[asyncio.Future] = Field(None, description="Pending guard rail verdict when it runs concurrently with the agent")
+
+    @model_validator(mode="after")
+    def bind_database(self) -> "UserInput":
+        if self.database is None:
+            if self.connection is None:
+                raise ValueError("Either connection or database is required")
+            self.database = Database.for_connection(self.connection)
+        return self
+
+    async def allow_side_effects(self) -> None:
+        """
+        Waits for a pending guard rail verdict before a tool writes anything.
+
+        Raises:
+            GuardRailViolation: If the guard rail flagged the input.
+        """
+        if self.guard_rail_verdict is None:
+            return
+        verdict = await asyncio.shield(self.guard_rail_verdict)
+        if verdict.rules_are_being_broken:
+            raise GuardRailViolation("The guard rail flagged the user input")
@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic_ai import RunContext
 from app.models.user_models import UserInput
 from app.agents.real_estate_agent import real_state_agent
@@ -8,3 +9,11 @@ async def add_user_name(ctx: RunContext[UserInput]) -> str:
     Adds the user's name to the system prompt.
     """
     return f"\nThe user's name is {ctx.deps.user_name}."
+
+@real_state_agent.system_prompt
+async def add_current_date(ctx: RunContext[UserInput]) -> str:
+    """
+    Adds the current date to the system prompt, so relative dates can be resolved.
+    """
+    now = datetime.now().astimezone()
+    return f"\nToday is {now:%A}, {now:%Y-%m-%d}, and the time is {now:%H:%M}."
@@ -1,35 +1,23 @@
+import argparse
 import duckdb
-import pandas as pd
 import asyncio
-import numpy as np
-from datetime import datetime, timedelta, time, date
 from app.utils.general import load_config
+from app.utils.database import sql_literal
+from app.utils.slots import compact_slots, extend_slot_horizon, prune_past_slots, DAYS_AHEAD
+from app.utils.ingestion import ensure_ingestion_columns, ingest_properties
+from app.utils.text_search import build_search_index
 
-SAMPLE_FRAC    = 0.30
-DAYS_AHEAD     = 28
-OPEN_TIME      = time(8, 0)
-CLOSE_TIME     = time(20, 0)
-SLOT_MINUTES   = 30
-BOOKED_RATIO   = 0.30
+SAMPLE_FRAC       = 0.30
+DEMO_BOOKED_RATIO = 0.30     # Share of new slots marked booked with --demo
 
-def main():
-    config = asyncio.run(load_config("config/config.yml"))
-    con = duckdb.connect(config["database"])
 
-    df = (
-        con.execute("SELECT * FROM propriedades")
-        .fetchdf()
-        .sample(frac=SAMPLE_FRAC, random_state=42)
-        .drop_duplicates(subset="id")
-        .reset_index(drop=True)
-        .rename(columns={"id": "property_id"})
-    )
+def load_properties(con: duckdb.DuckDBPyConnection) -> None:
+    """Fills `properties` with a sample of the raw `propriedades` table."""
+    report = ingest_properties(con, f"(SELECT * FROM propriedades USING SAMPLE {SAMPLE_FRAC * 100}% (bernoulli, 42))")
+    print(f"{report.inserted:,} properties loaded, {report.rejected:,} rejected")
 
-    PROPERTY_COLUMNS = [
-        "property_id", "preco", "tamanho", "n_quartos", "n_banheiros",
-        "n_garagem", "rua", "bairro", "cidade", "latitude", "longitude"
-    ]
 
+def create_tables(con: duckdb.DuckDBPyConnection) -> None:
     con.execute("""
     CREATE TABLE IF NOT EXISTS properties (
         property_id    VARCHAR PRIMARY KEY,
@@ -42,60 +30,69 @@ def main():
         bairro         VARCHAR,
         cidade         VARCHAR,
         latitude       DOUBLE,
-        longitude      DOUBLE
+        longitude      DOUBLE,
+        rua_norm       VARCHAR,
+        bairro_norm    VARCHAR,
+        cidade_norm    VARCHAR,
+        ingested_at    TIMESTAMP WITH TIME ZONE,
+        updated_at     TIMESTAMP WITH TIME ZONE
     );
     """)
 
+    # No primary key: DuckDB keeps its index in memory, which would grow with every slot.
+    # `extend_slot_horizon` only ever adds days a property has no slots for
     con.execute("""
     CREATE TABLE IF NOT EXISTS property_slots (
         property_id VARCHAR,
         slot_start  TIMESTAMP WITH TIME ZONE,
         slot_end    TIMESTAMP WITH TIME ZONE,
         status      VARCHAR,
-        CONSTRAINT pk PRIMARY KEY (property_id, slot_start),
-        CONSTRAINT fk_prop FOREIGN KEY (property_id)
-            REFERENCES properties(property_id)
+        booked_by   VARCHAR,
+        booked_at   TIMESTAMP WITH TIME ZONE
     );
     """)
 
-    con.execute("DELETE FROM properties;")
-    con.register("tmp_props", df[PROPERTY_COLUMNS])
-    con.execute("INSERT INTO properties SELECT * FROM tmp_props;")
-    con.unregister("tmp_props")
-
-    now = datetime.now().astimezone()
-    to_next = (SLOT_MINUTES - now.minute % SLOT_MINUTES) % SLOT_MINUTES
-    start_dt = (now + timedelta(minutes=to_next)).replace(second=0, microsecond=0)
+    ensure_ingestion_columns(con)
+    # Backfills the `*_norm` columns and creates the search tables of a database that
+    # predates them; a no-op past the watermark otherwise
+    build_search_index(con)
+    con.execute("ALTER TABLE property_slots ADD COLUMN IF NOT EXISTS booked_by VARCHAR;")
+    con.execute("ALTER TABLE property_slots ADD COLUMN IF NOT EXISTS booked_at TIMESTAMP WITH TIME ZONE;")
 
-    all_slots = []
-    for d in range(DAYS_AHEAD):
-        day: date = (start_dt + timedelta(days=d)).date()
-        if day.weekday() == 6:
-            continue
-        t = datetime.combine(day, OPEN_TIME, tzinfo=start_dt.tzinfo)
-        while t.time() < CLOSE_TIME:
-            all_slots.append(t)
-            t += timedelta(minutes=SLOT_MINUTES)
 
-    slots_df = (
-        pd.MultiIndex.from_product([df["property_id"], all_slots],
-                                   names=["property_id", "slot_start"])
-        .to_frame(index=False)
-    )
-    slots_df["slot_end"] = slots_df["slot_start"] + timedelta(minutes=SLOT_MINUTES)
+def main():
+    """
+    Slot maintenance, meant to run nightly: drops the slots that are over and adds the
+    days missing at the end of each property's horizon. Bookings are kept and new slots are
+    free, unless `--demo` marks a share of them booked to seed demo data. On the first run,
+    `properties` is loaded from `propriedades`.
+    """
+    parser = argparse.ArgumentParser(description="Maintains the visit slots of every property over a rolling horizon.")
+    parser.add_argument("--days-ahead", type=int, default=DAYS_AHEAD, help="Days of slots kept ahead, today included.")
+    parser.add_argument("--demo", action="store_true", help="Seed demo data: mark a share of the new slots booked, by nobody in particular.")
+    parser.add_argument("--booked-ratio", type=float, default=None, help=f"Share of new slots marked booked with --demo (default {DEMO_BOOKED_RATIO}).")
+    parser.add_argument("--memory-limit", default=None, help="DuckDB memory limit, e.g. '2GB'; larger sorts spill to disk.")
+    parser.add_argument("--compact", action="store_true", help="Rewrite the slots sorted afterwards, e.g. weekly.")
+    args = parser.parse_args()
+    if args.booked_ratio is not None and not args.demo:
+        parser.error("--booked-ratio only applies with --demo")
+    booked_ratio = (DEMO_BOOKED_RATIO if args.booked_ratio is None else args.booked_ratio) if args.demo else 0.0
 
-    rng = np.random.default_rng(seed=42)
-    mask = rng.random(len(slots_df)) < BOOKED_RATIO
-    slots_df["status"] = np.where(mask, "booked", "free")
+    config = asyncio.run(load_config("config/config.yml"))
+    con = duckdb.connect(config["database"])
+    if args.memory_limit:
+        con.execute(f"SET memory_limit = {sql_literal(args.memory_limit)}")
 
-    con.execute("DELETE FROM property_slots;")
-    con.register("tmp_slots", slots_df)
-    con.execute("INSERT INTO property_slots SELECT * FROM tmp_slots;")
-    con.unregister("tmp_slots")
+    create_tables(con)
+    if con.execute("SELECT count(*) FROM properties").fetchone()[0] == 0:
+        load_properties(con)
 
-    total  = len(slots_df)
-    booked = mask.sum()
-    print(f"{total:,} slots inserted ({booked:,} booked, {total-booked:,} free)")
+    pruned = prune_past_slots(con)
+    added = extend_slot_horizon(con, days_ahead=args.days_ahead, booked_ratio=booked_ratio)
+    if args.compact:
+        compact_slots(con)
+    total = con.execute("SELECT count(*) FROM property_slots").fetchone()[0]
+    print(f"{pruned:,} past slots pruned, {added:,} slots added, {total:,} slots in total")
 
     con.close()
 
@@ -1,6 +1,8 @@
 import duckdb
 import pandas as pd
 from datetime import datetime, timedelta
+from app.utils.text_search import build_search_index
+from app.utils.market_stats import refresh_market_stats
 
 def main():
     """
@@ -25,7 +27,12 @@ def main():
         bairro         VARCHAR,
         cidade         VARCHAR,
         latitude       DOUBLE,
-        longitude      DOUBLE
+        longitude      DOUBLE,
+        rua_norm       VARCHAR,
+        bairro_norm    VARCHAR,
+        cidade_norm    VARCHAR,
+        ingested_at    TIMESTAMP WITH TIME ZONE,
+        updated_at     TIMESTAMP WITH TIME ZONE
     );
     """)
 
@@ -35,6 +42,8 @@ def main():
         slot_start  TIMESTAMP,
         slot_end    TIMESTAMP,
         status      VARCHAR,
+        booked_by   VARCHAR,
+        booked_at   TIMESTAMP WITH TIME ZONE,
         CONSTRAINT pk PRIMARY KEY (property_id, slot_start)
     );
     """)
@@ -53,10 +62,15 @@ def main():
     properties_df = pd.DataFrame(properties_data, columns=['property_id', 'preco', 'tamanho', 'n_quartos', 'n_banheiros', 'n_garagem', 'rua', 'bairro', 'cidade', 'latitude', 'longitude'])
     
     # --- Slots Data ---
+    tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
     slots_data = [
         # Available FREE slot for booking test on property 'abcfoo42'
         ('abcfoo42', datetime(2024, 12, 25, 10, 0, 0), datetime(2024, 12, 25, 10, 30, 0), 'free'),
         ('abcfoo42', datetime(2024, 12, 25, 11, 0, 0), datetime(2024, 12, 25, 11, 30, 0), 'free'),
+
+        # Upcoming FREE slots on property 'abcfoo42', since slot lookups only return future slots
+        ('abcfoo42', tomorrow + timedelta(hours=10), tomorrow + timedelta(hours=10, minutes=30), 'free'),
+        ('abcfoo42', tomorrow + timedelta(hours=14), tomorrow + timedelta(hours=14, minutes=30), 'free'),
         
         # Already BOOKED slot for cancellation test on property 'xyzbar99'
         ('xyzbar99', datetime(2024, 12, 25, 10, 0, 0), datetime(2024, 12, 25, 10, 30, 0), 'booked'),
@@ -65,10 +79,12 @@ def main():
 
     # --- Insert Data ---
     con.register('properties_df', properties_df)
-    con.execute('INSERT INTO properties SELECT * FROM properties_df')
+    con.execute('INSERT INTO properties BY NAME SELECT * FROM properties_df')
+    build_search_index(con)
+    refresh_market_stats(con, full=True)
     
     con.register('slots_df', slots_df)
-    con.execute('INSERT INTO property_slots SELECT * FROM slots_df')
+    con.execute('INSERT INTO property_slots BY NAME SELECT * FROM slots_df ORDER BY property_id, slot_start')
 
     print("Test properties inserted:")
     con.table('properties').show()
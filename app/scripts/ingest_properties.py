@@ -0,0 +1,33 @@
+import argparse
+import asyncio
+import duckdb
+from app.utils.database import sql_literal
+from app.utils.general import load_config
+from app.utils.ingestion import ingest_properties, reader_sql, DEFAULT_BATCH_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upserts property listing feeds (CSV, TSV, Parquet or JSONL, optionally compressed) into `properties`.")
+    parser.add_argument("paths", nargs="+", help="Feed files or globs, e.g. 'feeds/2025-*.parquet'.")
+    parser.add_argument("--database", default=None, help="DuckDB file. Defaults to `database` in config.yml.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Rows per upsert statement.")
+    parser.add_argument("--memory-limit", default=None, help="DuckDB memory limit, e.g. '2GB'; larger sorts spill to disk.")
+    args = parser.parse_args()
+
+    database = args.database or asyncio.run(load_config("config/config.yml"))["database"]
+    con = duckdb.connect(database)
+    if args.memory_limit:
+        con.execute(f"SET memory_limit = {sql_literal(args.memory_limit)}")
+    # Rows are sorted before being written, so their order in the feed does not matter
+    con.execute("SET preserve_insertion_order = false")
+
+    for path in args.paths:
+        report = ingest_properties(con, reader_sql(path), batch_size=args.batch_size)
+        print(
+            f"{path}: {report.rows_read:,} rows in {report.seconds:.1f} s ({report.rows_per_second:,.0f} rows/s), "
+            f"{report.inserted:,} inserted, {report.updated:,} updated, {report.unchanged:,} unchanged, {report.rejected:,} rejected, {report.duplicates:,} duplicates"
+        )
+    con.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import asyncio
+import time
+import aiohttp
+from app.utils.webhook import SECRET_HEADER
+
+
+def make_update(update_id: int, chat_id: int, text: str, first_name: str = "Teste") -> dict:
+    """Builds the JSON of a Telegram text message update."""
+    user = {"id": chat_id, "is_bot": False, "first_name": first_name}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": first_name},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+async def send_updates(url: str, text: str, chat_id: int, count: int, secret_token: str = None):
+    """Posts `count` synthetic updates to a webhook, as Telegram would."""
+    headers = {SECRET_HEADER: secret_token} if secret_token else {}
+    async with aiohttp.ClientSession() as session:
+        for i in range(count):
+            async with session.post(url, json=make_update(int(time.time() * 1000) + i, chat_id, text), headers=headers) as response:
+                print(f"Update {i + 1}/{count}: HTTP {response.status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Posts synthetic Telegram updates to the bot's webhook.")
+    parser.add_argument("--url", default="http://localhost:8080/telegram", help="Webhook URL.")
+    parser.add_argument("--text", default="Oi!", help="Message text.")
+    parser.add_argument("--chat-id", type=int, default=1, help="Chat (and user) id.")
+    parser.add_argument("--count", type=int, default=1, help="Number of updates to send.")
+    parser.add_argument("--secret-token", default=None, help="Webhook secret token, if configured.")
+    args = parser.parse_args()
+    asyncio.run(send_updates(args.url, args.text, args.chat_id, args.count, args.secret_token))
+
+
+if __name__ == "__main__":
+    main()
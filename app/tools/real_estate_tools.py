@@ -1,8 +1,94 @@
 from pydantic_ai import RunContext, ModelRetry
 from app.models.user_models import UserInput
 from app.agents.real_estate_agent import real_state_agent
-from app.utils.general import check_if_property_exists, check_if_slot_exists
-from unidecode import unidecode
+from app.utils.general import check_if_property_exists, fetch_properties, has_column
+from app.utils.booking import book_slot, cancel_slot
+from app.models.booking_models import BookingResult, SlotRequest
+from app.utils.relaxation import search_with_relaxation
+from app.utils.search_query import SORT_ORDERS, SORT_COLUMNS
+from app.utils.slots import find_free_slots, find_free_slots_batch
+from app.utils.itinerary import plan_itinerary, MAX_PROPERTIES
+from app.utils.formatting import render_rows, fetch_limit, check_page, next_page_hint, PROPERTY_COLUMNS, NEARBY_COLUMNS, MARKET_COLUMNS, SLOT_COLUMNS, BATCH_SLOT_COLUMNS, ITINERARY_COLUMNS
+from app.utils.geo import GeoIndex, property_location, area_centroid, fetch_neighbours, haversine_km, MAX_RADIUS_KM
+from app.utils.similarity import SimilarityIndex
+from app.utils.market_stats import fetch_market_stats
+from app.utils.text_search import match_terms, matched_terms, MAX_SUGGESTIONS, MIN_SUGGESTION_SIMILARITY
+from app.utils.cache import ResultCache, cache_key
+from app.utils.database import Database
+from collections import Counter
+from typing import Optional
+import asyncio
+import duckdb
+import math
+from datetime import datetime
+import numpy as np
+
+
+# Identical searches are frequent, within a conversation (retries, re-asking) and across
+# users of the same city. Slots go stale faster, and are also dropped on every booking.
+search_cache = ResultCache(max_entries=1024, ttl=300)
+slot_cache   = ResultCache(max_entries=1024, ttl=60)
+# `id()` of the databases with entries in the caches, dropped when they close
+cached_databases: set[int] = set()
+
+MAX_SIMILAR = 20
+
+
+# Outcomes of booking and cancellation attempts, by `BookingResult.status`
+booking_outcomes: Counter[str] = Counter()
+
+
+def cache_stats() -> dict[str, dict]:
+    return {"search": search_cache.stats(), "slots": slot_cache.stats()}
+
+
+def database_tag(database: Database) -> tuple[str, int]:
+    """
+    Cache key part and tag of the entries of `database`.
+
+    Entries hold the database's `id()`, not the database, so the caches never keep a closed
+    one alive; closing it drops its entries, before the `id()` can be reused.
+    """
+    if id(database) not in cached_databases:
+        cached_databases.add(id(database))
+        database.on_close(forget_database)
+    return ("database", id(database))
+
+
+def forget_database(database: Database) -> None:
+    tag = ("database", id(database))
+    search_cache.invalidate(tag)
+    slot_cache.invalidate(tag)
+    cached_databases.discard(id(database))
+
+
+def booking_stats() -> dict[str, float]:
+    """
+    Booking attempt outcomes, and the share of attempts that lost a race for the slot.
+    """
+    attempts = booking_outcomes["booked"] + booking_outcomes["already_booked"] + booking_outcomes["conflict"]
+    lost = booking_outcomes["already_booked"] + booking_outcomes["conflict"]
+    return {**booking_outcomes, "conflict_rate": lost / attempts if attempts else 0.0}
+
+
+def check_page_argument(pagina: int) -> None:
+    """
+    Validates the `pagina` argument of the paginated tools.
+    """
+    try:
+        check_page(pagina)
+    except ValueError:
+        raise ModelRetry(f"Invalid `pagina`: {pagina}. Pages start at 1.")
+
+
+def check_number_arguments(**arguments: Optional[float]) -> None:
+    """
+    Validates numeric filters, which must be finite and not negative.
+    """
+    for name, value in arguments.items():
+        if value is not None and not (math.isfinite(value) and value >= 0):
+            raise ModelRetry(f"Invalid `{name}`: {value}. Use a finite, non-negative number, or leave it out.")
+
 
 @real_state_agent.tool(retries=3)
 async def search_properties(
@@ -17,10 +103,15 @@ async def search_properties(
     rua: str = None,
     bairro: str = None,
     cidade: str = None,
+    sort_by: str = "relevance",
+    pagina: int = 1,
 ) -> str:
     """
     Use this tool to search for real estate properties based on user-provided criteria.
     All parameters are optional. The more criteria provided, the more specific the search.
+    If nothing matches all criteria, the criteria are relaxed automatically and the output
+    starts with a line listing which ones were relaxed.
+    By default the closest matches to the requested price, size, rooms and location come first.
 
     Args:
         preco_min (float): Minimum price of the property.
@@ -30,110 +121,385 @@ async def search_properties(
         n_quartos (int): Number of bedrooms.
         n_banheiros (int): Number of bathrooms.
         n_garagem (int): Number of garage spaces.
-        rua (str): Street name (partial match).
-        bairro (str): Neighborhood name (partial match).
-        cidade (str): City name (partial match).
+        rua (str): Street name (partial match, tolerant to accents and small typos).
+        bairro (str): Neighborhood name (partial match, tolerant to accents and small typos).
+        cidade (str): City name (partial match, tolerant to accents and small typos).
+        sort_by (str): Order of the results: 'relevance' (default), 'price_per_m2' (cheapest per m² first),
+            'size' (largest first) or 'newest' (most recently listed first).
+        pagina (int): Page of results to return, starting at 1.
 
     Returns:
         A markdown table with the properties found, or an empty table if no properties match.
     """
-    base_query = "SELECT property_id, preco, tamanho, cidade, bairro, rua, n_quartos, n_banheiros, n_garagem FROM properties"
-    filters = []
-    params = {}
-
-    if rua is not None:
-        rua = unidecode(rua)
-    if bairro is not None:
-        bairro = unidecode(bairro)
-    if cidade is not None:
-        cidade = unidecode(cidade)
-
-    if preco_min is not None:
-        filters.append(f"preco >= {preco_min}")
-        params["preco_min"] = preco_min
-    if preco_max is not None:
-        filters.append(f"preco <= {preco_max}")
-        params["preco_max"] = preco_max
-    if tamanho_min is not None:
-        filters.append(f"tamanho >= {tamanho_min}")
-        params["tamanho_min"] = tamanho_min
-    if tamanho_max is not None:
-        filters.append(f"tamanho <= {tamanho_max}")
-        params["tamanho_max"] = tamanho_max
-    if n_quartos is not None:
-        filters.append(f"n_quartos = {n_quartos}")
-        params["n_quartos"] = n_quartos
-    if n_banheiros is not None:
-        filters.append(f"n_banheiros = {n_banheiros}")
-        params["n_banheiros"] = n_banheiros
-    if n_garagem is not None:
-        filters.append(f"n_garagem = {n_garagem}")
-        params["n_garagem"] = n_garagem
-    if rua is not None:
-        filters.append(f"rua ILIKE '%{rua}%'")
-        params["rua"] = f"%{rua}%"
-    if bairro is not None:
-        filters.append(f"bairro ILIKE '%{bairro.lower()}%'")
-        params["bairro"] = f"%{bairro.lower()}%"
-    if cidade is not None:
-        filters.append(f"cidade ILIKE '%{cidade.lower()}%'")
-        params["cidade"] = f"%{cidade.lower()}%"
-
-    if filters:
-        base_query += " WHERE " + " AND ".join(filters)
-
-    df = ctx.deps.connection.execute(base_query).fetch_df()
-    
-    if df.empty:
-        raise ModelRetry(
-"""No properties found for the given filters.
+    check_page_argument(pagina)
+    if sort_by not in SORT_ORDERS:
+        raise ModelRetry(f"Invalid `sort_by`: {sort_by}. Use one of: " + ", ".join(f"'{order}'" for order in SORT_ORDERS) + ".")
+    if sort_by in SORT_COLUMNS and not await has_column(ctx.deps.database, "properties", SORT_COLUMNS[sort_by]):
+        # Databases never run through ingestion do not record when listings were added
+        raise ModelRetry(f"`sort_by='{sort_by}'` is not available for these listings. Use another order.")
+
+    text_filters = {"rua": rua, "bairro": bairro, "cidade": cidade}
+    text_filters = {field: value for field, value in text_filters.items() if value is not None}
+    filters = {
+        "preco_min": preco_min,
+        "preco_max": preco_max,
+        "tamanho_min": tamanho_min,
+        "tamanho_max": tamanho_max,
+        "n_quartos": n_quartos,
+        "n_banheiros": n_banheiros,
+        "n_garagem": n_garagem,
+    }
+    check_number_arguments(**filters)
+
+    database = database_tag(ctx.deps.database)
+    key = cache_key("search", database, limit=fetch_limit(pagina), sort_by=sort_by, **filters, **text_filters)
+    cached = search_cache.get(key)
+    if cached is None:
+        text_matches = await asyncio.gather(*(match_terms(ctx.deps.database, field, value) for field, value in text_filters.items()))
+
+        terms = {}
+        suggestions = {}
+        for field, matches in zip(text_filters, text_matches):
+            terms[field] = matched_terms(matches)
+            if not terms[field]:
+                suggestions[field] = [match.label for match in matches if match.similarity >= MIN_SUGGESTION_SIMILARITY][:MAX_SUGGESTIONS]
+
+        search = await search_with_relaxation(ctx.deps.database, limit=fetch_limit(pagina), filters={**filters, **terms}, sort_by=sort_by)
+        cached = (search, suggestions)
+        search_cache.set(key, cached, tags=[database])
+    search, suggestions = cached
+
+    if search is None:
+        message = """No properties found for the given filters, even after relaxing them.
 Please try again with less specific filters.
-But if you are looking for a specific property using almost all parameters, review parameters values.
-IMPORTANT: If you are ussing the `rua` parameter to find a specific property, review the value used.
-Rua names tend to have lexical variations, so try ussing a different value for this parameter.""")
-
-    properties_str = ""
-    for _, row in df.iterrows():
-        properties_str += f"ID: {row['property_id']}\\n"
-        properties_str += f"Preço: R$ {row['preco']}\\n"
-        properties_str += f"Tamanho: {row['tamanho']} m²\\n"
-        properties_str += f"Cidade: {row['cidade']}\\n"
-        properties_str += f"Bairro: {row['bairro']}\\n"
-        properties_str += f"Rua: {row['rua']}\\n"
-        properties_str += f"Quartos: {row['n_quartos']}\\n"
-        properties_str += f"Banheiros: {row['n_banheiros']}\\n"
-        properties_str += f"Vagas: {row['n_garagem']}\\n"
-        properties_str += "-" * 20 + "\\n"
-    
-    return properties_str.strip()
+But if you are looking for a specific property using almost all parameters, review parameters values."""
+        for field, labels in suggestions.items():
+            if labels:
+                message += f"\nClosest known `{field}` values to '{text_filters[field]}': " + ", ".join(f"'{label}'" for label in labels)
+        raise ModelRetry(message)
+
+    properties_str, has_more = render_rows(search.columns, PROPERTY_COLUMNS, page=pagina)
+    if search.relaxed:
+        properties_str = "No property matches all criteria. Relaxed criteria: " + "; ".join(search.relaxed) + "\n" + properties_str
+    if has_more:
+        properties_str += "\n" + next_page_hint(has_more, pagina)
+
+    return properties_str
 
 @real_state_agent.tool(retries=3)
-async def get_property_slots(ctx: RunContext[UserInput], property_id: str) -> str:
+async def search_nearby_properties(
+    ctx: RunContext[UserInput],
+    latitude: float = None,
+    longitude: float = None,
+    property_id: str = None,
+    bairro: str = None,
+    cidade: str = None,
+    raio_km: float = None,
+    pagina: int = 1,
+) -> str:
     """
-    Use this tool to get the available time slots for visiting a specific property.
+    Use this tool to find properties near a place ("imóveis perto de X"), nearest first.
+    The place is either a point (`latitude` and `longitude`), another property (`property_id`,
+    which is left out of the results) or a neighborhood and/or city (`bairro`, `cidade`), whose
+    center is used. Give exactly one kind of place.
+
+    Args:
+        latitude (float): Latitude of the point, in degrees.
+        longitude (float): Longitude of the point, in degrees.
+        property_id (str): The unique identifier of the reference property.
+        bairro (str): Neighborhood name (partial match, tolerant to accents and small typos).
+        cidade (str): City name (partial match, tolerant to accents and small typos).
+        raio_km (float): Only return properties within this distance, in km. Without it, the nearest properties are returned.
+        pagina (int): Page of results to return, starting at 1.
+
+    Returns:
+        A markdown table with the properties found and their distance to the place.
+    """
+    check_page_argument(pagina)
+    places = [latitude is not None or longitude is not None, property_id is not None, bairro is not None or cidade is not None]
+    if sum(places) != 1 or places[0] and (latitude is None or longitude is None):
+        raise ModelRetry("Give exactly one place: `latitude` and `longitude`, or `property_id`, or `bairro`/`cidade`.")
+    if raio_km is not None and not 0 < raio_km <= MAX_RADIUS_KM:
+        raise ModelRetry(f"`raio_km` must be greater than 0 and at most {MAX_RADIUS_KM:g}.")
+
+    if property_id is not None:
+        point = await property_location(ctx.deps.database, property_id)
+        if point is None:
+            raise ModelRetry(f"""Property id not found in the database, or it has no location. ID: {property_id}
+Check the `property_id` and try again.""")
+    elif bairro is not None or cidade is not None:
+        text_filters = {field: value for field, value in {"bairro": bairro, "cidade": cidade}.items() if value is not None}
+        text_matches = await asyncio.gather(*(match_terms(ctx.deps.database, field, value) for field, value in text_filters.items()))
+        terms = {field: matched_terms(matches) for field, matches in zip(text_filters, text_matches)}
+        point = await area_centroid(ctx.deps.database, terms) if all(terms.values()) else None
+        if point is None:
+            message = "No properties found in the given place."
+            for field, matches in zip(text_filters, text_matches):
+                labels = [match.label for match in matches if match.similarity >= MIN_SUGGESTION_SIMILARITY][:MAX_SUGGESTIONS]
+                if labels:
+                    message += f"\nClosest known `{field}` values to '{text_filters[field]}': " + ", ".join(f"'{label}'" for label in labels)
+            raise ModelRetry(message)
+    else:
+        point = (latitude, longitude)
+
+    index = GeoIndex.for_database(ctx.deps.database)
+    await index.refresh()
+    if raio_km is not None:
+        neighbours = index.radius(*point, raio_km, limit=fetch_limit(pagina), exclude=property_id)
+    else:
+        neighbours = index.nearest(*point, fetch_limit(pagina), exclude=property_id)
+
+    if not len(neighbours.property_ids) and pagina == 1:
+        radius = raio_km if raio_km is not None else MAX_RADIUS_KM
+        return f"No properties found within {radius:g} km of the given place."
+
+    columns = await fetch_neighbours(ctx.deps.database, neighbours)
+    properties_str, has_more = render_rows(columns, NEARBY_COLUMNS, page=pagina)
+    if has_more:
+        properties_str += "\n" + next_page_hint(has_more, pagina)
+
+    return properties_str
+
+@real_state_agent.tool(retries=3)
+async def find_similar_properties(ctx: RunContext[UserInput], property_id: str, k: int = 5) -> str:
+    """
+    Use this tool when the user asks for properties similar to a given one ("tem algo parecido com esse?").
+    Similarity weighs price, size, bedrooms, bathrooms, garage spaces and location alike.
+
+    Args:
+        property_id (str): The unique identifier of the reference property.
+        k (int): Number of similar properties to return, from 1 to 20.
+
+    Returns:
+        A markdown table with the most similar properties first, and their distance to the reference property.
+    """
+    if not 1 <= k <= MAX_SIMILAR:
+        raise ModelRetry(f"`k` must be between 1 and {MAX_SIMILAR}.")
+
+    index = SimilarityIndex.for_database(ctx.deps.database)
+    await index.refresh()
+    similar = index.similar(property_id, k)
+    if similar is None:
+        raise ModelRetry(f"""Property id not found in the database. ID: {property_id}
+Check the `property_id` and try again.""")
+    if not len(similar.property_ids):
+        return f"No properties similar to {property_id} found."
+
+    columns = await fetch_properties(ctx.deps.database, similar.property_ids.tolist())
+    point = await property_location(ctx.deps.database, property_id)
+    if point is not None:
+        columns["distancia_km"] = haversine_km(*point, np.ma.asarray(columns["latitude"]), np.ma.asarray(columns["longitude"]))
+    else:
+        columns["distancia_km"] = np.ma.masked_all(len(columns["property_id"]))
+    properties_str, _ = render_rows(columns, NEARBY_COLUMNS, page_size=k)
+    return properties_str
+
+@real_state_agent.tool(retries=3)
+async def get_market_stats(
+    ctx: RunContext[UserInput],
+    cidade: str = None,
+    bairro: str = None,
+    n_quartos: int = None,
+    pagina: int = 1,
+) -> str:
+    """
+    Use this tool for questions about prices and sizes in a region, e.g. "qual o preço médio de um 3 quartos no Batel?".
+    Returns the number of listings and the 25th percentile, median and 75th percentile of the price and the price
+    per m², and the median size, per city, neighborhood and/or number of bedrooms. Do not compute these from
+    `search_properties` results. A '-' neighborhood or bedroom count means all of them.
+
+    Args:
+        cidade (str): City name (partial match, tolerant to accents and small typos).
+        bairro (str): Neighborhood name (partial match, tolerant to accents and small typos).
+        n_quartos (int): Number of bedrooms.
+        pagina (int): Page of results to return, starting at 1.
+
+    Returns:
+        A markdown table with the statistics of each matching group, largest first.
+    """
+    check_page_argument(pagina)
+    text_filters = {field: value for field, value in {"bairro": bairro, "cidade": cidade}.items() if value is not None}
+    text_matches = await asyncio.gather(*(match_terms(ctx.deps.database, field, value) for field, value in text_filters.items()))
+    terms = {}
+    for field, matches in zip(text_filters, text_matches):
+        terms[field] = matched_terms(matches)
+        if not terms[field]:
+            message = f"Unknown `{field}`: '{text_filters[field]}'."
+            labels = [match.label for match in matches if match.similarity >= MIN_SUGGESTION_SIMILARITY][:MAX_SUGGESTIONS]
+            if labels:
+                message += " Closest known values: " + ", ".join(f"'{label}'" for label in labels)
+            raise ModelRetry(message)
+
+    try:
+        columns = await fetch_market_stats(ctx.deps.database, cidades=terms.get("cidade"), bairros=terms.get("bairro"), n_quartos=n_quartos)
+    except duckdb.CatalogException:
+        return "Market statistics are not available yet."
+    if not len(columns["n_imoveis"]) and pagina == 1:
+        return "No listings found for the given region and number of bedrooms."
+
+    stats_str, has_more = render_rows(columns, MARKET_COLUMNS, page=pagina)
+    if has_more:
+        stats_str += "\n" + next_page_hint(has_more, pagina)
+
+    return stats_str
+
+@real_state_agent.tool(retries=3)
+async def get_property_slots(
+    ctx: RunContext[UserInput],
+    property_id: str,
+    date_from: str = None,
+    date_to: str = None,
+    time_from: str = None,
+    time_to: str = None,
+    pagina: int = 1,
+) -> str:
+    """
+    Use this tool to get the next available time slots for visiting a specific property.
+    Only future slots are returned, earliest first. Use the optional window to narrow them down,
+    e.g. "next Saturday morning" is date_from=date_to=<that Saturday>, time_from='08:00', time_to='12:00'.
 
     Args:
         property_id (str): The unique identifier of the property.
+        date_from (str): First day of the window, in 'YYYY-MM-DD' format.
+        date_to (str): Last day of the window (inclusive), in 'YYYY-MM-DD' format.
+        time_from (str): Earliest slot start time on each day, in 'HH:MM' format.
+        time_to (str): Slots must start before this time on each day, in 'HH:MM' format.
+        pagina (int): Page of slots to return, starting at 1.
     
     Returns:
         A markdown table with the available slots for the given property.
     """
-    if not await check_if_property_exists(ctx.deps.connection, property_id):
-        raise ModelRetry(
-            f"""Property id not found in the database. ID: {property_id}
+    check_page_argument(pagina)
+    window = {"date_from": date_from, "date_to": date_to, "time_from": time_from, "time_to": time_to}
+    database = database_tag(ctx.deps.database)
+    key = cache_key("slots", database, property_id, limit=fetch_limit(pagina), **window)
+    columns = slot_cache.get(key)
+    if columns is None:
+        if not await check_if_property_exists(ctx.deps.database, property_id):
+            raise ModelRetry(
+                f"""Property id not found in the database. ID: {property_id}
 Check the `property_id` and try again."""
-        )
+            )
+
+        try:
+            columns = await find_free_slots(ctx.deps.database, property_id, limit=fetch_limit(pagina), **window)
+        except ValueError as e:
+            raise ModelRetry(f"""Invalid slot window: {e}
+Use 'YYYY-MM-DD' for `date_from`/`date_to` and 'HH:MM' for `time_from`/`time_to`.""")
+        slot_cache.set(key, columns, tags=[database, (database, property_id)])
 
-    df = ctx.deps.connection.execute(f"SELECT * FROM property_slots WHERE property_id = '{property_id}' AND status = 'free'").fetch_df()
-    df = df.sort_values(by="slot_start").head(10)
+    if not len(columns["inicio"]) and pagina == 1:
+        return f"No free slots found for property {property_id} in the requested window."
 
-    slots_str = ""
-    for _, row in df.iterrows():
-        slots_str += f"Início: {row['slot_start']}\\n"
-        slots_str += f"Fim: {row['slot_end']}\\n"
-        slots_str += "-" * 20 + "\\n"
+    slots_str, has_more = render_rows(columns, SLOT_COLUMNS, page=pagina)
+    if has_more:
+        slots_str += "\n" + next_page_hint(has_more, pagina)
         
-    return slots_str.strip()
+    return slots_str
+
+@real_state_agent.tool(retries=3)
+async def get_slots_for_properties(
+    ctx: RunContext[UserInput],
+    property_ids: list[str],
+    date_from: str = None,
+    date_to: str = None,
+    time_from: str = None,
+    time_to: str = None,
+    per_property: int = 3,
+) -> str:
+    """
+    Use this tool to get the next available visit slots of several properties at once, e.g. "ver horários desses 5 imóveis",
+    instead of calling `get_property_slots` once per property. Takes the same optional window as `get_property_slots`.
+
+    Args:
+        property_ids (list[str]): The unique identifiers of the properties, at most 10.
+        date_from (str): First day of the window, in 'YYYY-MM-DD' format.
+        date_to (str): Last day of the window (inclusive), in 'YYYY-MM-DD' format.
+        time_from (str): Earliest slot start time on each day, in 'HH:MM' format.
+        time_to (str): Slots must start before this time on each day, in 'HH:MM' format.
+        per_property (int): Slots to return per property, from 1 to 10.
+
+    Returns:
+        A markdown table with the available slots of each property, earliest first.
+    """
+    property_ids = list(dict.fromkeys(property_ids))
+    if not 1 <= len(property_ids) <= MAX_PROPERTIES:
+        raise ModelRetry(f"Give between 1 and {MAX_PROPERTIES} `property_ids`.")
+    if not 1 <= per_property <= 10:
+        raise ModelRetry("`per_property` must be between 1 and 10.")
+
+    window = {"date_from": date_from, "date_to": date_to, "time_from": time_from, "time_to": time_to}
+    try:
+        columns, known = await asyncio.gather(
+            find_free_slots_batch(ctx.deps.database, property_ids, per_property, **window),
+            ctx.deps.database.fetchall("SELECT property_id FROM properties WHERE property_id IN (SELECT unnest(?))", [property_ids]),
+        )
+    except ValueError as e:
+        raise ModelRetry(f"""Invalid slot window: {e}
+Use 'YYYY-MM-DD' for `date_from`/`date_to` and 'HH:MM' for `time_from`/`time_to`.""")
+
+    known = {row[0] for row in known}
+    unknown = [property_id for property_id in property_ids if property_id not in known]
+    if len(unknown) == len(property_ids):
+        raise ModelRetry(f"""Property ids not found in the database: {", ".join(unknown)}
+Check the `property_ids` and try again.""")
+
+    with_slots = set(np.asarray(columns["property_id"]).tolist())
+    notes = []
+    if unknown:
+        notes.append("Property ids not found: " + ", ".join(unknown))
+    without_slots = [property_id for property_id in property_ids if property_id in known and property_id not in with_slots]
+    if without_slots:
+        notes.append("No free slots in the requested window for: " + ", ".join(without_slots))
+    if not with_slots:
+        return "\n".join(notes)
+
+    slots_str, _ = render_rows(columns, BATCH_SLOT_COLUMNS, page_size=len(columns["property_id"]))
+    return "\n".join([slots_str, *notes])
+
+@real_state_agent.tool(retries=3)
+async def plan_visit_itinerary(
+    ctx: RunContext[UserInput],
+    property_ids: list[str],
+    day: str,
+    time_from: str = None,
+    time_to: str = None,
+) -> str:
+    """
+    Use this tool to plan visits to several properties on the same day. The properties are ordered by distance into a
+    short route starting with the first one given, and each gets a free slot after the previous visit plus travel time,
+    so visits never overlap. Nothing is booked: show the plan and book the slots the user accepts with `book_property_slots`.
+
+    Args:
+        property_ids (list[str]): The unique identifiers of the properties, at most 10, the starting one first.
+        day (str): Day of the visits, in 'YYYY-MM-DD' format.
+        time_from (str): Earliest visit start time, in 'HH:MM' format.
+        time_to (str): Visits must start before this time, in 'HH:MM' format.
+
+    Returns:
+        A markdown table with the visits in route order, and the properties that could not be fitted.
+    """
+    if not 1 <= len(property_ids) <= MAX_PROPERTIES:
+        raise ModelRetry(f"Give between 1 and {MAX_PROPERTIES} `property_ids`.")
+    try:
+        itinerary = await plan_itinerary(ctx.deps.database, property_ids, day, time_from=time_from, time_to=time_to)
+    except ValueError as e:
+        raise ModelRetry(f"""Invalid day or time: {e}
+Use 'YYYY-MM-DD' for `day` and 'HH:MM' for `time_from`/`time_to`.""")
+    if not itinerary.stops and not itinerary.unscheduled:
+        raise ModelRetry(f"""Property ids not found in the database: {", ".join(itinerary.unknown)}
+Check the `property_ids` and try again.""")
+
+    notes = []
+    if itinerary.unknown:
+        notes.append("Property ids not found: " + ", ".join(itinerary.unknown))
+    if itinerary.unscheduled:
+        notes.append(f"No free slot on {day} fits the route for: " + ", ".join(itinerary.unscheduled))
+    if not itinerary.stops:
+        return "\n".join(notes)
+
+    plan_str, _ = render_rows(itinerary.columns(), ITINERARY_COLUMNS, page_size=len(itinerary.stops))
+    return "\n".join([plan_str, *notes])
 
 @real_state_agent.tool(retries=3)
 async def book_property_slot(ctx: RunContext[UserInput], property_id: str, slot_start: str) -> str:
@@ -147,19 +513,57 @@ async def book_property_slot(ctx: RunContext[UserInput], property_id: str, slot_
     Returns:
         A confirmation message if the booking is successful.
     """
-    if not await check_if_property_exists(ctx.deps.connection, property_id):
-        raise ModelRetry(
-            f"""Property id not found in the database. ID: {property_id}
-Check the `property_id` and try again."""
-        )
-    if not await check_if_slot_exists(ctx.deps.connection, property_id, slot_start):
-        raise ModelRetry(
-            f"""Slot {slot_start} is not available for property {property_id}
-Check the `slot_start` and try again."""
-        )
+    await ctx.deps.allow_side_effects()
+    try:
+        result = await book_slot(ctx.deps.database, property_id, slot_start, booked_by=ctx.deps.user_id or ctx.deps.user_name)
+    except ValueError:
+        raise ModelRetry(f"Invalid `slot_start`: {slot_start}. Use the 'YYYY-MM-DD HH:MM:SS' format.")
+    booking_outcomes[result.status] += 1
+    # Even a failed attempt means the cached slots may be stale, e.g. booked by someone else
+    slot_cache.invalidate((database_tag(ctx.deps.database), property_id))
 
-    ctx.deps.connection.execute(f"UPDATE property_slots SET status = 'booked' WHERE property_id = '{property_id}' AND slot_start = '{slot_start}'")
-    return f"Slot {slot_start} booked for property {property_id}."
+    if not result.ok:
+        raise ModelRetry(booking_failure_message(result))
+    return booking_success_message(result)
+
+@real_state_agent.tool(retries=3)
+async def book_property_slots(ctx: RunContext[UserInput], visits: list[SlotRequest]) -> str:
+    """
+    Use this tool to book several visits at once, e.g. an itinerary from `plan_visit_itinerary` the user accepted.
+    Each visit is booked independently: the output lists the ones booked and why the others failed.
+
+    Args:
+        visits (list[SlotRequest]): The visits to book, at most 10, each a `property_id` and a `slot_start` in 'YYYY-MM-DD HH:MM:SS' format.
+
+    Returns:
+        One line per visit with its outcome.
+    """
+    if not 1 <= len(visits) <= MAX_PROPERTIES:
+        raise ModelRetry(f"Give between 1 and {MAX_PROPERTIES} `visits`.")
+    invalid = []
+    for visit in visits:
+        try:
+            datetime.fromisoformat(visit.slot_start)
+        except ValueError:
+            invalid.append(visit.slot_start)
+    if invalid:
+        raise ModelRetry(f"Invalid `slot_start`: {', '.join(invalid)}. Use the 'YYYY-MM-DD HH:MM:SS' format.")
+
+    await ctx.deps.allow_side_effects()
+    booked_by = ctx.deps.user_id or ctx.deps.user_name
+    results = await asyncio.gather(*(book_slot(ctx.deps.database, visit.property_id, visit.slot_start, booked_by=booked_by) for visit in visits))
+
+    lines = []
+    for result in results:
+        booking_outcomes[result.status] += 1
+        slot_cache.invalidate((database_tag(ctx.deps.database), result.property_id))
+        if result.ok:
+            lines.append(booking_success_message(result))
+        else:
+            lines.append(booking_failure_message(result).replace("\n", " "))
+    if not any(result.ok for result in results):
+        raise ModelRetry("\n".join(lines))
+    return "\n".join(lines)
 
 @real_state_agent.tool(retries=3)
 async def cancel_property_slot(ctx: RunContext[UserInput], property_id: str, slot_start: str) -> str:
@@ -173,16 +577,34 @@ async def cancel_property_slot(ctx: RunContext[UserInput], property_id: str, slo
     Returns:
         A confirmation message if the cancellation is successful.
     """
-    if not await check_if_property_exists(ctx.deps.connection, property_id):
-        raise ModelRetry(
-            f"""Property id not found in the database. ID: {property_id}
+    await ctx.deps.allow_side_effects()
+    try:
+        result = await cancel_slot(ctx.deps.database, property_id, slot_start, booked_by=ctx.deps.user_id or ctx.deps.user_name)
+    except ValueError:
+        raise ModelRetry(f"Invalid `slot_start`: {slot_start}. Use the 'YYYY-MM-DD HH:MM:SS' format.")
+    booking_outcomes[result.status] += 1
+    slot_cache.invalidate((database_tag(ctx.deps.database), property_id))
+
+    if not result.ok:
+        raise ModelRetry(booking_failure_message(result))
+    return f"Slot {slot_start} cancelled for property {property_id}."
+
+def booking_success_message(result: BookingResult) -> str:
+    if result.status == "already_yours":
+        return f"Slot {result.slot_start} of property {result.property_id} was already booked by this user; nothing changed."
+    return f"Slot {result.slot_start} booked for property {result.property_id}."
+
+def booking_failure_message(result: BookingResult) -> str:
+    if result.status == "property_not_found":
+        return f"""Property id not found in the database. ID: {result.property_id}
 Check the `property_id` and try again."""
-        )
-    if not await check_if_slot_exists(ctx.deps.connection, property_id, slot_start):
-        raise ModelRetry(
-            f"""Slot {slot_start} is not available for property {property_id}
+    if result.status == "slot_not_found":
+        return f"""Slot {result.slot_start} does not exist for property {result.property_id}
+Check the `slot_start` with the `get_property_slots` tool and try again."""
+    if result.status in ("already_booked", "conflict"):
+        return f"""Slot {result.slot_start} of property {result.property_id} was already booked by someone else.
+Use the `get_property_slots` tool to offer the user another slot."""
+    if result.status == "not_booked":
+        return f"""Slot {result.slot_start} of property {result.property_id} is not booked, so there is nothing to cancel.
 Check the `slot_start` and try again."""
-        )
-        
-    ctx.deps.connection.execute(f"UPDATE property_slots SET status = 'free' WHERE property_id = '{property_id}' AND slot_start = '{slot_start}'")
-    return f"Slot {slot_start} cancelled for property {property_id}."
+    return f"""Slot {result.slot_start} of property {result.property_id} was booked by another user and cannot be cancelled."""
@@ -0,0 +1,100 @@
+import duckdb
+from datetime import datetime
+from typing import Optional
+from app.models.booking_models import BookingResult
+from app.utils.database import Database
+
+
+BOOK_SQL = """
+UPDATE property_slots
+SET status = 'booked', booked_by = ?, booked_at = now()
+WHERE property_id = ? AND slot_start = ? AND status = 'free'
+RETURNING booked_by
+"""
+
+CANCEL_SQL = """
+UPDATE property_slots
+SET status = 'free', booked_by = NULL, booked_at = NULL
+WHERE property_id = ? AND slot_start = ? AND status = 'booked' AND (booked_by IS NULL OR booked_by = ?)
+RETURNING property_id
+"""
+
+
+def slot_state(cursor: duckdb.DuckDBPyConnection, property_id: str, slot_start: str) -> tuple[Optional[tuple], bool]:
+    """
+    Reads the current status of a slot and whether its property exists at all.
+
+    Only used to explain why a conditional update did not apply, so the happy path stays a
+    single statement.
+    """
+    row = cursor.execute(
+        "SELECT status, booked_by FROM property_slots WHERE property_id = ? AND slot_start = ?",
+        [property_id, slot_start],
+    ).fetchone()
+    if row is not None:
+        return row, True
+    exists = cursor.execute("SELECT EXISTS(SELECT 1 FROM property_slots WHERE property_id = ?)", [property_id]).fetchone()[0]
+    return None, exists
+
+
+def book(cursor: duckdb.DuckDBPyConnection, property_id: str, slot_start: str, booked_by: str) -> BookingResult:
+    try:
+        rows = cursor.execute(BOOK_SQL, [booked_by, property_id, slot_start]).fetchall()
+    except duckdb.TransactionException:
+        # Another cursor updated the same row concurrently and won
+        return BookingResult(status="conflict", property_id=property_id, slot_start=slot_start)
+    if rows:
+        return BookingResult(status="booked", property_id=property_id, slot_start=slot_start, booked_by=booked_by)
+
+    row, property_exists = slot_state(cursor, property_id, slot_start)
+    if row is None:
+        status = "slot_not_found" if property_exists else "property_not_found"
+        return BookingResult(status=status, property_id=property_id, slot_start=slot_start)
+    if row[0] == "booked" and row[1] == booked_by:
+        # Booking again a slot one already holds, e.g. a retried tool call, is not a lost race
+        return BookingResult(status="already_yours", property_id=property_id, slot_start=slot_start, booked_by=booked_by)
+    return BookingResult(status="already_booked", property_id=property_id, slot_start=slot_start, booked_by=row[1])
+
+
+def cancel(cursor: duckdb.DuckDBPyConnection, property_id: str, slot_start: str, booked_by: str) -> BookingResult:
+    try:
+        rows = cursor.execute(CANCEL_SQL, [property_id, slot_start, booked_by]).fetchall()
+    except duckdb.TransactionException:
+        return BookingResult(status="conflict", property_id=property_id, slot_start=slot_start)
+    if rows:
+        return BookingResult(status="cancelled", property_id=property_id, slot_start=slot_start)
+
+    row, property_exists = slot_state(cursor, property_id, slot_start)
+    if row is None:
+        status = "slot_not_found" if property_exists else "property_not_found"
+        return BookingResult(status=status, property_id=property_id, slot_start=slot_start)
+    if row[0] != "booked":
+        return BookingResult(status="not_booked", property_id=property_id, slot_start=slot_start)
+    return BookingResult(status="not_owner", property_id=property_id, slot_start=slot_start, booked_by=row[1])
+
+
+async def book_slot(database: Database, property_id: str, slot_start: str, booked_by: str) -> BookingResult:
+    """
+    Books a free slot with a single conditional `UPDATE ... RETURNING`.
+
+    The update only applies while the slot is still free, so of several concurrent bookers
+    exactly one wins; the others get `already_booked`, or `conflict` if DuckDB aborted
+    their transaction because they raced on the same row. Booking again a slot already
+    held by `booked_by` gets `already_yours`.
+
+    Raises:
+        ValueError: If `slot_start` is not an ISO 'YYYY-MM-DD HH:MM:SS' timestamp.
+    """
+    datetime.fromisoformat(slot_start)
+    return await database.run(book, property_id, slot_start, booked_by)
+
+
+async def cancel_slot(database: Database, property_id: str, slot_start: str, booked_by: str) -> BookingResult:
+    """
+    Frees a slot booked by `booked_by` (or by nobody in particular) in a single statement.
+
+    Raises:
+        ValueError: If `slot_start` is not an ISO 'YYYY-MM-DD HH:MM:SS' timestamp.
+    """
+    datetime.fromisoformat(slot_start)
+    return await database.run(cancel, property_id, slot_start, booked_by)
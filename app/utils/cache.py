@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional
+from app.utils.text_search import normalize_text, SEARCH_FIELDS
+
+
+class ResultCache:
+    """
+    Bounded LRU cache whose entries also expire `ttl` seconds after being stored.
+
+    Entries can carry tags, e.g. the property whose slots they hold, so a write can drop
+    every entry it made stale with `invalidate`. Only meant to be used from the event loop
+    thread, so there is no locking.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any, tuple]] = OrderedDict()
+        self._tags: dict[Hashable, set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= self.clock():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[Hashable] = ()) -> None:
+        if key in self._entries:
+            self._remove(key)
+        tags = tuple(tags)
+        self._entries[key] = (self.clock() + self.ttl, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, tag: Hashable) -> int:
+        """
+        Drops every entry stored with `tag` and returns how many there were.
+        """
+        keys = self._tags.pop(tag, set())
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._tags.clear()
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+def cache_key(*parts: Any, **arguments: Optional[Any]) -> tuple:
+    """
+    Builds a cache key from positional parts and tool arguments, normalising the arguments
+    so that calls differing only in spelling share an entry: rua/bairro/cidade are accent
+    and case folded with `normalize_text`, other strings are stripped, whole floats become
+    ints and unset arguments are left out.
+    """
+    normalized = []
+    for name, value in sorted(arguments.items()):
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = normalize_text(value) if name in SEARCH_FIELDS else value.strip()
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        normalized.append((name, value))
+    return (*parts, tuple(normalized))
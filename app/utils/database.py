@@ -0,0 +1,207 @@
+import asyncio
+import math
+import os
+import statistics
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Sequence
+
+import duckdb
+
+
+DEFAULT_MAX_WORKERS = min(8, os.cpu_count() or 1)
+WAIT_SAMPLES        = 1000      # Recent pool wait times kept for the percentiles
+
+
+def sql_literal(value: Any) -> str:
+    """
+    Renders a Python value as a DuckDB literal for `EXECUTE` arguments.
+
+    This is literal rendering, not parameter binding: DuckDB's Python client cannot bind
+    parameters to `EXECUTE`, so values are written into the statement text. Numbers are
+    coerced through `int`/`float` and strings are quoted with every single quote doubled,
+    which leaves no way to break out of the literal.
+
+    Raises:
+        ValueError: If `value` is a non-finite float, which has no literal; callers
+            validate numbers before they get here.
+        TypeError: If `value` is of another type.
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, int):
+        return str(int(value))
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError(f"Cannot render non-finite number: {value}")
+        return repr(float(value))
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(sql_literal(item) for item in value) + "]"
+    raise TypeError(f"Unsupported literal type: {type(value).__name__}")
+
+
+# Statements prepared on each cursor, by name
+_prepared: "weakref.WeakKeyDictionary[duckdb.DuckDBPyConnection, set[str]]" = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def execute_prepared(cursor: duckdb.DuckDBPyConnection, name: str, sql: str, values: Sequence[Any]) -> duckdb.DuckDBPyConnection:
+    """
+    Executes `sql` as the prepared statement `name`, preparing it on first use by `cursor`.
+
+    The statement is planned once per cursor, but `values` are rendered into the `EXECUTE`
+    text with `sql_literal`, so that text still differs with every value. Must be called
+    from the thread that owns `cursor`.
+    """
+    with _prepared_lock:
+        prepared = _prepared.setdefault(cursor, set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    if not values:
+        return cursor.execute(f"EXECUTE {name}")
+    return cursor.execute(f"EXECUTE {name}({', '.join(sql_literal(value) for value in values)})")
+
+
+def fetch(cursor: duckdb.DuckDBPyConnection, query: str, params: Optional[Sequence[Any]], method: Optional[str]) -> Any:
+    """
+    Executes `query` and returns its result through the cursor `method`, if any.
+    """
+    result = cursor.execute(query, params)
+    return getattr(result, method)() if method else None
+
+
+def fetch_prepared(cursor: duckdb.DuckDBPyConnection, name: str, sql: str, values: Sequence[Any], method: str) -> Any:
+    return getattr(execute_prepared(cursor, name, sql, values), method)()
+
+
+class Database:
+    """
+    Async access layer over a DuckDB connection.
+
+    Queries run in a bounded thread pool so they never block the event loop. Every worker
+    thread owns its own `connection.cursor()`, which DuckDB can execute in parallel, so
+    concurrent chats scale across cores instead of serialising on a single connection.
+    `stats()` reports the contention for the pool: queries in flight and how long they
+    waited for a free worker.
+    """
+
+    # Shared instances by `id()` of their connection, which they keep alive until `close()`
+    _instances: "dict[int, Database]" = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, connection: Optional[duckdb.DuckDBPyConnection], max_workers: Optional[int] = None):
+        self.connection = connection
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="duckdb")
+        self._local = threading.local()
+        self.queries = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.waits: deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self._close_callbacks: list[Callable[["Database"], None]] = []
+
+    @classmethod
+    def for_connection(cls, connection: duckdb.DuckDBPyConnection, max_workers: Optional[int] = None) -> "Database":
+        """
+        Returns the shared `Database` bound to `connection`, creating it on first use. It
+        stays registered, with its connection and pool, until `close()`.
+        """
+        with cls._instances_lock:
+            database = cls._instances.get(id(connection))
+            if database is None:
+                database = cls(connection, max_workers=max_workers)
+                cls._instances[id(connection)] = database
+            return database
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """
+        Returns the cursor owned by the calling worker thread.
+        """
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None:
+            cursor = self.connection.cursor()
+            self._local.cursor = cursor
+        return cursor
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Runs `func(cursor, *args, **kwargs)` in the pool and awaits its result.
+        """
+        return await self._submit(lambda: func(self.cursor(), *args, **kwargs))
+
+    async def _submit(self, call: Callable[[], Any]) -> Any:
+        submitted = time.monotonic()
+
+        def task() -> Any:
+            self.waits.append(time.monotonic() - submitted)
+            return call()
+
+        loop = asyncio.get_running_loop()
+        self.queries += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await loop.run_in_executor(self._executor, task)
+        finally:
+            self.in_flight -= 1
+
+    # The helpers below pass module-level functions to `run`, so they also work through a
+    # `RemoteDatabase`, which sends them to another process
+
+    async def fetchall_prepared(self, name: str, sql: str, values: Sequence[Any]) -> list[tuple]:
+        return await self.run(fetch_prepared, name, sql, values, "fetchall")
+
+    async def fetchnumpy_prepared(self, name: str, sql: str, values: Sequence[Any]) -> dict[str, Any]:
+        return await self.run(fetch_prepared, name, sql, values, "fetchnumpy")
+
+    async def execute(self, query: str, params: Optional[Sequence[Any]] = None) -> None:
+        await self.run(fetch, query, params, None)
+
+    async def fetchone(self, query: str, params: Optional[Sequence[Any]] = None) -> Optional[tuple]:
+        return await self.run(fetch, query, params, "fetchone")
+
+    async def fetchall(self, query: str, params: Optional[Sequence[Any]] = None) -> list[tuple]:
+        return await self.run(fetch, query, params, "fetchall")
+
+    async def fetchnumpy(self, query: str, params: Optional[Sequence[Any]] = None) -> dict[str, Any]:
+        return await self.run(fetch, query, params, "fetchnumpy")
+
+    def stats(self) -> dict[str, Any]:
+        waits = sorted(self.waits)
+        return {
+            "queries": self.queries,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "workers": self.max_workers,
+            "wait_p50": statistics.median(waits) if waits else 0.0,
+            "wait_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "wait_max": waits[-1] if waits else 0.0,
+        }
+
+    def on_close(self, callback: Callable[["Database"], None]) -> None:
+        """
+        Registers `callback(database)` to run on `close()`, e.g. to drop what other modules
+        hold for this database by its `id()`.
+        """
+        self._close_callbacks.append(callback)
+
+    def close(self) -> None:
+        """
+        Stops the pool and, for a shared instance, unregisters it; `for_connection` then
+        creates a new one. The `on_close` callbacks run last.
+        """
+        with self._instances_lock:
+            if self.connection is not None and self._instances.get(id(self.connection)) is self:
+                del self._instances[id(self.connection)]
+        self._executor.shutdown(wait=True)
+        callbacks, self._close_callbacks = self._close_callbacks, []
+        for callback in callbacks:
+            callback(self)
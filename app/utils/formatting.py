@@ -0,0 +1,147 @@
+import numpy as np
+from dataclasses import dataclass
+from typing import Mapping, Optional, Sequence
+
+
+DEFAULT_PAGE_SIZE = 10
+MISSING           = "-"
+
+
+@dataclass(frozen=True)
+class Column:
+    name: str               # Result column
+    label: str              # Header (table layout) or field label (detailed layout)
+    fmt: str = "%s"         # printf-style format applied to every value
+
+
+PROPERTY_COLUMNS = (
+    Column("property_id", "ID"),
+    Column("preco", "Preço (R$)", "%.0f"),
+    Column("tamanho", "Tamanho (m²)", "%g"),
+    Column("n_quartos", "Quartos", "%d"),
+    Column("n_banheiros", "Banheiros", "%d"),
+    Column("n_garagem", "Vagas", "%d"),
+    Column("rua", "Rua"),
+    Column("bairro", "Bairro"),
+    Column("cidade", "Cidade"),
+)
+
+NEARBY_COLUMNS = (
+    *PROPERTY_COLUMNS,
+    Column("distancia_km", "Distância (km)", "%.2f"),
+)
+
+MARKET_COLUMNS = (
+    Column("cidade", "Cidade"),
+    Column("bairro", "Bairro"),
+    Column("n_quartos", "Quartos", "%d"),
+    Column("n_imoveis", "Imóveis", "%d"),
+    Column("preco_p25", "Preço p25 (R$)", "%.0f"),
+    Column("preco_mediana", "Preço mediano (R$)", "%.0f"),
+    Column("preco_p75", "Preço p75 (R$)", "%.0f"),
+    Column("preco_m2_p25", "R$/m² p25", "%.0f"),
+    Column("preco_m2_mediana", "R$/m² mediano", "%.0f"),
+    Column("preco_m2_p75", "R$/m² p75", "%.0f"),
+    Column("tamanho_mediana", "Tamanho mediano (m²)", "%g"),
+)
+
+SLOT_COLUMNS = (
+    Column("inicio", "Início"),
+    Column("fim", "Fim"),
+)
+
+BATCH_SLOT_COLUMNS = (
+    Column("property_id", "ID"),
+    *SLOT_COLUMNS,
+)
+
+ITINERARY_COLUMNS = (
+    Column("ordem", "Ordem", "%d"),
+    Column("property_id", "ID"),
+    *SLOT_COLUMNS,
+    Column("rua", "Rua"),
+    Column("bairro", "Bairro"),
+    Column("distancia_km", "Distância da visita anterior (km)", "%.2f"),
+)
+
+
+def check_page(page: int) -> None:
+    """
+    Raises:
+        ValueError: If `page` is before the first page, which would render nothing or
+            become a negative `OFFSET`.
+    """
+    if page < 1:
+        raise ValueError(f"Pages start at 1, got {page}")
+
+
+def format_column(values: np.ndarray, fmt: str) -> np.ndarray:
+    """
+    Formats a whole result column at once, rendering NULLs as `MISSING`.
+    """
+    values = np.ma.asarray(values)
+    cells = np.char.mod(fmt, np.ma.getdata(values))
+    return np.where(np.ma.getmaskarray(values), MISSING, cells)
+
+
+def render_rows(
+    columns: Mapping[str, np.ndarray],
+    spec: Sequence[Column],
+    layout: str = "table",
+    page: int = 1,
+    page_size: int = DEFAULT_PAGE_SIZE,
+) -> tuple[str, bool]:
+    """
+    Renders one page of a result set fetched with `fetchnumpy`.
+
+    Every column is formatted in a single vectorised pass and the rows are joined once,
+    so the cost is linear in the page size. The `table` layout is a compact markdown
+    table, with one line per row; the `detailed` layout is one `Label: value` line per
+    field.
+
+    Returns the rendered page and whether there are rows after it.
+
+    Raises:
+        ValueError: If `page` is less than 1.
+    """
+    check_page(page)
+    start = (page - 1) * page_size
+    end = start + page_size
+    cells = [format_column(np.ma.asarray(columns[column.name])[start:end], column.fmt) for column in spec]
+    n_rows = len(np.ma.asarray(columns[spec[0].name]))
+
+    if layout == "table":
+        rows = np.char.add("| ", cells[0])
+        for cell in cells[1:]:
+            rows = np.char.add(np.char.add(rows, " | "), cell)
+        lines = [
+            "| " + " | ".join(column.label for column in spec) + " |",
+            "|" + "|".join("---" for _ in spec) + "|",
+            *np.char.add(rows, " |").tolist(),
+        ]
+        return "\n".join(lines), n_rows > end
+
+    if layout == "detailed":
+        rows = np.char.add(f"{spec[0].label}: ", cells[0])
+        for column, cell in zip(spec[1:], cells[1:]):
+            rows = np.char.add(np.char.add(rows, f"\n{column.label}: "), cell)
+        return ("\n" + "-" * 20 + "\n").join(rows.tolist()), n_rows > end
+
+    raise ValueError(f"Unknown layout: {layout}")
+
+
+def fetch_limit(page: int, page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """
+    Rows to fetch to render `page`, plus one to know whether another page follows.
+
+    Raises:
+        ValueError: If `page` is less than 1.
+    """
+    check_page(page)
+    return page * page_size + 1
+
+
+def next_page_hint(has_more: bool, page: int, argument: str = "pagina") -> Optional[str]:
+    if not has_more:
+        return None
+    return f"More results available: call the tool again with the same arguments and {argument}={page + 1}."
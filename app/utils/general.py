@@ -1,15 +1,43 @@
 import yaml
-import duckdb
+import numpy as np
+from typing import Any, Sequence
+from app.utils.database import Database
+
+DEFAULT_MLFLOW_AUTOLOG = False
 
 async def load_config(config_path: str):
     with open(config_path, "r") as file:
         config = yaml.safe_load(file)
     return config
 
-async def check_if_property_exists(connection: duckdb.DuckDBPyConnection, property_id: str) -> bool:
-    result = connection.execute(f"SELECT EXISTS(SELECT 1 FROM property_slots WHERE property_id = '{property_id}') AS exists").fetchone()
+def setup_mlflow(config: dict[str, Any], experiment: str) -> bool:
+    """
+    Turns on mlflow tracing of the agent runs when `mlflow_autolog` is set. mlflow is only
+    imported then, as it takes longer to import than the rest of the app.
+    """
+    if not config.get("mlflow_autolog", DEFAULT_MLFLOW_AUTOLOG):
+        return False
+    import mlflow
+    mlflow.pydantic_ai.autolog()
+    mlflow.set_experiment(experiment)
+    return True
+
+async def has_column(database: Database, table: str, column: str) -> bool:
+    result = await database.fetchone(
+        "SELECT count(*) > 0 FROM duckdb_columns() WHERE table_name = ? AND column_name = ?", [table, column]
+    )
     return result[0]
 
-async def check_if_slot_exists(connection: duckdb.DuckDBPyConnection, property_id: str, slot_start: str) -> bool:
-    result = connection.execute(f"SELECT EXISTS(SELECT 1 FROM property_slots WHERE property_id = '{property_id}' AND slot_start = '{slot_start}') AS exists").fetchone()
+async def check_if_property_exists(database: Database, property_id: str) -> bool:
+    result = await database.fetchone("SELECT EXISTS(SELECT 1 FROM property_slots WHERE property_id = ?) AS exists", [property_id])
     return result[0]
+
+async def fetch_properties(database: Database, property_ids: Sequence[str]) -> dict[str, np.ndarray]:
+    """
+    The `properties` rows of `property_ids`, in that order, as `fetchnumpy` columns.
+    Unknown ids are left out.
+    """
+    columns = await database.fetchnumpy("SELECT * FROM properties WHERE property_id IN (SELECT unnest(?))", [list(property_ids)])
+    rank = {property_id: i for i, property_id in enumerate(property_ids)}
+    order = np.argsort([rank[property_id] for property_id in np.asarray(columns["property_id"]).tolist()], kind="stable")
+    return {name: values[order] for name, values in columns.items()}
@@ -0,0 +1,256 @@
+import asyncio
+import math
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import duckdb
+import numpy as np
+from app.utils.database import Database
+from app.utils.general import fetch_properties
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE   = 111.195       # Along a meridian
+CELL_DEGREES    = 0.01          # Grid cell side, about 1.1 km
+MAX_RADIUS_KM   = 100.0         # Nearest-neighbour searches never look further
+REFRESH_SECONDS = 60            # New listings show up within this delay
+REBUILD_SECONDS = 3600          # Full rebuilds also pick up moved and removed listings
+MAX_DELTA_SHARE = 0.1           # Listings added since the build that trigger a rebuild
+
+
+def haversine_km(latitude: float, longitude: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    lat1, lon1 = math.radians(latitude), math.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+@dataclass
+class Neighbours:
+    property_ids: np.ndarray
+    distances_km: np.ndarray
+
+
+class GeoIndex:
+    """
+    In-memory grid index over the coordinates of `properties`, for radius and
+    nearest-neighbour queries.
+
+    Listings are bucketed into cells of `cell_degrees` and stored sorted by cell, so a
+    query only computes distances for the cells its circle overlaps, found with a binary
+    search, instead of the whole table. Listings ingested after the build (by
+    `ingested_at`) are kept in a small delta that is scanned in full; the index is rebuilt
+    once the delta grows past `MAX_DELTA_SHARE` of it, or every `rebuild_seconds`.
+    """
+
+    _instances: "weakref.WeakKeyDictionary[Database, GeoIndex]" = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(
+        self,
+        database: Database,
+        cell_degrees: float = CELL_DEGREES,
+        refresh_seconds: float = REFRESH_SECONDS,
+        rebuild_seconds: float = REBUILD_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        # Held weakly, as the shared instances are keyed by their database
+        self._database = weakref.ref(database)
+        self.cell_degrees = cell_degrees
+        self.n_columns = math.ceil(360 / cell_degrees) + 1
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.clock = clock
+        self._lock = asyncio.Lock()
+        self.built_at: Optional[float] = None
+        self.refreshed_at: Optional[float] = None
+        self.watermark: Any = None
+        self.builds = 0
+        self._set_base(np.array([], dtype=object), np.array([]), np.array([]))
+        self._set_delta(np.array([], dtype=object), np.array([]), np.array([]))
+
+    @property
+    def database(self) -> Database:
+        return self._database()
+
+    @classmethod
+    def for_database(cls, database: Database) -> "GeoIndex":
+        """
+        Returns the shared `GeoIndex` of `database`, creating it on first use.
+        """
+        with cls._instances_lock:
+            index = cls._instances.get(database)
+            if index is None:
+                index = cls(database)
+                cls._instances[database] = index
+            return index
+
+    def cells(self, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        rows = np.floor((np.asarray(latitudes) + 90) / self.cell_degrees).astype(np.int64)
+        columns = np.floor((np.asarray(longitudes) + 180) / self.cell_degrees).astype(np.int64)
+        return rows * self.n_columns + columns
+
+    def _set_base(self, property_ids: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray) -> None:
+        keys = self.cells(latitudes, longitudes)
+        order = np.argsort(keys, kind="stable")
+        self.property_ids = property_ids[order]
+        self.latitudes = latitudes[order]
+        self.longitudes = longitudes[order]
+        self.cell_keys, self.cell_starts = np.unique(keys[order], return_index=True)
+        self.cell_ends = np.append(self.cell_starts[1:], len(order))
+
+    def _set_delta(self, property_ids: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray) -> None:
+        self.delta_ids = property_ids
+        self.delta_latitudes = latitudes
+        self.delta_longitudes = longitudes
+
+    @staticmethod
+    def _load(cursor: duckdb.DuckDBPyConnection, since: Any = None) -> tuple[dict[str, np.ndarray], Any]:
+        has_ingested_at = cursor.execute(
+            "SELECT count(*) FROM duckdb_columns() WHERE table_name = 'properties' AND column_name = 'ingested_at'"
+        ).fetchone()[0] > 0
+        where = "latitude IS NOT NULL AND longitude IS NOT NULL"
+        params: list[Any] = []
+        if since is not None and has_ingested_at:
+            where += " AND ingested_at > ?"
+            params.append(since)
+        columns = cursor.execute(f"SELECT property_id, latitude, longitude FROM properties WHERE {where}", params).fetchnumpy()
+        watermark = cursor.execute("SELECT max(ingested_at) FROM properties").fetchone()[0] if has_ingested_at else None
+        return columns, watermark
+
+    async def refresh(self) -> None:
+        """
+        Builds the index on first use and brings it up to date when it is due.
+        """
+        now = self.clock()
+        if self.refreshed_at is not None and now - self.refreshed_at < self.refresh_seconds:
+            return
+        async with self._lock:
+            now = self.clock()
+            if self.refreshed_at is not None and now - self.refreshed_at < self.refresh_seconds:
+                return
+            rebuild = (
+                self.built_at is None
+                or now - self.built_at >= self.rebuild_seconds
+                or len(self.delta_ids) > MAX_DELTA_SHARE * max(len(self.property_ids), 1)
+            )
+            if not rebuild and self.watermark is None:
+                # Without `ingested_at` new listings cannot be told apart
+                self.refreshed_at = now
+                return
+
+            columns, watermark = await self.database.run(self._load, None if rebuild else self.watermark)
+            arrays = (
+                np.asarray(columns["property_id"], dtype=object),
+                np.asarray(columns["latitude"], dtype=np.float64),
+                np.asarray(columns["longitude"], dtype=np.float64),
+            )
+            if rebuild:
+                self._set_base(*arrays)
+                self._set_delta(np.array([], dtype=object), np.array([]), np.array([]))
+                self.built_at = now
+                self.builds += 1
+            elif len(arrays[0]):
+                self._set_delta(*(np.concatenate([old, new]) for old, new in zip(
+                    (self.delta_ids, self.delta_latitudes, self.delta_longitudes), arrays
+                )))
+            self.watermark = watermark if watermark is not None else self.watermark
+            self.refreshed_at = now
+
+    def _candidates(self, latitude: float, longitude: float, radius_km: float) -> np.ndarray:
+        """
+        Positions in the base arrays of the listings in the cells a circle overlaps.
+        """
+        lat_span = radius_km / KM_PER_DEGREE
+        lon_span = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        rows = np.arange(*np.floor((np.array([latitude - lat_span, latitude + lat_span]) + 90) / self.cell_degrees).astype(np.int64) + [0, 1])
+        columns = np.arange(*np.floor((np.array([longitude - lon_span, longitude + lon_span]) + 180) / self.cell_degrees).astype(np.int64) + [0, 1])
+        keys = (rows[:, None] * self.n_columns + columns[None, :]).ravel()
+
+        found = np.searchsorted(self.cell_keys, keys)
+        present = found < len(self.cell_keys)
+        keys, found = keys[present], found[present]
+        # A missing key finds the next cell, which may be in the window too: keep exact hits only
+        found = found[self.cell_keys[found] == keys]
+        starts, ends = self.cell_starts[found], self.cell_ends[found]
+        lengths = ends - starts
+        if not lengths.sum():
+            return np.array([], dtype=np.int64)
+        # Concatenated aranges of every [start, end)
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return np.arange(lengths.sum()) + offsets
+
+    def radius(self, latitude: float, longitude: float, radius_km: float, limit: Optional[int] = None, exclude: Optional[str] = None) -> Neighbours:
+        """
+        Listings within `radius_km` of a point, nearest first, at most `limit` of them.
+        """
+        positions = self._candidates(latitude, longitude, radius_km)
+        ids = np.concatenate([self.property_ids[positions], self.delta_ids])
+        distances = np.concatenate([
+            haversine_km(latitude, longitude, self.latitudes[positions], self.longitudes[positions]),
+            haversine_km(latitude, longitude, self.delta_latitudes, self.delta_longitudes),
+        ])
+        keep = distances <= radius_km
+        if exclude is not None:
+            keep &= ids != exclude
+        ids, distances = ids[keep], distances[keep]
+
+        if limit is not None and len(distances) > limit:
+            top = np.argpartition(distances, limit - 1)[:limit]
+            ids, distances = ids[top], distances[top]
+        order = np.argsort(distances, kind="stable")
+        return Neighbours(ids[order], distances[order])
+
+    def nearest(self, latitude: float, longitude: float, k: int, max_radius_km: float = MAX_RADIUS_KM, exclude: Optional[str] = None) -> Neighbours:
+        """
+        The `k` listings nearest to a point, within `max_radius_km`.
+
+        Searches a circle that doubles until it holds `k` listings; those are then the
+        nearest, as anything outside the circle is further away.
+        """
+        radius_km = self.cell_degrees * KM_PER_DEGREE
+        while True:
+            found = self.radius(latitude, longitude, radius_km, limit=k, exclude=exclude)
+            if len(found.property_ids) >= k or radius_km >= max_radius_km:
+                return found
+            radius_km = min(radius_km * 2, max_radius_km)
+
+    def stats(self) -> dict[str, Any]:
+        return {"listings": len(self.property_ids), "delta": len(self.delta_ids), "cells": len(self.cell_keys), "builds": self.builds}
+
+
+async def property_location(database: Database, property_id: str) -> Optional[tuple[float, float]]:
+    """
+    Latitude and longitude of a listing, or None if it is unknown or has no coordinates.
+    """
+    row = await database.fetchone(
+        "SELECT latitude, longitude FROM properties WHERE property_id = ? AND latitude IS NOT NULL AND longitude IS NOT NULL",
+        [property_id],
+    )
+    return (row[0], row[1]) if row else None
+
+
+async def area_centroid(database: Database, terms: dict[str, list[str]]) -> Optional[tuple[float, float]]:
+    """
+    Mean coordinates of the listings whose `<field>_norm` is one of `terms[field]`, for
+    every field given, e.g. the centre of a neighbourhood. None if no listing matches.
+    """
+    where = " AND ".join(f"{field}_norm IN (SELECT unnest(?))" for field in terms)
+    row = await database.fetchone(
+        f"SELECT avg(latitude), avg(longitude) FROM properties WHERE {where} AND latitude IS NOT NULL AND longitude IS NOT NULL",
+        list(terms.values()),
+    )
+    return (row[0], row[1]) if row and row[0] is not None else None
+
+
+async def fetch_neighbours(database: Database, neighbours: Neighbours) -> dict[str, np.ndarray]:
+    """
+    The `properties` rows of `neighbours`, in their order, with a `distancia_km` column.
+    """
+    property_ids = neighbours.property_ids.tolist()
+    columns = await fetch_properties(database, property_ids)
+    rank = {property_id: i for i, property_id in enumerate(property_ids)}
+    columns["distancia_km"] = neighbours.distances_km[[rank[property_id] for property_id in np.asarray(columns["property_id"]).tolist()]]
+    return columns
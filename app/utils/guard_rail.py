@@ -0,0 +1,133 @@
+import asyncio
+import re
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+from app.utils.text_search import normalize_text
+
+
+T = TypeVar("T")
+
+
+# Messages with more words than this always go to the LLM: a long message can bury an
+# off-topic request or an injection between real estate words.
+MAX_LOCAL_WORDS = 12
+
+# Whole messages that are small talk or answers to the agent's questions
+SMALL_TALK = frozenset({
+    "oi", "ola", "opa", "e ai", "bom dia", "boa tarde", "boa noite", "tudo bem", "tudo bom",
+    "sim", "nao", "ok", "okay", "certo", "claro", "pode ser", "pode", "beleza", "perfeito",
+    "otimo", "show", "isso", "exato", "obrigado", "obrigada", "valeu", "tchau", "ate mais",
+    "hi", "hello", "hey", "yes", "no", "thanks", "thank you", "bye", "sure",
+})
+
+# A bare property id, number, price, date or time
+BARE_VALUE_PATTERN = re.compile(r"^(?:[a-z]*\d[\w\-:/.,]*|r\$ ?[\d.,]+(?: ?mil)?)$")
+
+ON_TOPIC_PATTERN = re.compile(r"\b(?:" + "|".join((
+    r"imove(?:l|is)", r"apartamentos?", r"aptos?", r"casas?", r"sobrados?", r"kitnets?", r"studios?",
+    r"coberturas?", r"terrenos?", r"quartos?", r"suites?", r"banheiros?", r"garage(?:m|ns)", r"vagas?",
+    r"ruas?", r"bairros?", r"cidades?", r"regiao", r"perto", r"metros?", r"m2", r"tamanho",
+    r"prec(?:o|os)", r"valor", r"reais", r"mil", r"orcamento", r"alug\w*", r"compr\w*", r"vend\w*",
+    r"financ\w*", r"visit\w*", r"agend\w*", r"horarios?", r"marc\w*", r"reserv\w*", r"cancel\w*",
+    r"house", r"houses", r"apartments?", r"flat", r"rent", r"buy", r"bedrooms?", r"bathrooms?",
+    r"property", r"properties", r"neighbou?rhood", r"price", r"visit", r"book", r"slots?",
+)) + r")\b")
+
+OFF_TOPIC_PATTERN = re.compile(r"\b(?:" + "|".join((
+    r"matematica", r"math", r"homework", r"licao", r"deve(?:r|res) de casa", r"receitas?", r"recipe",
+    r"futebol", r"football", r"soccer", r"poemas?", r"poems?", r"piadas?", r"jokes?", r"programa(?:r|cao)", r"codigo", r"python",
+    r"javascript", r"filmes?", r"movies?", r"musicas?", r"songs?", r"politica", r"politics", r"eleic\w*",
+    r"bitcoin", r"horoscopo", r"capital", r"traduz\w*", r"translate",
+    r"escrev\w*", r"write", r"redac\w*", r"essays?", r"resum\w*", r"summari[sz]e", r"historias?", r"stor(?:y|ies)",
+)) + r")\b")
+
+# Never decided locally, whatever else the message says
+ESCALATE_PATTERN = re.compile(r"\b(?:" + "|".join((
+    r"ignor\w*", r"instruc\w*", r"instructions?", r"prompt", r"sistema", r"system", r"regras?", r"rules?",
+    r"roub\w*", r"invad\w*", r"mat(?:ar|e)", r"kill", r"armas?", r"weapons?", r"drogas?", r"drugs?",
+    r"hack\w*", r"golpes?", r"fraud\w*", r"scam", r"senhas?", r"password", r"bomba", r"bomb",
+)) + r")\b")
+
+
+def classify_locally(user_input: str) -> Optional[bool]:
+    """
+    Cheap verdict for inputs that do not need the LLM guard rail.
+
+    Returns False for small talk, bare values (a property id, a price, a date) and short
+    messages with real estate words and no off-topic ones; True for short messages with
+    only off-topic words; None, meaning "ask the LLM", for everything else: long messages,
+    messages mixing real estate and off-topic words (e.g. an essay about a house) and any
+    message touching the guard rail itself or harmful topics.
+    """
+    text = normalize_text(user_input).strip(" .!?")
+    if not text:
+        return False
+    if ESCALATE_PATTERN.search(text):
+        return None
+    if text in SMALL_TALK or BARE_VALUE_PATTERN.match(text):
+        return False
+    if len(text.split()) > MAX_LOCAL_WORDS:
+        return None
+
+    on_topic = ON_TOPIC_PATTERN.search(text) is not None
+    off_topic = OFF_TOPIC_PATTERN.search(text) is not None
+    if off_topic:
+        # A real estate word does not make an off-topic request acceptable
+        return None if on_topic else True
+    return False if on_topic else None
+
+
+class GuardRailViolation(Exception):
+    """
+    Raised by a tool with side effects when the guard rail flagged the input it runs for.
+    """
+
+
+def verdict_passed(guard_rail_verdict: Optional[asyncio.Future]) -> bool:
+    """
+    Whether a (possibly pending) guard rail verdict already cleared the input, e.g. to
+    decide if a partial response may be shown.
+    """
+    if guard_rail_verdict is None:
+        return True
+    if not guard_rail_verdict.done() or guard_rail_verdict.cancelled() or guard_rail_verdict.exception() is not None:
+        return False
+    return not guard_rail_verdict.result().rules_are_being_broken
+
+
+async def run_guarded(
+    guard_rail: Any,
+    inputs: dict[str, Any],
+    run_agent: Callable[[Optional[asyncio.Task]], Awaitable[T]],
+    speculative: bool = False,
+) -> Optional[T]:
+    """
+    Runs an agent turn behind the guard rail and returns its result, or None if the input
+    broke the rules.
+
+    By default the guard rail is awaited before the agent starts. With `speculative` both
+    start at once, so a turn costs the slower of the two instead of their sum; the agent
+    gets the guard rail task, which tools with side effects await before writing (see
+    `UserInput.allow_side_effects`), and is cancelled if the verdict is a violation.
+    """
+    if not speculative:
+        verdict = await guard_rail.ainvoke(inputs)
+        if verdict.rules_are_being_broken:
+            return None
+        return await run_agent(None)
+
+    guard_rail_task = asyncio.ensure_future(guard_rail.ainvoke(inputs))
+    agent_task = asyncio.ensure_future(run_agent(guard_rail_task))
+    try:
+        verdict = await asyncio.shield(guard_rail_task)
+    except BaseException:
+        agent_task.cancel()
+        guard_rail_task.cancel()
+        raise
+
+    if verdict.rules_are_being_broken:
+        agent_task.cancel()
+        await asyncio.wait([agent_task])
+        if not agent_task.cancelled():
+            agent_task.exception()
+        return None
+    return await agent_task
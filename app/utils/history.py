@@ -0,0 +1,177 @@
+import dataclasses
+import re
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+
+
+DEFAULT_KEEP_TURNS = 4              # Most recent turns kept verbatim
+DEFAULT_MAX_TURNS  = 20             # Turns kept at all; older ones are summarised
+DEFAULT_GUARD_RAIL_TURNS = 3        # Turns shown to the guard rail
+MAX_VERBATIM_CHARS = 200            # Tool outputs up to this size are never compacted
+MAX_SUMMARY_CHARS  = 120            # Per user message in the summary of dropped turns
+MAX_SUMMARY_ITEMS  = 10             # User messages in the summary
+MAX_SUMMARY_IDS    = 50             # Property ids in the summary
+MAX_GUARD_RAIL_CHARS = 300          # Per message in the guard rail window
+
+# First cell of a markdown table row, i.e. the property id in `PROPERTY_COLUMNS` tables
+ROW_ID_PATTERN = re.compile(r"^\| ([^|]+?) \|", re.MULTILINE)
+
+COMPACTED_PREFIX = "[Earlier "
+SUMMARY_HEADER = "Summary of the earlier conversation."
+SUMMARY_IDS    = "Property ids shown to the user: "
+
+
+def split_turns(messages: list[ModelMessage]) -> list[list[ModelMessage]]:
+    """
+    Splits a message history into turns, each starting at a request with a user prompt.
+    """
+    turns: list[list[ModelMessage]] = []
+    for message in messages:
+        starts_turn = isinstance(message, ModelRequest) and any(isinstance(part, UserPromptPart) for part in message.parts)
+        if starts_turn or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def referenced_ids(text: str) -> list[str]:
+    """
+    Property ids listed in the tables of a tool output, in order of appearance.
+    """
+    ids = [cell for cell in ROW_ID_PATTERN.findall(text) if cell != "ID" and not cell.startswith("---")]
+    return list(dict.fromkeys(ids))
+
+
+def compact_text(tool_name: str, text: str) -> str:
+    if len(text) <= MAX_VERBATIM_CHARS or text.startswith(COMPACTED_PREFIX):
+        return text
+    ids = referenced_ids(text)
+    if ids:
+        return f"{COMPACTED_PREFIX}`{tool_name}` output omitted. Property ids: {', '.join(ids)}]"
+    return f"{COMPACTED_PREFIX}`{tool_name}` output omitted]"
+
+
+def compact_message(message: ModelMessage) -> ModelMessage:
+    """
+    Replaces long tool outputs, and long string arguments such as the tables in the final
+    result, with references to the property ids they listed.
+    """
+    parts = []
+    for part in message.parts:
+        if isinstance(part, ToolReturnPart) and isinstance(part.content, str):
+            part = dataclasses.replace(part, content=compact_text(part.tool_name, part.content))
+        elif isinstance(part, ToolCallPart):
+            args = part.args_as_dict()
+            compacted = {name: compact_text(part.tool_name, value) if isinstance(value, str) else value for name, value in args.items()}
+            if compacted != args:
+                part = dataclasses.replace(part, args=compacted)
+        parts.append(part)
+    return dataclasses.replace(message, parts=parts)
+
+
+def is_summary(part: object) -> bool:
+    return isinstance(part, SystemPromptPart) and part.content.startswith(SUMMARY_HEADER)
+
+
+def summarize_turns(turns: list[list[ModelMessage]]) -> str:
+    """
+    Extractive summary of dropped turns: what the user asked and which properties came up.
+
+    A summary left by an earlier compaction is folded in, keeping only the latest
+    `MAX_SUMMARY_ITEMS` messages and `MAX_SUMMARY_IDS` ids, so it never grows unbounded.
+    """
+    asked = []
+    ids: dict[str, None] = {}
+    for message in (message for turn in turns for message in turn):
+        for part in message.parts:
+            if is_summary(part):
+                for line in part.content.splitlines():
+                    if line.startswith("- "):
+                        asked.append(line[2:])
+                    elif line.startswith(SUMMARY_IDS):
+                        ids.update(dict.fromkeys(line[len(SUMMARY_IDS):].split(", ")))
+            elif isinstance(part, UserPromptPart) and isinstance(part.content, str):
+                asked.append(" ".join(part.content.split())[:MAX_SUMMARY_CHARS])
+            elif isinstance(part, ToolReturnPart) and isinstance(part.content, str):
+                ids.update(dict.fromkeys(referenced_ids(part.content)))
+
+    lines = [SUMMARY_HEADER, "The user asked:", *(f"- {text}" for text in asked[-MAX_SUMMARY_ITEMS:])]
+    if ids:
+        lines.append(SUMMARY_IDS + ", ".join(list(ids)[-MAX_SUMMARY_IDS:]))
+    return "\n".join(lines)
+
+
+def compact_history(
+    messages: list[ModelMessage],
+    keep_turns: int = DEFAULT_KEEP_TURNS,
+    max_turns: int = DEFAULT_MAX_TURNS,
+) -> list[ModelMessage]:
+    """
+    Bounds a message history, so the prompt of every turn stays about the same size.
+
+    The last `keep_turns` turns are kept verbatim. Older ones keep their messages, but long
+    tool outputs are reduced to the property ids they listed (see `compact_message`), and
+    turns beyond `max_turns` are replaced by a short summary. The system prompt of the
+    first request is carried over, since the agent only adds it to an empty history.
+    Returns new messages; `messages` is left untouched.
+    """
+    turns = split_turns(messages)
+    if len(turns) <= keep_turns:
+        return list(messages)
+
+    system_parts = [
+        part for part in messages[0].parts if isinstance(part, SystemPromptPart) and not is_summary(part)
+    ] if isinstance(messages[0], ModelRequest) else []
+    dropped, kept = turns[:-max_turns], turns[-max_turns:]
+    recent = kept[-keep_turns:] if keep_turns else []
+    older = kept[:len(kept) - len(recent)]
+
+    compacted = [compact_message(message) for turn in older for message in turn]
+    compacted += [message for turn in recent for message in turn]
+
+    first = compacted[0]
+    if dropped:
+        system_parts.append(SystemPromptPart(content=summarize_turns(dropped)))
+    else:
+        system_parts += [part for part in messages[0].parts if is_summary(part)]
+    if isinstance(first, ModelRequest):
+        first_parts = [part for part in first.parts if not isinstance(part, SystemPromptPart)]
+        compacted[0] = dataclasses.replace(first, parts=[*system_parts, *first_parts])
+    return compacted
+
+
+def message_text(message: ModelMessage) -> list[tuple[str, str]]:
+    """
+    The (speaker, text) pairs of a message a human would have seen.
+    """
+    texts = []
+    for part in message.parts:
+        if isinstance(part, UserPromptPart) and isinstance(part.content, str):
+            texts.append(("User", part.content))
+        elif isinstance(part, TextPart):
+            texts.append(("Agent", part.content))
+        elif isinstance(part, ToolCallPart) and isinstance(response := part.args_as_dict().get("response"), str):
+            texts.append(("Agent", response))
+    return texts
+
+
+def guard_rail_window(messages: list[ModelMessage], turns: int = DEFAULT_GUARD_RAIL_TURNS) -> str:
+    """
+    The last `turns` turns as plain "User:"/"Agent:" lines, without tool traffic, for the
+    guard rail prompt's `{history}`.
+    """
+    lines = []
+    for turn in split_turns(messages)[-turns:] if turns else []:
+        for message in turn:
+            for speaker, text in message_text(message):
+                lines.append(f"{speaker}: {text[:MAX_GUARD_RAIL_CHARS]}")
+    return "\n".join(lines)
+
@@ -0,0 +1,199 @@
+import os
+import time
+from dataclasses import dataclass
+import duckdb
+from app.utils.database import sql_literal
+from app.utils.market_stats import refresh_market_stats
+from app.utils.text_search import build_search_index, ensure_search_columns, NORMALIZED_COLUMNS_SQL
+
+
+DEFAULT_BATCH_SIZE = 500_000
+
+PROPERTY_COLUMNS = (
+    "property_id", "preco", "tamanho", "n_quartos", "n_banheiros", "n_garagem",
+    "rua", "bairro", "cidade", "latitude", "longitude",
+)
+NUMBER_COLUMNS = ("preco", "tamanho")
+COORDINATE_COLUMNS = {"latitude": 90, "longitude": 180}     # Largest valid absolute value
+COUNT_COLUMNS  = ("n_quartos", "n_banheiros", "n_garagem")
+TEXT_COLUMNS   = ("rua", "bairro", "cidade")
+
+NUMERIC_TYPES  = {"TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT", "FLOAT", "DOUBLE"}
+
+# Feed column names accepted for a `properties` column
+COLUMN_ALIASES = {"id": "property_id", "lat": "latitude", "lon": "longitude", "lng": "longitude"}
+
+READERS = {
+    ".csv": "read_csv({path}, header = true, all_varchar = true)",
+    ".tsv": "read_csv({path}, header = true, all_varchar = true, delim = '\t')",
+    ".parquet": "read_parquet({path})",
+    ".json": "read_json({path}, format = 'newline_delimited')",
+    ".jsonl": "read_json({path}, format = 'newline_delimited')",
+    ".ndjson": "read_json({path}, format = 'newline_delimited')",
+}
+
+
+@dataclass
+class IngestionReport:
+    rows_read: int
+    rejected: int
+    duplicates: int
+    inserted: int
+    updated: int
+    unchanged: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_read / self.seconds if self.seconds else 0.0
+
+
+def reader_sql(path: str) -> str:
+    """
+    DuckDB table function streaming the feed at `path`, which may be a glob, chosen by its
+    extension (a trailing `.gz`/`.zst` is ignored).
+
+    Raises:
+        ValueError: If the format is not supported.
+    """
+    stem = path.lower()
+    for compression in (".gz", ".zst"):
+        stem = stem.removesuffix(compression)
+    reader = READERS.get(os.path.splitext(stem)[1])
+    if reader is None:
+        raise ValueError(f"Unsupported feed format: {path}")
+    return reader.format(path=sql_literal(path))
+
+
+def number_sql(column: str, numeric: bool = False) -> str:
+    """
+    Parses a number that may come as text, e.g. "R$ 1.234.567,89", "-25,43" or "1200.5".
+    A comma is the decimal separator, dots then being thousands separators, as is a single
+    dot without a comma. `numeric` columns are only cast.
+    """
+    if numeric:
+        return f"CAST({column} AS DOUBLE)"
+    text = f"regexp_replace(CAST({column} AS VARCHAR), '[^0-9,.-]', '', 'g')"
+    cleaned = f"""CASE
+        WHEN contains({text}, ',') THEN replace(replace({text}, '.', ''), ',', '.')
+        WHEN length({text}) - length(replace({text}, '.', '')) > 1 THEN replace({text}, '.', '')
+        ELSE {text}
+    END"""
+    return f"coalesce(TRY_CAST({column} AS DOUBLE), TRY_CAST({cleaned} AS DOUBLE))"
+
+
+def cleaned_columns_sql(source_columns: list[tuple[str, str]]) -> str:
+    """
+    Select list mapping the feed's (name, type) columns to validated `properties` columns.
+    Columns the feed lacks are NULL; unusable counts and out of range coordinates too.
+    """
+    available = {}
+    for column, column_type in source_columns:
+        name = COLUMN_ALIASES.get(column.lower(), column.lower())
+        available.setdefault(name, ('"' + column.replace('"', '""') + '"', column_type in NUMERIC_TYPES))
+
+    expressions = []
+    for name in PROPERTY_COLUMNS:
+        source, numeric = available.get(name, ("NULL", True))
+        number = number_sql(source, numeric)
+        if name == "property_id":
+            expression = f"nullif(trim(CAST({source} AS VARCHAR)), '')"
+        elif name in NUMBER_COLUMNS:
+            expression = number
+        elif name in COORDINATE_COLUMNS:
+            expression = f"CASE WHEN abs({number}) <= {COORDINATE_COLUMNS[name]} THEN {number} END"
+        elif name in COUNT_COLUMNS:
+            expression = f"CASE WHEN {number} >= 0 THEN round({number})::INTEGER END"
+        else:
+            expression = f"nullif(trim(regexp_replace(CAST({source} AS VARCHAR), '\\s+', ' ', 'g')), '')"
+        expressions.append(f"{expression} AS {name}")
+    return ",\n        ".join(expressions)
+
+
+def ensure_ingestion_columns(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Adds the columns ingestion writes besides the listing itself to an older `properties`.
+    """
+    ensure_search_columns(con)
+    con.execute("ALTER TABLE properties ADD COLUMN IF NOT EXISTS ingested_at TIMESTAMP WITH TIME ZONE")
+    con.execute("ALTER TABLE properties ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE")
+
+
+def ingest_properties(con: duckdb.DuckDBPyConnection, source: str, batch_size: int = DEFAULT_BATCH_SIZE) -> IngestionReport:
+    """
+    Upserts the listings of `source`, any DuckDB FROM clause (see `reader_sql`), into
+    `properties` by `property_id`.
+
+    The feed is streamed by DuckDB into a staging table, never through Python, and
+    validated on the way: rows without an id or a positive price and size are rejected,
+    coordinates out of range become NULL and the `*_norm` search columns are computed.
+    Of several rows with the same id, one is kept. Rows are then upserted `batch_size` at
+    a time, sorted like the rest of `properties`, so each statement stays bounded. New
+    properties get `ingested_at`; updated ones keep it. Both get `updated_at`, which the
+    in-memory indexes follow; listings identical to the stored ones are not written at
+    all, so they keep it too. The search index then gets the terms of the changed
+    listings, and the market statistics of their cities are recomputed.
+
+    Raises:
+        duckdb.Error: If `source` cannot be read, or `properties` has no primary key.
+    """
+    started = time.perf_counter()
+    ensure_ingestion_columns(con)
+    source_columns = [(row[0], row[1]) for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE ingest_staging AS
+    SELECT *, coalesce(property_id IS NOT NULL AND preco > 0 AND tamanho > 0, false) AS valid
+    FROM (
+        SELECT {cleaned_columns_sql(source_columns)}
+        FROM {source}
+    )
+    """)
+    rows_read, rejected = con.execute("SELECT count(*), count(*) FILTER (WHERE NOT valid) FROM ingest_staging").fetchone()
+
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE ingest_rows AS
+    SELECT *, row_number() OVER (ORDER BY cidade_norm, bairro_norm, rua_norm, property_id) AS batch_row
+    FROM (
+        SELECT DISTINCT ON (property_id) * EXCLUDE (valid), {NORMALIZED_COLUMNS_SQL}
+        FROM ingest_staging
+        WHERE valid
+    )
+    """)
+    con.execute("DROP TABLE ingest_staging")
+
+    columns = [*PROPERTY_COLUMNS, *(f"{field}_norm" for field in TEXT_COLUMNS)]
+    values = [column for column in columns if column != "property_id"]
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in values)
+
+    def changed(stored: str, incoming: str) -> str:
+        stored_row = ", ".join(f"{stored}.{column}" for column in values)
+        incoming_row = ", ".join(f"{incoming}.{column}" for column in values)
+        return f"({stored_row}) IS DISTINCT FROM ({incoming_row})"
+
+    unique, existing, updated = con.execute(f"""
+    SELECT count(*), count(p.property_id), count(p.property_id) FILTER (WHERE {changed("p", "r")})
+    FROM ingest_rows r LEFT JOIN properties p USING (property_id)
+    """).fetchone()
+    for first in range(0, unique, batch_size):
+        con.execute(f"""
+        INSERT INTO properties ({", ".join(columns)}, ingested_at, updated_at)
+        SELECT {", ".join(columns)}, now(), now() FROM ingest_rows
+        WHERE batch_row > ? AND batch_row <= ?
+        ORDER BY batch_row
+        ON CONFLICT (property_id) DO UPDATE SET {updates}, updated_at = EXCLUDED.updated_at
+        WHERE {changed("properties", "EXCLUDED")}
+        """, [first, first + batch_size])
+    con.execute("DROP TABLE ingest_rows")
+
+    build_search_index(con)
+    refresh_market_stats(con)
+    return IngestionReport(
+        rows_read=rows_read,
+        rejected=rejected,
+        duplicates=rows_read - rejected - unique,
+        inserted=unique - existing,
+        updated=updated,
+        unchanged=existing - updated,
+        seconds=time.perf_counter() - started,
+    )
@@ -0,0 +1,122 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Optional
+import numpy as np
+from app.utils.database import Database
+from app.utils.geo import haversine_km
+from app.utils.slots import slot_window
+
+
+TRAVEL_KMH     = 20.0       # Average speed between visits, in city traffic
+MAX_PROPERTIES = 10
+
+
+@dataclass
+class Stop:
+    property_id: str
+    slot_start: datetime
+    slot_end: datetime
+    rua: Optional[str]
+    bairro: Optional[str]
+    distancia_km: Optional[float]   # From the previous stop
+
+
+@dataclass
+class Itinerary:
+    stops: list[Stop] = field(default_factory=list)
+    unscheduled: list[str] = field(default_factory=list)    # No free slot fits the route
+    unknown: list[str] = field(default_factory=list)        # Not in `properties`
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """
+        The stops as `render_rows` columns.
+        """
+        return {
+            "ordem": np.arange(1, len(self.stops) + 1),
+            "property_id": np.array([stop.property_id for stop in self.stops], dtype=object),
+            "inicio": np.array([stop.slot_start.strftime("%Y-%m-%d %H:%M:%S") for stop in self.stops], dtype=object),
+            "fim": np.array([stop.slot_end.strftime("%Y-%m-%d %H:%M:%S") for stop in self.stops], dtype=object),
+            "rua": np.ma.masked_equal(np.array([stop.rua or "" for stop in self.stops], dtype=object), ""),
+            "bairro": np.ma.masked_equal(np.array([stop.bairro or "" for stop in self.stops], dtype=object), ""),
+            "distancia_km": np.ma.masked_invalid(np.array([np.nan if stop.distancia_km is None else stop.distancia_km for stop in self.stops])),
+        }
+
+
+def route_order(latitudes: np.ndarray, longitudes: np.ndarray) -> list[int]:
+    """
+    Visiting order of a few places, starting with the first: always the nearest place not
+    visited yet. Places without coordinates (NaN) come last, in their order.
+    """
+    located = [i for i in range(len(latitudes)) if not (np.isnan(latitudes[i]) or np.isnan(longitudes[i]))]
+    if not located or located[0] != 0:
+        return list(range(len(latitudes)))
+    order, remaining = [0], located[1:]
+    while remaining:
+        last = order[-1]
+        distances = haversine_km(latitudes[last], longitudes[last], latitudes[remaining], longitudes[remaining])
+        order.append(remaining.pop(int(np.argmin(distances))))
+    return order + [i for i in range(len(latitudes)) if i not in located]
+
+
+async def plan_itinerary(
+    database: Database,
+    property_ids: list[str],
+    day: str,
+    time_from: Optional[str] = None,
+    time_to: Optional[str] = None,
+    travel_kmh: float = TRAVEL_KMH,
+) -> Itinerary:
+    """
+    Plans visits to several properties on one day: the properties are ordered into a short
+    route (see `route_order`), starting with the first one given, and each gets its
+    earliest free slot that starts after the previous visit ends plus the travel time at
+    `travel_kmh`. Properties that no longer fit are left out, in `unscheduled`.
+
+    Both the properties and their slots of the day are read with one query each.
+
+    Raises:
+        ValueError: If `day`, `time_from` or `time_to` is not in the expected format.
+    """
+    property_ids = list(dict.fromkeys(property_ids))
+    predicates, params = slot_window(date_from=day, date_to=day, time_from=time_from, time_to=time_to)
+
+    places = await database.fetchall(
+        "SELECT property_id, latitude, longitude, rua, bairro FROM properties WHERE property_id IN (SELECT unnest(?))",
+        [property_ids],
+    )
+    slot_rows = await database.fetchall(
+        f"""SELECT property_id, slot_start, slot_end
+        FROM property_slots
+        WHERE property_id IN (SELECT unnest(?)) AND {" AND ".join(predicates)}
+        ORDER BY property_id, slot_start""",
+        [property_ids, *params],
+    )
+
+    found = {row[0]: row for row in places}
+    itinerary = Itinerary(unknown=[property_id for property_id in property_ids if property_id not in found])
+    known = [property_id for property_id in property_ids if property_id in found]
+    slots: dict[str, list[tuple[Any, Any]]] = {}
+    for property_id, slot_start, slot_end in slot_rows:
+        slots.setdefault(property_id, []).append((slot_start, slot_end))
+
+    latitudes = np.array([np.nan if found[property_id][1] is None else found[property_id][1] for property_id in known], dtype=np.float64)
+    longitudes = np.array([np.nan if found[property_id][2] is None else found[property_id][2] for property_id in known], dtype=np.float64)
+
+    previous: Optional[int] = None
+    free_from = None
+    for i in route_order(latitudes, longitudes):
+        property_id = known[i]
+        distance = None
+        if previous is not None and not np.isnan([latitudes[previous], longitudes[previous], latitudes[i], longitudes[i]]).any():
+            distance = float(haversine_km(latitudes[previous], longitudes[previous], latitudes[i:i + 1], longitudes[i:i + 1])[0])
+        earliest = free_from
+        if earliest is not None and distance is not None:
+            earliest += timedelta(hours=distance / travel_kmh)
+
+        slot = next((slot for slot in slots.get(property_id, []) if earliest is None or slot[0] >= earliest), None)
+        if slot is None:
+            itinerary.unscheduled.append(property_id)
+            continue
+        itinerary.stops.append(Stop(property_id, slot[0], slot[1], found[property_id][3], found[property_id][4], distance))
+        previous, free_from = i, slot[1]
+    return itinerary
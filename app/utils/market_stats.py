@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+from typing import Any, Optional
+import duckdb
+from app.utils.database import Database
+
+
+STATS_SQL = """
+    count(*) AS n_imoveis,
+    quantile_cont(preco, 0.25) AS preco_p25,
+    quantile_cont(preco, 0.5) AS preco_mediana,
+    quantile_cont(preco, 0.75) AS preco_p75,
+    quantile_cont(preco / tamanho, 0.25) AS preco_m2_p25,
+    quantile_cont(preco / tamanho, 0.5) AS preco_m2_mediana,
+    quantile_cont(preco / tamanho, 0.75) AS preco_m2_p75,
+    quantile_cont(tamanho, 0.5) AS tamanho_mediana
+"""
+
+# Statistics of the listings of some cities, per city, neighbourhood and bedroom count.
+# `level` is `GROUPING(bairro_norm, n_quartos)`: bit 2 is set when the row covers every
+# neighbourhood of the city and bit 1 every bedroom count, those columns then being NULL
+GROUPS_SQL = f"""
+SELECT
+    cidade_norm, bairro_norm, n_quartos,
+    GROUPING(bairro_norm, n_quartos) AS level,
+    any_value(cidade) AS cidade, CASE WHEN GROUPING(bairro_norm) = 0 THEN any_value(bairro) END AS bairro,
+    {STATS_SQL},
+    now() AS refreshed_at
+FROM properties
+WHERE cidade_norm IS NOT NULL AND preco > 0 AND tamanho > 0 AND {{cities}}
+GROUP BY GROUPING SETS ((cidade_norm, bairro_norm, n_quartos), (cidade_norm, bairro_norm), (cidade_norm, n_quartos), (cidade_norm))
+"""
+
+
+@dataclass
+class MarketStatsRefresh:
+    cities: Optional[int]       # Cities recomputed, None for a full rebuild
+    groups: int                 # Rows written to `market_stats`
+
+
+def create_market_stats_tables(con: duckdb.DuckDBPyConnection) -> None:
+    con.execute(f"""
+    CREATE TABLE IF NOT EXISTS market_stats AS
+    {GROUPS_SQL.format(cities="false")}
+    """)
+    con.execute("CREATE TABLE IF NOT EXISTS market_stats_state (watermark TIMESTAMP WITH TIME ZONE)")
+
+
+def refresh_market_stats(con: duckdb.DuckDBPyConnection, full: bool = False) -> MarketStatsRefresh:
+    """
+    Brings `market_stats` up to date with `properties`.
+
+    Quantiles cannot be updated from the rows that changed alone, so every group of a city
+    with a listing changed since the last refresh (by `updated_at`) is recomputed from
+    that city's listings, and other cities are kept. Without `updated_at`, on first use or
+    with `full`, everything is recomputed, which also drops removed listings and the old
+    city of a listing that moved.
+    """
+    create_market_stats_tables(con)
+    has_updated_at = con.execute(
+        "SELECT count(*) FROM duckdb_columns() WHERE table_name = 'properties' AND column_name = 'updated_at'"
+    ).fetchone()[0] > 0
+    state = con.execute("SELECT watermark FROM market_stats_state").fetchone()
+    watermark = con.execute("SELECT max(updated_at) FROM properties").fetchone()[0] if has_updated_at else None
+    full = full or state is None or state[0] is None or watermark is None
+
+    con.execute("BEGIN TRANSACTION")
+    try:
+        if full:
+            cities = None
+            con.execute("DELETE FROM market_stats")
+            groups = con.execute(f"INSERT INTO market_stats {GROUPS_SQL.format(cities='true')}").fetchone()[0]
+        else:
+            con.execute("""
+            CREATE OR REPLACE TEMP TABLE market_stats_cities AS
+            SELECT DISTINCT cidade_norm FROM properties WHERE updated_at > ?
+            """, [state[0]])
+            cities = con.execute("SELECT count(*) FROM market_stats_cities").fetchone()[0]
+            con.execute("DELETE FROM market_stats WHERE cidade_norm IN (SELECT cidade_norm FROM market_stats_cities)")
+            groups = con.execute(f"""
+            INSERT INTO market_stats
+            {GROUPS_SQL.format(cities="cidade_norm IN (SELECT cidade_norm FROM market_stats_cities)")}
+            """).fetchone()[0]
+            con.execute("DROP TABLE market_stats_cities")
+        con.execute("DELETE FROM market_stats_state")
+        con.execute("INSERT INTO market_stats_state VALUES (?)", [watermark])
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return MarketStatsRefresh(cities=cities, groups=groups)
+
+
+async def fetch_market_stats(
+    database: Database,
+    cidades: Optional[list[str]] = None,
+    bairros: Optional[list[str]] = None,
+    n_quartos: Optional[int] = None,
+) -> dict[str, Any]:
+    """
+    Rows of `market_stats` for the given normalised cities and neighbourhoods (any of each
+    list) and bedroom count, at the level those arguments select, largest groups first.
+    The lookup reads the summary table only, so it does not grow with `properties`.
+    """
+    level = 2 * (bairros is None) + (n_quartos is None)
+    predicates, params = ["level = ?"], [level]
+    for column, values in (("cidade_norm", cidades), ("bairro_norm", bairros)):
+        if values is not None:
+            predicates.append(f"{column} IN (SELECT unnest(?))")
+            params.append(values)
+    if n_quartos is not None:
+        predicates.append("n_quartos = ?")
+        params.append(n_quartos)
+    return await database.fetchnumpy(
+        f"SELECT * FROM market_stats WHERE {' AND '.join(predicates)} ORDER BY n_imoveis DESC, cidade_norm, bairro_norm",
+        params,
+    )
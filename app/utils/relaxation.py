@@ -0,0 +1,98 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Optional
+from app.utils.database import Database
+from app.utils.search_query import SearchQuery
+
+
+BAND_FILTERS  = (("preco_min", "preco_max"), ("tamanho_min", "tamanho_max"))
+COUNT_FILTERS = ("n_quartos", "n_banheiros", "n_garagem")
+
+
+@dataclass(frozen=True)
+class RelaxationStep:
+    band: float                      # Fraction by which price/size bands are widened
+    min_counts: bool                 # Whether room/garage counts become minimums
+    drop: tuple[str, ...] = ()       # Text filters that are ignored
+
+
+RELAXATION_STEPS = (
+    RelaxationStep(band=0.0, min_counts=False),
+    RelaxationStep(band=0.10, min_counts=True),
+    RelaxationStep(band=0.25, min_counts=True, drop=("rua",)),
+    RelaxationStep(band=0.50, min_counts=True, drop=("rua", "bairro")),
+)
+
+
+@dataclass
+class RelaxedSearch:
+    columns: dict[str, Any]
+    relaxed: list[str]
+
+
+def format_number(value: float) -> str:
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def relax_filters(filters: dict[str, Any], step: RelaxationStep) -> tuple[Optional[dict[str, Any]], list[str]]:
+    """
+    Applies `step` to the `search_properties` filters.
+
+    Returns the relaxed filters, or None if the step cannot match anything (a text filter
+    without known terms that the step keeps), and a note for every constraint it changed.
+    """
+    relaxed = dict(filters)
+    notes = []
+
+    for low, high in BAND_FILTERS:
+        if step.band and relaxed.get(low) is not None:
+            relaxed[low] = round(relaxed[low] * (1 - step.band), 2)
+            notes.append(f"{low} {format_number(filters[low])} -> {format_number(relaxed[low])}")
+        if step.band and relaxed.get(high) is not None:
+            relaxed[high] = round(relaxed[high] * (1 + step.band), 2)
+            notes.append(f"{high} {format_number(filters[high])} -> {format_number(relaxed[high])}")
+
+    for name in COUNT_FILTERS:
+        if step.min_counts and relaxed.get(name) is not None:
+            relaxed[f"{name}_min"] = relaxed.pop(name)
+            notes.append(f"{name} = {filters[name]} -> {name} >= {filters[name]}")
+
+    for name in step.drop:
+        if relaxed.get(name) is not None:
+            relaxed.pop(name)
+            notes.append(f"{name} ignored")
+
+    if any(relaxed.get(name) == [] for name in ("rua", "bairro", "cidade")):
+        return None, notes
+    return relaxed, notes
+
+
+async def search_with_relaxation(
+    database: Database,
+    filters: dict[str, Any],
+    limit: Optional[int] = None,
+    sort_by: str = "relevance",
+) -> Optional[RelaxedSearch]:
+    """
+    Runs the search, relaxing the filters step by step until something matches.
+
+    The exact search runs first. Only if it comes back empty are the relaxed variants run,
+    all at once on the pool, and the least relaxed non-empty result wins. So a zero-result
+    search costs one extra batch of queries instead of an extra model round-trip.
+    """
+    async def run(step: RelaxationStep) -> Optional[RelaxedSearch]:
+        relaxed, notes = relax_filters(filters, step)
+        if relaxed is None:
+            return None
+        query = SearchQuery(limit=limit, sort_by=sort_by, **relaxed)
+        columns = await database.fetchnumpy_prepared(query.name, query.sql, query.values)
+        return RelaxedSearch(columns=columns, relaxed=notes) if len(columns["property_id"]) else None
+
+    exact = await run(RELAXATION_STEPS[0])
+    if exact is not None:
+        return exact
+
+    for search in await asyncio.gather(*(run(step) for step in RELAXATION_STEPS[1:])):
+        if search is not None:
+            return search
+    return None
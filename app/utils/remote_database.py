@@ -0,0 +1,76 @@
+import threading
+from multiprocessing.managers import BaseManager
+from typing import Any, Callable, Optional
+import duckdb
+from app.utils.database import Database
+
+
+class DatabaseService:
+    """
+    Runs the `Database.run` calls of other processes on the connection of the process that
+    owns the database file. The manager serves every client connection in a thread of its
+    own, so each gets its own cursor and they run in parallel, like the pool of `Database`.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+
+    def run(self, func: Callable[..., Any], args: tuple, kwargs: dict[str, Any]) -> Any:
+        return func(self.database.cursor(), *args, **kwargs)
+
+
+_service: Optional[DatabaseService] = None
+_service_lock = threading.Lock()
+
+
+def _open_service(path: str, max_workers: Optional[int]) -> None:
+    global _service
+    with _service_lock:
+        _service = DatabaseService(Database(duckdb.connect(path), max_workers=max_workers))
+
+
+def _get_service() -> DatabaseService:
+    return _service
+
+
+class DatabaseManager(BaseManager):
+    pass
+
+
+DatabaseManager.register("database", callable=_get_service, exposed=("run",))
+
+
+def start_database_server(path: str, max_workers: Optional[int] = None) -> DatabaseManager:
+    """
+    Opens the DuckDB file `path` read-write in a server process of its own, for several
+    processes to share: DuckDB lets a single process open a file for writing, so the others
+    send their queries there through a `RemoteDatabase`. Stop it with `shutdown()`.
+
+    The server ignores SIGINT, so it outlives its clients when they are interrupted.
+    """
+    manager = DatabaseManager(address=("127.0.0.1", 0))
+    manager.start(_open_service, (path, max_workers))
+    return manager
+
+
+class RemoteDatabase(Database):
+    """
+    `Database` of a process that does not own the database file: every `run` call is sent
+    to the server started by `start_database_server`, and runs there. The functions given
+    to `run` and their results are pickled, so they must be module-level functions or
+    static methods, as in the helpers of `Database`.
+
+    `connection` is None; the pool only waits on the server, one connection per thread.
+    """
+
+    def __init__(self, address: tuple[str, int], authkey: bytes, max_workers: Optional[int] = None):
+        super().__init__(None, max_workers=max_workers)
+        manager = DatabaseManager(address=address, authkey=authkey)
+        manager.connect()
+        self._service = manager.database()
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        raise TypeError("A RemoteDatabase has no local cursor; use run()")
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await self._submit(lambda: self._service.run(func, args, kwargs))
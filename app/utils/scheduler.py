@@ -0,0 +1,116 @@
+import asyncio
+import statistics
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+DEFAULT_MAX_CONCURRENT_CHATS = 16
+DEFAULT_MAX_PENDING          = 1000
+DEFAULT_MAX_PENDING_PER_CHAT = 3
+WAIT_SAMPLES                 = 1000     # Recent wait times kept for the percentiles
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats in parallel and those of one chat in order.
+
+    At most `max_concurrent_chats` updates run at once, and a chat only takes a slot once
+    its previous update is done, so a chat sending messages in a burst never holds more
+    than one slot nor races on its own session. Updates waiting for a slot are the queue:
+    once it holds `max_pending` updates, or `max_pending_per_chat` for one chat, new
+    updates are rejected through `on_reject` instead of piling up.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_chats: int = DEFAULT_MAX_CONCURRENT_CHATS,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        max_pending_per_chat: int = DEFAULT_MAX_PENDING_PER_CHAT,
+        on_reject: Optional[Callable[[object], Awaitable[Any]]] = None,
+    ):
+        # Rejection happens before the base class semaphore could ever block
+        super().__init__(max_concurrent_updates=max_concurrent_chats + max_pending)
+        self.max_concurrent_chats = max_concurrent_chats
+        self.max_pending = max_pending
+        self.max_pending_per_chat = max_pending_per_chat
+        self.on_reject = on_reject
+        self._slots = asyncio.Semaphore(max_concurrent_chats)
+        self._chat_locks: dict[Hashable, asyncio.Lock] = {}
+        self._chat_pending: dict[Hashable, int] = {}
+        self.pending = 0
+        self.running = 0
+        self.max_pending_seen = 0
+        self.processed = 0
+        self.rejected = 0
+        self.waits: deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    @staticmethod
+    def chat_key(update: object) -> Optional[Hashable]:
+        if isinstance(update, Update) and update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = self.chat_key(update)
+        chat_full = chat is not None and self._chat_pending.get(chat, 0) >= self.max_pending_per_chat
+        if self.pending >= self.max_pending or chat_full:
+            self.rejected += 1
+            coroutine.close()
+            if self.on_reject is not None:
+                await self.on_reject(update)
+            return
+
+        queued = time.monotonic()
+        self.pending += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        self._chat_pending[chat] = self._chat_pending.get(chat, 0) + 1
+        lock = self._chat_locks.setdefault(chat, asyncio.Lock()) if chat is not None else None
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._slots:
+                    self.pending -= 1
+                    self._chat_pending[chat] -= 1
+                    self.waits.append(time.monotonic() - queued)
+                    queued = None
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                    self.processed += 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if queued is not None:
+                # Cancelled while waiting
+                self.pending -= 1
+                self._chat_pending[chat] -= 1
+            if not self._chat_pending.get(chat):
+                self._chat_pending.pop(chat, None)
+                if lock is not None and not lock.locked():
+                    self._chat_locks.pop(chat, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        waits = sorted(self.waits)
+        return {
+            "running": self.running,
+            "queue_depth": self.pending,
+            "max_queue_depth": self.max_pending_seen,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "wait_p50": statistics.median(waits) if waits else 0.0,
+            "wait_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "wait_max": waits[-1] if waits else 0.0,
+        }
@@ -0,0 +1,128 @@
+from typing import Any, Optional
+
+
+SEARCH_COLUMNS = "property_id, preco, tamanho, cidade, bairro, rua, n_quartos, n_banheiros, n_garagem"
+
+# (argument, SQL predicate) in a fixed order: the position of each filter is its bit in the mask
+SEARCH_FILTERS = (
+    ("preco_min", "preco >= {}"),
+    ("preco_max", "preco <= {}"),
+    ("tamanho_min", "tamanho >= {}"),
+    ("tamanho_max", "tamanho <= {}"),
+    ("n_quartos", "n_quartos = {}"),
+    ("n_banheiros", "n_banheiros = {}"),
+    ("n_garagem", "n_garagem = {}"),
+    ("rua", "list_contains({}, rua_norm)"),
+    ("bairro", "list_contains({}, bairro_norm)"),
+    ("cidade", "list_contains({}, cidade_norm)"),
+    ("n_quartos_min", "n_quartos >= {}"),
+    ("n_banheiros_min", "n_banheiros >= {}"),
+    ("n_garagem_min", "n_garagem >= {}"),
+)
+
+# Ranking of the relevance order: each requested target adds a penalty, 0 for an exact
+# match, and rows come lowest total first. Prices and sizes count their log-ratio to the
+# target (0.1 is about 10% off); the target is the middle of the band, or its only bound.
+RANGE_TARGETS = (("preco", "preco_min", "preco_max"), ("tamanho", "tamanho_min", "tamanho_max"))
+# A room off weighs like being about 30% off the price
+COUNT_TARGETS = (("n_quartos", 0.25), ("n_banheiros", 0.25), ("n_garagem", 0.25))
+# Text filters list their terms best match first (see `text_search.matched_terms`); a row
+# matching the last of several terms weighs like being about 40% off the price
+TEXT_TARGETS  = (("rua", 0.35), ("bairro", 0.35), ("cidade", 0.35))
+MISSING_PENALTY = 1.0
+
+SORT_ORDERS = {
+    "relevance": "score, property_id",
+    "price_per_m2": "preco / tamanho, property_id",
+    "size": "tamanho DESC, property_id",
+    "newest": "ingested_at DESC NULLS LAST, property_id",
+}
+# Columns a sort order needs that only ingestion adds to `properties`
+SORT_COLUMNS = {"newest": "ingested_at"}
+
+
+class SearchQuery:
+    """
+    `search_properties` statement, with placeholders for the filter values.
+
+    Every combination of present filters maps to one bit mask, and every mask to one fixed
+    statement text, so there are at most 2**len(SEARCH_FILTERS) distinct statements. They
+    are prepared once per cursor; the values are then rendered as literals into the
+    `EXECUTE` (see `database.sql_literal`), not bound.
+
+    The `rua`, `bairro` and `cidade` filters take lists of normalised terms, as resolved by
+    `text_search.match_terms`, and compare them against the `*_norm` columns.
+
+    Rows come in `sort_by` order (see `SORT_ORDERS`), by default by how close they are to
+    the requested targets.
+    """
+
+    def __init__(self, limit: Optional[int] = None, sort_by: str = "relevance", **filters: Any):
+        unknown = set(filters) - {name for name, _ in SEARCH_FILTERS}
+        if unknown:
+            raise ValueError(f"Unknown search filters: {sorted(unknown)}")
+        if sort_by not in SORT_ORDERS:
+            raise ValueError(f"Unknown sort order: {sort_by}")
+        self.sort_by = sort_by
+
+        self.mask = 0
+        self.values: list[Any] = []
+        for bit, (name, _) in enumerate(SEARCH_FILTERS):
+            value = filters.get(name)
+            if value is None:
+                continue
+            self.mask |= 1 << bit
+            self.values.append(value)
+        self.values.append(limit)
+
+    @property
+    def name(self) -> str:
+        return f"search_properties_{self.mask}_{self.sort_by}"
+
+    @property
+    def sql(self) -> str:
+        return build_search_sql(self.mask, self.sort_by)
+
+
+def build_score_sql(placeholders: dict[str, str]) -> str:
+    """
+    Relevance penalty of a row, from the placeholders of the filters present.
+    """
+    terms = []
+    for column, low, high in RANGE_TARGETS:
+        bounds = [placeholders[name] for name in (low, high) if name in placeholders]
+        if bounds:
+            target = bounds[0] if len(bounds) == 1 else f"({bounds[0]} + {bounds[1]}) / 2"
+            terms.append(f"abs(ln(greatest({column}, 1) / greatest({target}, 1)))")
+    for column, weight in COUNT_TARGETS:
+        target = placeholders.get(column, placeholders.get(f"{column}_min"))
+        if target is not None:
+            terms.append(f"{weight} * abs({column} - {target})")
+    for column, weight in TEXT_TARGETS:
+        terms_list = placeholders.get(column)
+        if terms_list is not None:
+            terms.append(f"{weight} * (list_position({terms_list}, {column}_norm) - 1) / greatest(len({terms_list}) - 1, 1)")
+
+    if not terms:
+        return "0"
+    return " + ".join(f"coalesce({term}, {MISSING_PENALTY})" for term in terms)
+
+
+def build_search_sql(mask: int, sort_by: str = "relevance") -> str:
+    """
+    Builds the statement text for a filter mask and sort order, with `$n` placeholders in
+    filter order followed by the row limit. Rows come in a stable order so pages do not
+    overlap; with `ORDER BY ... LIMIT`, DuckDB keeps only the best rows in a heap instead
+    of sorting every match.
+    """
+    predicates = []
+    placeholders = {}
+    for bit, (name, predicate) in enumerate(SEARCH_FILTERS):
+        if mask & (1 << bit):
+            placeholders[name] = f"${len(predicates) + 1}"
+            predicates.append(predicate.format(placeholders[name]))
+
+    sql = f"SELECT {SEARCH_COLUMNS}, {build_score_sql(placeholders)} AS score FROM properties"
+    if predicates:
+        sql += " WHERE " + " AND ".join(predicates)
+    return sql + f" ORDER BY {SORT_ORDERS[sort_by]} LIMIT ${len(predicates) + 1}"
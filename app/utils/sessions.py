@@ -0,0 +1,149 @@
+import asyncio
+import sqlite3
+import threading
+import zlib
+import duckdb
+from abc import ABC, abstractmethod
+from typing import Optional
+from pydantic_ai.messages import ModelMessagesTypeAdapter
+from app.models.session_models import ChatSession
+from app.utils.cache import ResultCache
+from app.utils.database import Database
+
+
+DEFAULT_MAX_SESSIONS = 10_000       # Sessions kept in memory
+DEFAULT_IDLE_SECONDS = 30 * 60      # Sessions idle for longer are reloaded from the store
+DEFAULT_SESSIONS_DATABASE = "db/sessions.sqlite"
+
+SESSIONS_SQL = """
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    chat_id               VARCHAR PRIMARY KEY,
+    message_history       BLOB,
+    last_shown_properties VARCHAR,
+    last_shown_slots      VARCHAR,
+    updated_at            TIMESTAMP WITH TIME ZONE
+)
+"""
+
+
+class SessionStore(ABC):
+    """
+    Where chat sessions live between messages.
+    """
+
+    @abstractmethod
+    async def get(self, chat_id: str) -> ChatSession:
+        ...
+
+    @abstractmethod
+    async def save(self, chat_id: str, session: ChatSession) -> None:
+        ...
+
+
+def dump_messages(session: ChatSession) -> bytes:
+    return zlib.compress(ModelMessagesTypeAdapter.dump_json(session.message_history))
+
+
+def load_messages(blob: Optional[bytes]) -> list:
+    return ModelMessagesTypeAdapter.validate_json(zlib.decompress(blob)) if blob else []
+
+
+class DuckDBSessionStore(SessionStore):
+    """
+    Sessions in the `chat_sessions` table, one row per chat.
+
+    The message history is stored as zlib-compressed pydantic-ai JSON, which with the
+    compacted histories of `compact_history` is a few KB per chat.
+    """
+
+    def __init__(self, database: Database):
+        self.database = database
+
+    @staticmethod
+    def create_table(con: duckdb.DuckDBPyConnection) -> None:
+        con.execute(SESSIONS_SQL)
+
+    async def get(self, chat_id: str) -> ChatSession:
+        row = await self.database.fetchone(
+            "SELECT message_history, last_shown_properties, last_shown_slots FROM chat_sessions WHERE chat_id = ?",
+            [chat_id],
+        )
+        if row is None:
+            return ChatSession()
+        return ChatSession(message_history=load_messages(row[0]), last_shown_properties=row[1], last_shown_slots=row[2])
+
+    async def save(self, chat_id: str, session: ChatSession) -> None:
+        await self.database.execute(
+            "INSERT OR REPLACE INTO chat_sessions VALUES (?, ?, ?, ?, now())",
+            [chat_id, dump_messages(session), session.last_shown_properties, session.last_shown_slots],
+        )
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions in a SQLite file, for several bot processes sharing one session state.
+
+    DuckDB lets a single process write to a database file, so it cannot back sessions shared
+    by webhook workers; SQLite in WAL mode can, with readers never blocking the writer.
+    Every thread gets its own connection and calls run in the default executor.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self.connection().executescript(SESSIONS_SQL.replace("TIMESTAMP WITH TIME ZONE", "TEXT") + ";")
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _get(self, chat_id: str) -> ChatSession:
+        row = self.connection().execute(
+            "SELECT message_history, last_shown_properties, last_shown_slots FROM chat_sessions WHERE chat_id = ?",
+            [chat_id],
+        ).fetchone()
+        if row is None:
+            return ChatSession()
+        return ChatSession(message_history=load_messages(row[0]), last_shown_properties=row[1], last_shown_slots=row[2])
+
+    def _save(self, chat_id: str, blob: bytes, session: ChatSession) -> None:
+        self.connection().execute(
+            "INSERT OR REPLACE INTO chat_sessions VALUES (?, ?, ?, ?, datetime('now'))",
+            [chat_id, blob, session.last_shown_properties, session.last_shown_slots],
+        )
+
+    async def get(self, chat_id: str) -> ChatSession:
+        return await asyncio.to_thread(self._get, chat_id)
+
+    async def save(self, chat_id: str, session: ChatSession) -> None:
+        await asyncio.to_thread(self._save, chat_id, dump_messages(session), session)
+
+
+class CachedSessionStore(SessionStore):
+    """
+    Bounded in-memory front for another store.
+
+    Writes go through to `backend` at once, so evicting a session from memory, because it
+    was idle for `idle_seconds` or to stay within `max_sessions`, never loses it: the next
+    message of the chat just reloads it. Memory use is bounded by `max_sessions` whatever
+    the number of users.
+    """
+
+    def __init__(self, backend: SessionStore, max_sessions: int = DEFAULT_MAX_SESSIONS, idle_seconds: float = DEFAULT_IDLE_SECONDS):
+        self.backend = backend
+        self.cache = ResultCache(max_entries=max_sessions, ttl=idle_seconds)
+
+    async def get(self, chat_id: str) -> ChatSession:
+        session = self.cache.get(chat_id)
+        if session is None:
+            session = await self.backend.get(chat_id)
+            self.cache.set(chat_id, session)
+        return session
+
+    async def save(self, chat_id: str, session: ChatSession) -> None:
+        await self.backend.save(chat_id, session)
+        self.cache.set(chat_id, session)
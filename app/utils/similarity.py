@@ -0,0 +1,240 @@
+import asyncio
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import duckdb
+import numpy as np
+from app.utils.database import Database
+from app.utils.geo import KM_PER_DEGREE, MAX_DELTA_SHARE, REBUILD_SECONDS, REFRESH_SECONDS
+
+
+# Features compared, computed by DuckDB. Prices and sizes are compared on a log scale, so
+# R$ 100k apart matters more for a R$ 300k flat than for a R$ 3M house.
+FEATURES_SQL = """
+    CASE WHEN preco > 0 THEN ln(preco) END AS preco, CASE WHEN tamanho > 0 THEN ln(tamanho) END AS tamanho,
+    n_quartos::DOUBLE AS n_quartos, n_banheiros::DOUBLE AS n_banheiros, n_garagem::DOUBLE AS n_garagem,
+    latitude, longitude
+"""
+SCALED_FEATURES   = ("preco", "tamanho", "n_quartos", "n_banheiros", "n_garagem")
+LOCATION_SCALE_KM = 5.0         # Distance between listings that weighs as much as one standard deviation
+
+
+@dataclass
+class SimilarListings:
+    property_ids: np.ndarray
+    distances: np.ndarray       # Euclidean, in standard deviations of the features
+
+
+class SimilarityIndex:
+    """
+    In-memory feature matrix of `properties`, for "similar listing" queries.
+
+    Every listing is a float32 row of its standardised price, size and room counts, and its
+    location in units of `LOCATION_SCALE_KM`, so all features weigh alike; missing values
+    are the average listing's. A query is then a single vectorised pass computing the
+    distance of every row to the listing at once, with `|x - q|² = |x|² - 2x·q + |q|²` and
+    the squared norms kept alongside the matrix. The matrix is stored column-major, which
+    makes that product with only a handful of features several times faster.
+
+    Rows are sorted by `property_id`. Listings changed since the build (by `updated_at`)
+    are rewritten in place, with the build's scaling; new ones go to a small delta
+    matrix. The index is rebuilt once the delta grows past `MAX_DELTA_SHARE` of it, or
+    every `rebuild_seconds`, which also drops removed listings.
+    """
+
+    _instances: "weakref.WeakKeyDictionary[Database, SimilarityIndex]" = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(
+        self,
+        database: Database,
+        refresh_seconds: float = REFRESH_SECONDS,
+        rebuild_seconds: float = REBUILD_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        # Held weakly, as the shared instances are keyed by their database
+        self._database = weakref.ref(database)
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.clock = clock
+        self._lock = asyncio.Lock()
+        self.built_at: Optional[float] = None
+        self.refreshed_at: Optional[float] = None
+        self.watermark: Any = None
+        self.builds = 0
+        self.updates = 0
+        self.means = np.zeros(len(SCALED_FEATURES) + 2)
+        self.scales = np.ones(len(SCALED_FEATURES) + 2)
+        self.property_ids = np.array([], dtype=object)
+        self.matrix = np.zeros((0, len(self.means)), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.delta_ids: list[str] = []
+        self.delta_positions: dict[str, int] = {}
+        self.delta_matrix = np.zeros((0, len(self.means)), dtype=np.float32)
+
+    @property
+    def database(self) -> Database:
+        return self._database()
+
+    @classmethod
+    def for_database(cls, database: Database) -> "SimilarityIndex":
+        """
+        Returns the shared `SimilarityIndex` of `database`, creating it on first use.
+        """
+        with cls._instances_lock:
+            index = cls._instances.get(database)
+            if index is None:
+                index = cls(database)
+                cls._instances[database] = index
+            return index
+
+    @staticmethod
+    def _load(cursor: duckdb.DuckDBPyConnection, since: Any = None) -> tuple[dict[str, np.ndarray], Any]:
+        has_updated_at = cursor.execute(
+            "SELECT count(*) FROM duckdb_columns() WHERE table_name = 'properties' AND column_name = 'updated_at'"
+        ).fetchone()[0] > 0
+        where, params = "", []
+        if since is not None and has_updated_at:
+            where, params = "WHERE updated_at > ?", [since]
+        columns = cursor.execute(f"SELECT property_id, {FEATURES_SQL} FROM properties {where} ORDER BY property_id", params).fetchnumpy()
+        watermark = cursor.execute("SELECT max(updated_at) FROM properties").fetchone()[0] if has_updated_at else None
+        return columns, watermark
+
+    @staticmethod
+    def _raw(columns: dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Features as a float64 matrix, NaN where missing.
+        """
+        features = [*SCALED_FEATURES, "latitude", "longitude"]
+        return np.column_stack([np.ma.asarray(columns[name], dtype=np.float64).filled(np.nan) for name in features])
+
+    def _fit(self, raw: np.ndarray) -> None:
+        with np.errstate(invalid="ignore"):
+            means = np.nanmean(raw, axis=0) if len(raw) else np.zeros(raw.shape[1])
+            scales = np.nanstd(raw, axis=0) if len(raw) else np.ones(raw.shape[1])
+        means = np.nan_to_num(means)
+        scales = np.where(np.isfinite(scales) & (scales > 0), scales, 1.0)
+        # Latitude and longitude become kilometres, whatever their spread
+        scales[-2] = LOCATION_SCALE_KM / KM_PER_DEGREE
+        scales[-1] = LOCATION_SCALE_KM / (KM_PER_DEGREE * max(np.cos(np.radians(means[-2])), 0.01))
+        self.means, self.scales = means, scales
+
+    def _transform(self, raw: np.ndarray) -> np.ndarray:
+        return np.nan_to_num((raw - self.means) / self.scales).astype(np.float32)
+
+    async def refresh(self) -> None:
+        """
+        Builds the index on first use and brings it up to date when it is due.
+        """
+        now = self.clock()
+        if self.refreshed_at is not None and now - self.refreshed_at < self.refresh_seconds:
+            return
+        async with self._lock:
+            now = self.clock()
+            if self.refreshed_at is not None and now - self.refreshed_at < self.refresh_seconds:
+                return
+            rebuild = (
+                self.built_at is None
+                or now - self.built_at >= self.rebuild_seconds
+                or len(self.delta_ids) > MAX_DELTA_SHARE * max(len(self.property_ids), 1)
+            )
+            if not rebuild and self.watermark is None:
+                # Without `updated_at` changed listings cannot be told apart
+                self.refreshed_at = now
+                return
+
+            columns, watermark = await self.database.run(self._load, None if rebuild else self.watermark)
+            property_ids = np.asarray(columns["property_id"], dtype=object)
+            raw = self._raw(columns)
+            if rebuild:
+                self._fit(raw)
+                self.property_ids = property_ids
+                self.matrix = np.asfortranarray(self._transform(raw))
+                self.norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+                self.delta_ids, self.delta_positions = [], {}
+                self.delta_matrix = np.zeros((0, self.matrix.shape[1]), dtype=np.float32)
+                self.built_at = now
+                self.builds += 1
+            elif len(property_ids):
+                self._update(property_ids, self._transform(raw))
+            self.watermark = watermark if watermark is not None else self.watermark
+            self.refreshed_at = now
+
+    def _update(self, property_ids: np.ndarray, rows: np.ndarray) -> None:
+        positions = np.searchsorted(self.property_ids, property_ids)
+        found = positions < len(self.property_ids)
+        found[found] = self.property_ids[positions[found]] == property_ids[found]
+        self.matrix[positions[found]] = rows[found]
+        self.norms[positions[found]] = np.einsum("ij,ij->i", rows[found], rows[found])
+        self.updates += int(found.sum())
+
+        new_rows = []
+        for property_id, row in zip(property_ids[~found].tolist(), rows[~found]):
+            position = self.delta_positions.get(property_id)
+            if position is None:
+                self.delta_positions[property_id] = len(self.delta_ids)
+                self.delta_ids.append(property_id)
+                new_rows.append(row)
+            elif position < len(self.delta_matrix):
+                self.delta_matrix[position] = row
+            else:
+                new_rows[position - len(self.delta_matrix)] = row
+        if new_rows:
+            self.delta_matrix = np.vstack([self.delta_matrix, np.stack(new_rows)])
+
+    def position(self, property_id: str) -> Optional[int]:
+        """
+        Row of a listing in the base matrix followed by the delta, or None if it is not indexed.
+        """
+        position = int(np.searchsorted(self.property_ids, property_id))
+        if position < len(self.property_ids) and self.property_ids[position] == property_id:
+            return position
+        position = self.delta_positions.get(property_id)
+        return len(self.property_ids) + position if position is not None else None
+
+    def _distances(self, query: np.ndarray) -> np.ndarray:
+        """
+        Squared distances of every base row to `query`.
+        """
+        distances = self.matrix @ query
+        distances *= -2
+        distances += self.norms
+        distances += np.dot(query, query)
+        return distances
+
+    @staticmethod
+    def _top(distances: np.ndarray, k: int) -> np.ndarray:
+        if len(distances) <= k:
+            return np.arange(len(distances))
+        return np.argpartition(distances, k - 1)[:k]
+
+    def similar(self, property_id: str, k: int) -> Optional[SimilarListings]:
+        """
+        The `k` listings most similar to `property_id`, most similar first, or None if the
+        listing is not indexed.
+        """
+        position = self.position(property_id)
+        if position is None:
+            return None
+        n_base = len(self.property_ids)
+        query = (self.matrix[position] if position < n_base else self.delta_matrix[position - n_base]).copy()
+        base = self._distances(query)
+        delta = ((self.delta_matrix - query) ** 2).sum(axis=1)
+        if position < n_base:
+            base[position] = np.inf
+        else:
+            delta[position - n_base] = np.inf
+
+        # The k nearest of each part, then of both
+        base_top, delta_top = self._top(base, k), self._top(delta, k)
+        ids = np.concatenate([self.property_ids[base_top], np.array(self.delta_ids, dtype=object)[delta_top]])
+        distances = np.concatenate([base[base_top], delta[delta_top]])
+        keep = np.isfinite(distances)
+        ids, distances = ids[keep], distances[keep]
+        order = np.argsort(distances, kind="stable")[:k]
+        return SimilarListings(ids[order], np.sqrt(np.maximum(distances[order], 0)))
+
+    def stats(self) -> dict[str, Any]:
+        return {"listings": len(self.property_ids), "delta": len(self.delta_ids), "updates": self.updates, "builds": self.builds}
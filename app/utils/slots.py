@@ -0,0 +1,182 @@
+import duckdb
+from datetime import date, datetime, time, timedelta
+from typing import Any, Optional
+from app.utils.database import Database
+
+
+SLOT_MINUTES    = 30
+OPEN_TIME       = time(8, 0)
+CLOSE_TIME      = time(20, 0)
+DAYS_AHEAD      = 28
+CLOSED_WEEKDAYS = (6,)          # `date.weekday()` of days without visits: Sunday
+
+SLOT_COLUMNS_SQL = "strftime(slot_start, '%Y-%m-%d %H:%M:%S') AS inicio, strftime(slot_end, '%Y-%m-%d %H:%M:%S') AS fim"
+
+
+def slot_window(
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    time_from: Optional[str] = None,
+    time_to: Optional[str] = None,
+) -> tuple[list[str], list[Any]]:
+    """
+    Builds the predicates selecting free, future slots inside an optional date/time window.
+
+    Dates are 'YYYY-MM-DD' and inclusive; times are 'HH:MM' and select slots starting at or
+    after `time_from` and before `time_to` on every day of the window.
+
+    Raises:
+        ValueError: If a date or time is not in the expected format.
+    """
+    predicates = ["status = 'free'", "slot_start >= now()"]
+    params: list[Any] = []
+
+    if date_from is not None:
+        predicates.append("slot_start >= CAST(? AS DATE)")
+        params.append(date.fromisoformat(date_from))
+    if date_to is not None:
+        predicates.append("slot_start < CAST(? AS DATE) + INTERVAL 1 DAY")
+        params.append(date.fromisoformat(date_to))
+    if time_from is not None:
+        predicates.append("strftime(slot_start, '%H:%M') >= ?")
+        params.append(time.fromisoformat(time_from).strftime("%H:%M"))
+    if time_to is not None:
+        predicates.append("strftime(slot_start, '%H:%M') < ?")
+        params.append(time.fromisoformat(time_to).strftime("%H:%M"))
+
+    return predicates, params
+
+
+async def find_free_slots(database: Database, property_id: str, limit: int, **window: Optional[str]) -> dict[str, Any]:
+    """
+    Returns the next `limit` free slots of a property, earliest first, as numpy columns.
+
+    Filtering, ordering and limiting all happen in DuckDB. `property_slots` is written
+    sorted by (property_id, slot_start), so the zone maps narrow the scan down to the row
+    group holding the property and the top-N operator never sorts more than `limit` rows.
+    """
+    predicates, params = slot_window(**window)
+    return await database.fetchnumpy(
+        f"""SELECT {SLOT_COLUMNS_SQL}
+        FROM property_slots
+        WHERE property_id = ? AND {" AND ".join(predicates)}
+        ORDER BY slot_start
+        LIMIT ?""",
+        [property_id, *params, limit],
+    )
+
+
+async def find_free_slots_batch(
+    database: Database,
+    property_ids: list[str],
+    per_property: int,
+    **window: Optional[str],
+) -> dict[str, Any]:
+    """
+    Returns the next `per_property` free slots of each of several properties in one query,
+    as numpy columns, grouped by property in the order given and earliest first.
+
+    `ROW_NUMBER() OVER (PARTITION BY property_id ...)` ranks the slots of each property,
+    and only the first ranks are kept.
+    """
+    predicates, params = slot_window(**window)
+    return await database.fetchnumpy(
+        f"""SELECT property_id, {SLOT_COLUMNS_SQL}
+        FROM property_slots
+        WHERE property_id IN (SELECT unnest(?)) AND {" AND ".join(predicates)}
+        QUALIFY row_number() OVER (PARTITION BY property_id ORDER BY slot_start) <= ?
+        ORDER BY list_position(?, property_id), slot_start""",
+        [property_ids, *params, per_property, property_ids],
+    )
+
+
+# Slots of one day for every property whose slots end before that day. Properties without
+# slots yet have no horizon and get the day too
+EXTEND_DAY_SQL = """
+INSERT INTO property_slots BY NAME
+SELECT
+    p.property_id,
+    s.slot_start,
+    s.slot_start + to_minutes($slot_minutes)                AS slot_end,
+    CASE WHEN random() < $booked_ratio THEN 'booked' ELSE 'free' END AS status
+FROM properties p
+LEFT JOIN slot_horizon h USING (property_id)
+CROSS JOIN (
+    SELECT unnest(generate_series(
+        $day + $open_time,
+        $day + $close_time - to_minutes($slot_minutes),
+        to_minutes($slot_minutes)
+    )) AS slot_start
+) s
+WHERE (h.last_day IS NULL OR h.last_day < $day) AND s.slot_start >= $now
+ORDER BY p.property_id, s.slot_start
+"""
+
+
+def slot_days(today: date, days_ahead: int = DAYS_AHEAD) -> list[date]:
+    """
+    The days of the horizon starting `today` that have visits.
+    """
+    days = (today + timedelta(days=offset) for offset in range(days_ahead))
+    return [day for day in days if day.weekday() not in CLOSED_WEEKDAYS]
+
+
+def prune_past_slots(con: duckdb.DuckDBPyConnection, now: Optional[datetime] = None) -> int:
+    """
+    Deletes the slots that already ended, booked or not. Returns how many were deleted.
+    """
+    return con.execute("DELETE FROM property_slots WHERE slot_end <= ?", [now or datetime.now()]).fetchone()[0]
+
+
+def extend_slot_horizon(
+    con: duckdb.DuckDBPyConnection,
+    days_ahead: int = DAYS_AHEAD,
+    now: Optional[datetime] = None,
+    booked_ratio: float = 0.0,
+) -> int:
+    """
+    Adds the missing days at the end of every property's horizon of `days_ahead` days.
+    Returns how many slots were added.
+
+    Slots are generated in DuckDB with `generate_series`, one day per statement, so a run
+    over millions of properties never holds more than a day of slots, and DuckDB can spill
+    the sort to disk under its `memory_limit`. Existing slots, and so their bookings, are
+    never touched; a share `booked_ratio` of the new ones is marked booked, for demo data.
+    Each day is sorted by (property_id, slot_start) but is appended after the previous
+    ones; `compact_slots` restores the single sorted run slot lookups are fastest on.
+    """
+    now = now or datetime.now()
+    con.execute("""
+    CREATE OR REPLACE TEMP TABLE slot_horizon AS
+    SELECT property_id, max(slot_start)::DATE AS last_day FROM property_slots GROUP BY property_id
+    """)
+    added = 0
+    try:
+        for day in slot_days(now.date(), days_ahead):
+            added += con.execute(EXTEND_DAY_SQL, {
+                "day": day,
+                "open_time": OPEN_TIME,
+                "close_time": CLOSE_TIME,
+                "slot_minutes": SLOT_MINUTES,
+                "booked_ratio": booked_ratio,
+                "now": now,
+            }).fetchone()[0]
+    finally:
+        con.execute("DROP TABLE IF EXISTS slot_horizon")
+    return added
+
+
+def compact_slots(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Rewrites `property_slots` sorted by (property_id, slot_start), in one transaction.
+    """
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute("CREATE TEMP TABLE slots_sorted AS SELECT * FROM property_slots ORDER BY property_id, slot_start")
+        con.execute("DELETE FROM property_slots")
+        con.execute("INSERT INTO property_slots SELECT * FROM slots_sorted")
+        con.execute("DROP TABLE slots_sorted")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from typing import Optional
+from telegram import Message
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+
+DEFAULT_EDIT_INTERVAL = 1.0     # Seconds between edits of one message, within Telegram's limits
+PARTIAL_SUFFIX        = " …"
+
+
+class ProgressiveReply:
+    """
+    A reply that grows as the agent streams its response.
+
+    The first `update` sends the message and later ones edit it, at most once every
+    `interval` seconds; updates in between are skipped, as the next one carries their text
+    too. A `RetryAfter` from Telegram pushes the next edit back instead of failing the
+    turn. `finish` always delivers the final text, waiting out a rate limit if it must.
+    Texts must already be escaped for MarkdownV2.
+    """
+
+    def __init__(self, reply_to: Message, interval: float = DEFAULT_EDIT_INTERVAL):
+        self.reply_to = reply_to
+        self.interval = interval
+        self.message: Optional[Message] = None
+        self.text: Optional[str] = None
+        self.next_edit = 0.0
+        self.edits = 0
+
+    async def update(self, text: str) -> None:
+        text = text[:MessageLimit.MAX_TEXT_LENGTH - len(PARTIAL_SUFFIX)]
+        if text.endswith("\\"):
+            # Do not leave half an escape sequence behind
+            text = text[:-1]
+        text += PARTIAL_SUFFIX
+        if text == self.text or time.monotonic() < self.next_edit:
+            return
+        try:
+            await self.send(text)
+        except RetryAfter as e:
+            self.next_edit = time.monotonic() + _seconds(e.retry_after)
+
+    async def finish(self, text: str) -> None:
+        if text == self.text:
+            return
+        try:
+            await self.send(text)
+        except RetryAfter as e:
+            await asyncio.sleep(_seconds(e.retry_after))
+            await self.send(text)
+
+    async def send(self, text: str) -> None:
+        if self.message is None:
+            self.message = await self.reply_to.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+        else:
+            try:
+                await self.message.edit_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+            self.edits += 1
+        self.text = text
+        self.next_edit = time.monotonic() + self.interval
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
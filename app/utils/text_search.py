@@ -0,0 +1,200 @@
+import duckdb
+from dataclasses import dataclass
+from unidecode import unidecode
+from app.utils.database import Database
+
+
+SEARCH_FIELDS      = ("rua", "bairro", "cidade")
+MIN_SIMILARITY     = 0.45
+MIN_SUGGESTION_SIMILARITY = 0.2
+MAX_FUZZY_MATCHES  = 500      # Close spellings returned; values containing the input are all returned
+MAX_SUGGESTIONS    = 5
+
+# SQL counterpart of `trigrams`, over a `term` column
+TRIGRAMS_SQL = "list_transform(range(1, length(' ' || term || ' ') - 1), i -> substring(' ' || term || ' ', i, 3))"
+
+
+@dataclass
+class TermMatch:
+    term: str
+    label: str
+    similarity: float
+    contains: bool
+
+
+def normalize_text(text: str) -> str:
+    """
+    Folds accents and case and collapses whitespace, e.g. "  São  JOSÉ " -> "sao jose".
+    """
+    return " ".join(unidecode(text).lower().split())
+
+
+def normalize_sql(column: str) -> str:
+    """
+    SQL counterpart of `normalize_text`, used to fill the `*_norm` columns at ingestion.
+    """
+    return f"trim(regexp_replace(lower(strip_accents({column})), '\\s+', ' ', 'g'))"
+
+
+# `*_norm` column expressions for INSERT ... SELECT statements over raw listings
+NORMALIZED_COLUMNS_SQL = ", ".join(f"{normalize_sql(field)} AS {field}_norm" for field in SEARCH_FIELDS)
+
+
+def trigrams(term: str) -> list[str]:
+    padded = f" {term} "
+    return sorted({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+
+def ensure_search_columns(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Adds the `*_norm` columns to a `properties` table created before they existed.
+    """
+    for field in SEARCH_FIELDS:
+        con.execute(f"ALTER TABLE properties ADD COLUMN IF NOT EXISTS {field}_norm VARCHAR")
+
+
+# Distinct normalised values of each field in some rows of `properties`, with a label
+TERMS_SQL = """
+SELECT field, term, any_value(label) AS label
+FROM (
+    SELECT 'rua' AS field, rua_norm AS term, rua AS label FROM properties WHERE {rows}
+    UNION ALL
+    SELECT 'bairro', bairro_norm, bairro FROM properties WHERE {rows}
+    UNION ALL
+    SELECT 'cidade', cidade_norm, cidade FROM properties WHERE {rows}
+)
+WHERE term IS NOT NULL AND term <> ''
+GROUP BY field, term
+"""
+
+
+def build_search_index(con: duckdb.DuckDBPyConnection, full: bool = False) -> None:
+    """
+    Fills missing `*_norm` columns of `properties` and brings the trigram lookup tables up
+    to date with it.
+
+    Ingestion should write the `*_norm` columns itself (see `NORMALIZED_COLUMNS_SQL`), in
+    a sorted layout; the update here only backfills rows written without them.
+    `search_terms` holds one row per distinct normalised rua/bairro/cidade value and
+    `search_trigrams` is the inverted index from every trigram to the terms containing
+    it, written sorted by (field, trigram) so a lookup only scans the row groups of its
+    field and never touches `properties`.
+
+    Like `refresh_market_stats`, only the terms of listings changed since the last build
+    (by `updated_at`) are added, appended to the tables. Without `updated_at`, on first
+    use, after a backfill or with `full`, both tables are rebuilt, which also restores
+    their sorted layout and drops the terms no listing has anymore.
+    """
+    ensure_search_columns(con)
+    backfilled = con.execute(f"""
+    UPDATE properties SET
+        rua_norm    = {normalize_sql("rua")},
+        bairro_norm = {normalize_sql("bairro")},
+        cidade_norm = {normalize_sql("cidade")}
+    WHERE rua_norm IS NULL OR bairro_norm IS NULL OR cidade_norm IS NULL
+    """).fetchone()[0]
+
+    con.execute("CREATE TABLE IF NOT EXISTS search_index_state (watermark TIMESTAMP WITH TIME ZONE)")
+    has_updated_at = con.execute(
+        "SELECT count(*) FROM duckdb_columns() WHERE table_name = 'properties' AND column_name = 'updated_at'"
+    ).fetchone()[0] > 0
+    has_tables = con.execute(
+        "SELECT count(*) FROM duckdb_tables() WHERE table_name IN ('search_terms', 'search_trigrams')"
+    ).fetchone()[0] == 2
+    state = con.execute("SELECT watermark FROM search_index_state").fetchone()
+    watermark = con.execute("SELECT max(updated_at) FROM properties").fetchone()[0] if has_updated_at else None
+    full = full or backfilled > 0 or not has_tables or state is None or state[0] is None or watermark is None
+
+    con.execute("BEGIN TRANSACTION")
+    try:
+        if full:
+            con.execute(f"""
+            CREATE OR REPLACE TABLE search_terms AS
+            SELECT *, length(list_distinct({TRIGRAMS_SQL})) AS n_trigrams
+            FROM ({TERMS_SQL.format(rows="true")})
+            """)
+            con.execute(f"""
+            CREATE OR REPLACE TABLE search_trigrams AS
+            SELECT DISTINCT field, unnest({TRIGRAMS_SQL}) AS trigram, term
+            FROM search_terms
+            ORDER BY field, trigram
+            """)
+        else:
+            con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE search_new_terms AS
+            SELECT *, length(list_distinct({TRIGRAMS_SQL})) AS n_trigrams
+            FROM ({TERMS_SQL.format(rows="updated_at > $watermark")}) changed
+            WHERE NOT EXISTS (SELECT 1 FROM search_terms s WHERE s.field = changed.field AND s.term = changed.term)
+            """, {"watermark": state[0]})
+            con.execute("INSERT INTO search_terms SELECT field, term, label, n_trigrams FROM search_new_terms")
+            con.execute(f"""
+            INSERT INTO search_trigrams
+            SELECT DISTINCT field, unnest({TRIGRAMS_SQL}) AS trigram, term
+            FROM search_new_terms
+            ORDER BY field, trigram
+            """)
+            con.execute("DROP TABLE search_new_terms")
+        con.execute("DELETE FROM search_index_state")
+        con.execute("INSERT INTO search_index_state VALUES (?)", [watermark])
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+async def match_terms(database: Database, field: str, value: str) -> list[TermMatch]:
+    """
+    Ranks the known `field` values against `value` by trigram similarity.
+
+    Values containing `value` come first, all of them, as `ILIKE '%value%'` would find
+    them even when they share no trigram with it (e.g. "ti" in "curitiba"). The closest
+    other spellings follow, at most `MAX_FUZZY_MATCHES`, found through `search_trigrams`.
+    The result serves both as filter candidates (see `matched_terms`) and as "did you
+    mean" suggestions.
+    """
+    if field not in SEARCH_FIELDS:
+        raise ValueError(f"Unknown search field: {field}")
+
+    term = normalize_text(value)
+    if not term:
+        return []
+    grams = trigrams(term)
+
+    rows = await database.fetchall(f"""
+    WITH shared AS (
+        SELECT t.term, count(*) AS n_shared
+        FROM (SELECT unnest($grams) AS trigram) q
+        JOIN search_trigrams t ON t.field = $field AND t.trigram = q.trigram
+        GROUP BY t.term
+    ),
+    containing AS (
+        SELECT s.term, s.label,
+               coalesce(shared.n_shared, 0) / ($n_grams + s.n_trigrams - coalesce(shared.n_shared, 0)) AS similarity,
+               true AS contains
+        FROM search_terms s LEFT JOIN shared ON shared.term = s.term
+        WHERE s.field = $field AND contains(s.term, $term)
+    ),
+    close AS (
+        SELECT s.term, s.label,
+               shared.n_shared / ($n_grams + s.n_trigrams - shared.n_shared) AS similarity,
+               false AS contains
+        FROM shared JOIN search_terms s ON s.field = $field AND s.term = shared.term
+        WHERE NOT contains(s.term, $term)
+        ORDER BY similarity DESC, s.term
+        LIMIT {MAX_FUZZY_MATCHES}
+    )
+    SELECT * FROM containing
+    UNION ALL
+    SELECT * FROM close
+    ORDER BY contains DESC, similarity DESC, term
+    """, {"grams": grams, "field": field, "n_grams": len(grams), "term": term})
+    return [TermMatch(term=row[0], label=row[1], similarity=row[2], contains=row[3]) for row in rows]
+
+
+def matched_terms(matches: list[TermMatch]) -> list[str]:
+    """
+    Terms to filter on: the values containing the input if there are any, as `ILIKE`
+    would, otherwise the spellings close enough to be a typo of it.
+    """
+    containing = [match.term for match in matches if match.contains]
+    return containing or [match.term for match in matches if match.similarity >= MIN_SIMILARITY]
@@ -0,0 +1,69 @@
+import hmac
+import json
+from typing import Any, Awaitable, Callable, Optional
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+DEFAULT_PATH  = "/telegram"
+DEFAULT_HOST  = "0.0.0.0"
+DEFAULT_PORT  = 8080
+
+
+def build_webhook_app(
+    application: Application,
+    path: str = DEFAULT_PATH,
+    secret_token: Optional[str] = None,
+    ready: Optional[Callable[[], Awaitable[bool]]] = None,
+) -> web.Application:
+    """
+    aiohttp app receiving Telegram updates on `path` and reporting its health.
+
+    An update is acknowledged as soon as it is queued on `application`, whose update
+    processor runs it, so Telegram never waits for an LLM turn. `/healthz` answers while
+    the process is up; `/readyz` only once `application` is running and `ready()`, e.g. a
+    database ping, succeeds.
+    """
+    async def receive_update(request: web.Request) -> web.Response:
+        if secret_token is not None and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            update = None
+        if update is None:
+            return web.Response(status=400, text="Invalid update")
+        await application.update_queue.put(update)
+        return web.Response(status=200)
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def readyz(request: web.Request) -> web.Response:
+        checks: dict[str, Any] = {"application": application.running}
+        if ready is not None:
+            try:
+                checks["ready"] = bool(await ready())
+            except Exception:
+                checks["ready"] = False
+        status = 200 if all(checks.values()) else 503
+        return web.json_response(checks, status=status)
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    return app
+
+
+async def start_webhook_server(app: web.Application, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, reuse_port: bool = False) -> web.AppRunner:
+    """
+    Starts serving `app`. With `reuse_port` several processes can listen on the same port
+    and the kernel spreads the connections between them.
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=reuse_port).start()
+    return runner
@@ -0,0 +1,65 @@
+import duckdb
+from app.utils.text_search import build_search_index, NORMALIZED_COLUMNS_SQL
+
+CITIES        = ["Curitiba", "Florianopolis", "São Paulo"]
+NEIGHBORHOODS = ["Batel", "Centro", "Água Verde", "Portão"]
+N_STREETS     = 5000
+SLOT_MINUTES  = 30
+
+
+def create_properties(con: duckdb.DuckDBPyConnection, n_rows: int) -> None:
+    """
+    Synthetic `properties` table of `n_rows` rows, in the sorted layout ingestion writes,
+    with its search index.
+    """
+    con.execute(f"""
+    CREATE OR REPLACE TABLE properties AS
+    SELECT *, {NORMALIZED_COLUMNS_SQL}
+    FROM (
+        SELECT
+            'p' || i::VARCHAR                              AS property_id,
+            round(100000 + random() * 1900000, 2)          AS preco,
+            round(30 + random() * 270, 1)                  AS tamanho,
+            (1 + random() * 4)::INTEGER                    AS n_quartos,
+            (1 + random() * 3)::INTEGER                    AS n_banheiros,
+            (random() * 3)::INTEGER                        AS n_garagem,
+            'Rua ' || (i % {N_STREETS})::VARCHAR           AS rua,
+            {NEIGHBORHOODS}[1 + i % {len(NEIGHBORHOODS)}]  AS bairro,
+            {CITIES}[1 + i % {len(CITIES)}]                AS cidade,
+            -25.4 + random() * 0.2                         AS latitude,
+            -49.3 + random() * 0.2                         AS longitude
+        FROM range({n_rows}) t(i)
+    )
+    ORDER BY cidade_norm, bairro_norm, rua_norm
+    """)
+    build_search_index(con)
+
+
+def create_slots(con: duckdb.DuckDBPyConnection, slots_per_property: int, booked_ratio: float = 0.2) -> None:
+    """
+    Synthetic `property_slots` table with `slots_per_property` future slots per property,
+    a share `booked_ratio` of them booked, sorted by (property_id, slot_start).
+    """
+    con.execute(f"""
+    CREATE OR REPLACE TABLE property_slots AS
+    SELECT
+        property_id,
+        slot_start,
+        slot_start + INTERVAL {SLOT_MINUTES} MINUTE                   AS slot_end,
+        CASE WHEN booked THEN 'booked' ELSE 'free' END              AS status,
+        CASE WHEN booked THEN 'synthetic' END                       AS booked_by,
+        CAST(NULL AS TIMESTAMP WITH TIME ZONE)                      AS booked_at
+    FROM (
+        SELECT
+            property_id,
+            date_trunc('hour', now()::TIMESTAMP) + INTERVAL 1 DAY + s * INTERVAL {SLOT_MINUTES} MINUTE AS slot_start,
+            random() < {booked_ratio}                                                                  AS booked
+        FROM properties, range({slots_per_property}) t(s)
+    )
+    ORDER BY property_id, slot_start
+    """)
+
+
+def create_database(con: duckdb.DuckDBPyConnection, n_properties: int, slots_per_property: int = 8) -> None:
+    create_properties(con, n_properties)
+    create_slots(con, slots_per_property)
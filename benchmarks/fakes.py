@@ -0,0 +1,107 @@
+import asyncio
+import json
+import math
+import os
+import random
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Optional
+from langchain_core.runnables import RunnableLambda
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, ToolCallPart, ToolReturnPart, RetryPromptPart, UserPromptPart
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, DeltaToolCalls, FunctionModel
+
+# The agents build their OpenAI clients on first use, which needs a key even though the
+# fakes below replace every model call
+os.environ.setdefault("OPENAI_API_KEY", "offline")
+os.environ.setdefault("PYDANTIC_AI_NO_BANNER", "1")
+
+from app.agents.guard_rail_agent import GuardRail, build_guard_rail_prompt
+from app.models.guard_rail_models import GuardRailAgentOutput
+from app.utils.cache import ResultCache
+from app.utils.guard_rail import classify_locally
+
+
+STREAM_CHUNK_CHARS = 16     # Characters of the final output per streamed delta
+
+
+@dataclass
+class ToolStep:
+    tool_name: str
+    args: dict[str, Any]
+
+
+@dataclass
+class TurnPlan:
+    """What the scripted model does for one user input: tool calls, one per model request, then the final output."""
+    steps: list[ToolStep] = field(default_factory=list)
+    response: str = "Ok."
+
+
+def turn_messages(messages: list[ModelMessage]) -> list[ModelMessage]:
+    """Messages of the current turn, from its user prompt on."""
+    for i in range(len(messages) - 1, -1, -1):
+        message = messages[i]
+        if isinstance(message, ModelRequest) and any(isinstance(part, UserPromptPart) for part in message.parts):
+            return messages[i:]
+    return messages
+
+
+def scripted_model(plan: Callable[[str], TurnPlan], latency: Callable[[], float] = lambda: 0.0) -> FunctionModel:
+    """
+    `FunctionModel` standing in for the agent's LLM, following `plan(user_input)`.
+
+    Each model request answers with the next tool call of the plan, or with the final
+    output once every step got its result. `latency()` seconds are slept per request, to
+    model the LLM's own time. Works with `run_stream` too, the final output arriving in
+    small deltas like a real model's.
+    """
+    async def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await asyncio.sleep(latency())
+        current = turn_messages(messages)
+        user_input = next(part.content for part in current[0].parts if isinstance(part, UserPromptPart))
+        turn = plan(user_input)
+        # The request of the user prompt may also carry the previous turn's output tool return
+        output_tools = {tool.name for tool in info.output_tools}
+        done = sum(
+            isinstance(part, (ToolReturnPart, RetryPromptPart)) and part.tool_name not in output_tools
+            for message in current for part in message.parts
+        )
+        if done < len(turn.steps):
+            step = turn.steps[done]
+            return ModelResponse(parts=[ToolCallPart(tool_name=step.tool_name, args=step.args)])
+        output_tool = info.output_tools[0].name
+        return ModelResponse(parts=[ToolCallPart(tool_name=output_tool, args=json.dumps({"response": turn.response}))])
+
+    async def stream(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[DeltaToolCalls]:
+        part = (await respond(messages, info)).parts[0]
+        args = part.args if isinstance(part.args, str) else json.dumps(part.args)
+        yield {0: DeltaToolCall(name=part.tool_name, json_args="")}
+        for start in range(0, len(args), STREAM_CHUNK_CHARS):
+            yield {0: DeltaToolCall(json_args=args[start:start + STREAM_CHUNK_CHARS])}
+
+    return FunctionModel(respond, stream_function=stream)
+
+
+def scripted_guard_rail(latency: Callable[[], float] = lambda: 0.0, cached: bool = True) -> GuardRail:
+    """
+    The production `GuardRail` with its LLM replaced by a fake chat model: the real prompt
+    is rendered, `latency()` seconds are slept and the local classifier's verdict, or
+    "no violation", is returned.
+    """
+    async def fake_chat_model(prompt_value) -> GuardRailAgentOutput:
+        await asyncio.sleep(latency())
+        user_input = prompt_value.to_messages()[-1].content.rsplit("<input>", 1)[-1].split("</input>", 1)[0].strip()
+        return GuardRailAgentOutput(rules_are_being_broken=bool(classify_locally(user_input)))
+
+    return GuardRail(build_guard_rail_prompt() | RunnableLambda(fake_chat_model), ResultCache(max_entries=10_000 if cached else 0))
+
+
+def latency_distribution(mean: float, sigma: float = 0.5, seed: Optional[int] = None) -> Callable[[], float]:
+    """
+    Lognormal latencies with the given `mean` seconds, like LLM calls: most close to the
+    median with a long tail, wider with a larger `sigma`.
+    """
+    if not mean:
+        return lambda: 0.0
+    rng = random.Random(seed)
+    mu = math.log(mean) - sigma ** 2 / 2
+    return lambda: rng.lognormvariate(mu, sigma)
@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import resource
+import statistics
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Optional
+import duckdb
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
+from telegram.request import BaseRequest, RequestData
+from benchmarks.data import create_database, CITIES, NEIGHBORHOODS
+from benchmarks.fakes import ToolStep, TurnPlan, latency_distribution, scripted_guard_rail, scripted_model
+import telegram_bot
+from telegram_bot import handle_message, reject_busy
+from app.agents.real_estate_agent import real_state_agent
+from app.scripts.send_test_update import make_update
+from app.tools import real_estate_tools
+from app.utils.database import Database
+from app.utils.scheduler import ChatUpdateProcessor, DEFAULT_MAX_CONCURRENT_CHATS, DEFAULT_MAX_PENDING, DEFAULT_MAX_PENDING_PER_CHAT
+from app.utils.sessions import CachedSessionStore, DuckDBSessionStore
+from app.utils.telegram_stream import PARTIAL_SUFFIX
+
+N_USERS      = 1000
+N_ROWS       = 100_000
+ROUNDS       = 1
+LLM_LATENCY  = 1.0      # Mean seconds per LLM call
+API_LATENCY  = 0.05     # Mean seconds per Telegram API call
+THINK_TIME   = 2.0      # Mean seconds a user takes to answer
+RAMP_SECONDS = 10.0
+TURN_TIMEOUT = 120.0
+HOT_SLOTS    = 20       # Slots everyone wants, where bookings race
+HOT_SHARE    = 0.3      # Share of bookings going for a hot slot
+CANCEL_SHARE = 0.3      # Share of users cancelling the visit they booked
+ERROR_REPLY  = "Ocorreu um erro"
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "imovel-match", "username": "imovel_match_bot"}
+
+
+class FakeTelegramAPI(BaseRequest):
+    """
+    Stands in for the Telegram Bot API behind `Application`'s bot.
+
+    Every call sleeps `latency()` seconds and succeeds; sent and edited texts are passed to
+    `on_text(chat_id, text)`, which is how simulated users see their replies.
+    """
+
+    def __init__(self, on_text: Callable[[int, str], None], latency: Callable[[], float] = lambda: 0.0):
+        self.on_text = on_text
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None, *args, **kwargs) -> tuple[int, bytes]:
+        await asyncio.sleep(self.latency())
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        self.calls[endpoint] += 1
+
+        result: object = True
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(parameters["chat_id"])
+            result = {
+                "message_id": parameters.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": parameters["text"],
+            }
+            self.on_text(chat_id, parameters["text"])
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+@dataclass
+class Turn:
+    text: str
+    plan: TurnPlan
+
+
+def user_script(rng: random.Random, slots: list[tuple[str, str]], hot_slots: list[tuple[str, str]], hot_share: float, cancel_share: float) -> list[Turn]:
+    """
+    One user's conversation: a search, the slots of a property, a booking and, sometimes,
+    its cancellation. Bookings go for one of `hot_slots` with probability `hot_share`, so
+    users race for them.
+    """
+    n_quartos = rng.randint(1, 4)
+    cidade = rng.choice(CITIES)
+    bairro = rng.choice(NEIGHBORHOODS)
+    property_id, slot_start = rng.choice(hot_slots) if rng.random() < hot_share else rng.choice(slots)
+    script = [
+        Turn(f"Procuro um imóvel com {n_quartos} quartos no {bairro}, {cidade}",
+             TurnPlan([ToolStep("search_properties", {"n_quartos": n_quartos, "bairro": bairro, "cidade": cidade})], "Encontrei estes imóveis.")),
+        Turn(f"Quais os horários de visita do imóvel {property_id}?",
+             TurnPlan([ToolStep("get_property_slots", {"property_id": property_id})], "Estes são os horários livres.")),
+        Turn(f"Quero visitar o imóvel {property_id} em {slot_start}",
+             TurnPlan([ToolStep("book_property_slot", {"property_id": property_id, "slot_start": slot_start})], "Visita agendada.")),
+    ]
+    if rng.random() < cancel_share:
+        script.append(Turn(f"Cancele a visita ao imóvel {property_id} em {slot_start}",
+                           TurnPlan([ToolStep("cancel_property_slot", {"property_id": property_id, "slot_start": slot_start})], "Visita cancelada.")))
+    return script
+
+
+def percentile(samples: list[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[round(q * (len(samples) - 1))] if samples else 0.0
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    con = duckdb.connect(args.db_path or ":memory:")
+    create_database(con, args.rows)
+    DuckDBSessionStore.create_table(con)
+    database = Database(con, max_workers=args.database_workers)
+
+    free = con.execute(f"SELECT property_id, strftime(slot_start, '%Y-%m-%d %H:%M:%S') FROM property_slots WHERE status = 'free' USING SAMPLE {max(args.users * 4, 100)} ROWS").fetchall()
+    hot_slots = free[:args.hot_slots]
+
+    # Simulated users wait on the final reply to their message; partial ones are edits
+    replies: dict[int, asyncio.Future] = {}
+
+    def on_text(chat_id: int, text: str) -> None:
+        future = replies.get(chat_id)
+        if future is not None and not future.done() and not text.endswith(PARTIAL_SUFFIX):
+            future.set_result(text)
+
+    api = FakeTelegramAPI(on_text, latency_distribution(args.api_latency, seed=args.seed))
+    processor = ChatUpdateProcessor(args.max_concurrent_chats, args.max_pending, args.max_pending_per_chat, on_reject=reject_busy)
+    application = Application.builder().token("1:load").request(api).get_updates_request(api).updater(None).concurrent_updates(processor).build()
+    application.bot_data["database"] = database
+    application.bot_data["config"] = {"stream_responses": args.stream, "stream_edit_interval": 1.0, "guard_rail_mode": args.guard_rail_mode}
+    application.bot_data["sessions"] = CachedSessionStore(DuckDBSessionStore(database))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+
+    llm_latency = latency_distribution(args.llm_latency, sigma=args.llm_sigma, seed=args.seed)
+    plans: dict[str, TurnPlan] = {}
+    update_ids = itertools.count(1)
+    latencies: list[float] = []
+    outcomes: Counter[str] = Counter()
+    think_time = latency_distribution(args.think_time, seed=args.seed)
+
+    async def simulate_user(chat_id: int) -> None:
+        await asyncio.sleep(rng.uniform(0, args.ramp))
+        for _ in range(args.rounds):
+            for turn in user_script(rng, free, hot_slots, args.hot_share, args.cancel_share):
+                plans[turn.text] = turn.plan
+                replies[chat_id] = asyncio.get_running_loop().create_future()
+                started = time.perf_counter()
+                await application.update_queue.put(Update.de_json(make_update(next(update_ids), chat_id, turn.text), application.bot))
+                try:
+                    text = await asyncio.wait_for(replies[chat_id], args.turn_timeout)
+                except asyncio.TimeoutError:
+                    outcomes["timeout"] += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                outcomes["error" if text.startswith(ERROR_REPLY) else "ok"] += 1
+                await asyncio.sleep(think_time())
+
+    guard_rail = telegram_bot.guard_rail_agent
+    telegram_bot.guard_rail_agent = scripted_guard_rail(llm_latency)
+    real_estate_tools.booking_outcomes.clear()
+    try:
+        with real_state_agent.override(model=scripted_model(lambda user_input: plans[user_input], llm_latency)):
+            await application.initialize()
+            await application.start()
+            started = time.perf_counter()
+            await asyncio.gather(*(simulate_user(chat_id) for chat_id in range(1, args.users + 1)))
+            elapsed = time.perf_counter() - started
+            await application.stop()
+            await application.shutdown()
+    finally:
+        telegram_bot.guard_rail_agent = guard_rail
+        database.close()
+        con.close()
+
+    return {
+        "users": args.users,
+        "rows": args.rows,
+        "seconds": elapsed,
+        "turns": outcomes,
+        "turns_per_second": len(latencies) / elapsed,
+        "latency_p50": statistics.median(latencies) if latencies else 0.0,
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "scheduler": processor.stats(),
+        "database": database.stats(),
+        "bookings": real_estate_tools.booking_stats(),
+        "telegram_api": dict(api.calls),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['users']:,} users over {report['rows']:,} properties, {report['seconds']:.1f} s")
+    print(f"  turns               {dict(report['turns'])}")
+    print(f"  throughput          {report['turns_per_second']:.1f} turns/s")
+    print(f"  turn latency        p50 {report['latency_p50']:.3f} s, p95 {report['latency_p95']:.3f} s, p99 {report['latency_p99']:.3f} s")
+    print(f"  update scheduler    {report['scheduler']}")
+    print(f"  database            {report['database']}")
+    print(f"  bookings            {report['bookings']}")
+    print(f"  telegram api calls  {report['telegram_api']}")
+    print(f"  peak RSS            {report['peak_rss_mb']:.0f} MB")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Simulates concurrent Telegram users against the bot's message handler, with scripted LLMs and a fake Telegram API.")
+    parser.add_argument('--users', type=int, default=N_USERS, help='Simulated users, one chat each.')
+    parser.add_argument('--rounds', type=int, default=ROUNDS, help='Conversations per user.')
+    parser.add_argument('--rows', type=int, default=N_ROWS, help='Size of the synthetic properties table.')
+    parser.add_argument('--db-path', default=None, help='DuckDB file for the synthetic database, instead of memory. It is overwritten.')
+    parser.add_argument('--database-workers', type=int, default=None, help='Threads of the database pool.')
+    parser.add_argument('--llm-latency', type=float, default=LLM_LATENCY, help='Mean seconds per LLM call.')
+    parser.add_argument('--llm-sigma', type=float, default=0.5, help='Spread of the lognormal LLM latencies.')
+    parser.add_argument('--api-latency', type=float, default=API_LATENCY, help='Mean seconds per Telegram API call.')
+    parser.add_argument('--think-time', type=float, default=THINK_TIME, help='Mean seconds between a reply and the next message.')
+    parser.add_argument('--ramp', type=float, default=RAMP_SECONDS, help='Users start spread over this many seconds.')
+    parser.add_argument('--turn-timeout', type=float, default=TURN_TIMEOUT, help='Seconds a user waits for a reply.')
+    parser.add_argument('--hot-slots', type=int, default=HOT_SLOTS, help='Slots many users try to book.')
+    parser.add_argument('--hot-share', type=float, default=HOT_SHARE, help='Share of bookings going for a hot slot.')
+    parser.add_argument('--cancel-share', type=float, default=CANCEL_SHARE, help='Share of users cancelling their booking.')
+    parser.add_argument('--max-concurrent-chats', type=int, default=16, help='As in config.yml.')
+    parser.add_argument('--max-pending', type=int, default=1000, help='As `max_pending_updates` in config.yml.')
+    parser.add_argument('--max-pending-per-chat', type=int, default=3, help='As in config.yml.')
+    parser.add_argument('--guard-rail-mode', choices=["sequential", "speculative"], default="sequential", help='As in config.yml.')
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='Reply once complete instead of streaming.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the simulated users and latencies.')
+    parser.add_argument('--json', default=None, help='Write the report to this file.')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import time
+import duckdb
+from app.utils.database import Database
+from app.utils.search_query import SearchQuery
+from app.utils.text_search import match_terms, matched_terms
+from benchmarks.data import create_properties
+
+N_ROWS      = 1_000_000
+N_QUERIES   = 200
+
+# Filter combinations the agent typically sends, cycled through during the run
+FILTER_SETS = [
+    {"cidade": "curitiba", "preco_min": 500000.0, "preco_max": 510000.0},
+    {"cidade": "curitiba", "n_quartos": 2, "tamanho_min": 290.0},
+    {"preco_min": 300000.0, "preco_max": 305000.0, "bairro": "batel"},
+    {"tamanho_min": 80.0, "n_quartos": 3, "n_banheiros": 2, "rua": "rua 4321"},
+    {"rua": "rua 1234", "n_garagem": 1},
+]
+
+
+async def resolve_filters(database: Database, filters: dict) -> dict:
+    """
+    `filters` with the rua/bairro/cidade values resolved to term lists, as the tools do
+    before building a `SearchQuery`.
+    """
+    resolved = dict(filters)
+    for field in ("rua", "bairro", "cidade"):
+        if field in resolved:
+            resolved[field] = matched_terms(await match_terms(database, field, resolved[field]))
+    return resolved
+
+
+async def run(n_rows: int, n_queries: int) -> None:
+    con = duckdb.connect()
+    create_properties(con, n_rows)
+    database = Database(con, max_workers=1)
+
+    # Both paths run the same statements, text search and ORDER BY included, so the
+    # difference is only planning every call versus PREPARE once and EXECUTE
+    queries = [SearchQuery(**await resolve_filters(database, filters)) for filters in FILTER_SETS]
+    paths = [
+        ("unprepared", lambda query: database.fetchall(query.sql, query.values)),
+        ("prepared", lambda query: database.fetchall_prepared(query.name, query.sql, query.values)),
+    ]
+    for query in queries:
+        assert await paths[0][1](query) == await paths[1][1](query)
+
+    results = {}
+    for label, search in paths:
+        for query in queries:
+            await search(query)
+
+        started = time.perf_counter()
+        for i in range(n_queries):
+            await search(queries[i % len(queries)])
+        results[label] = (time.perf_counter() - started) / n_queries * 1000
+
+    database.close()
+    print(f"{n_rows:,} properties, {n_queries} queries per path")
+    for label, ms in results.items():
+        print(f"  {label:<16} {ms:8.3f} ms/query")
+    print(f"  speed-up         {results['unprepared'] / results['prepared']:8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the search_properties statements run prepared and unprepared.")
+    parser.add_argument('--rows', type=int, default=N_ROWS, help='Number of rows in the synthetic properties table.')
+    parser.add_argument('--queries', type=int, default=N_QUERIES, help='Number of queries per path.')
+    args = parser.parse_args()
+    asyncio.run(run(args.rows, args.queries))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+N_RUNS   = 5
+N_TOP    = 8
+ROOT     = Path(__file__).resolve().parent.parent
+
+# Code run by each cold start: the entry points, then what their first turn adds
+ENTRY_POINTS = {
+    "main": "import main",
+    "telegram_bot": "import telegram_bot",
+    "real_estate_tools": "import app.tools.real_estate_tools",
+    "real_state_agent": "from app.agents.real_estate_agent import real_state_agent",
+    "guard_rail_chain": "from app.agents.guard_rail_agent import guard_rail_agent; guard_rail_agent.chain",
+}
+
+
+def parse_importtime(stderr: str) -> tuple[float, Counter]:
+    """
+    Total import time in milliseconds from `-X importtime` output, and the time spent in
+    each top-level package, counting every module's own time only.
+    """
+    packages: Counter = Counter()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us) / 1000
+    return sum(packages.values()), packages
+
+
+def cold_start(code: str) -> tuple[float, float, Counter]:
+    """
+    Runs `code` in a new interpreter. Returns its wall time and import time in
+    milliseconds, and the import time per package.
+    """
+    env = dict(os.environ)
+    # The OpenAI clients are never called, but some need a key to be built
+    env.setdefault("OPENAI_API_KEY", "offline")
+    env.setdefault("PYDANTIC_AI_NO_BANNER", "1")
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, env=env, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if process.returncode != 0:
+        raise RuntimeError(f"{code!r} failed:\n{process.stderr[-2000:]}")
+    import_ms, packages = parse_importtime(process.stderr)
+    return wall_ms, import_ms, packages
+
+
+def run(name: str, code: str, n_runs: int, n_top: int) -> dict:
+    # One discarded run, so bytecode compilation and a cold disk cache do not count
+    cold_start(code)
+    walls, imports, packages = [], [], Counter()
+    for _ in range(n_runs):
+        wall_ms, import_ms, run_packages = cold_start(code)
+        walls.append(wall_ms)
+        imports.append(import_ms)
+        packages.update(run_packages)
+    return {
+        "name": name,
+        "wall_ms": statistics.median(walls),
+        "import_ms": statistics.median(imports),
+        "top_packages": {package: ms / n_runs for package, ms in packages.most_common(n_top)},
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['name']:<20} wall {report['wall_ms']:8.1f} ms   imports {report['import_ms']:8.1f} ms")
+    print("    " + ", ".join(f"{package} {ms:.0f}" for package, ms in report["top_packages"].items()))
+
+
+def regressions(reports: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    Entry points whose median wall time grew more than `tolerance` (0.25 = 25%) over the
+    baseline run.
+    """
+    found = []
+    baseline_by_name = {report["name"]: report for report in baseline}
+    for report in reports:
+        previous = baseline_by_name.get(report["name"])
+        if previous and report["wall_ms"] > previous["wall_ms"] * (1 + tolerance):
+            found.append(f"{report['name']}: wall {previous['wall_ms']:.1f} -> {report['wall_ms']:.1f} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start time of each entry point, in new interpreters, with `-X importtime`.")
+    parser.add_argument('--entry-points', nargs='+', choices=list(ENTRY_POINTS), default=list(ENTRY_POINTS), help='Entry points to measure.')
+    parser.add_argument('--runs', type=int, default=N_RUNS, help='Cold starts per entry point; the median is reported.')
+    parser.add_argument('--top', type=int, default=N_TOP, help='Packages with the most import time listed per entry point.')
+    parser.add_argument('--json', default=None, help='Write the results to this file.')
+    parser.add_argument('--baseline', default=None, help='Results of an earlier --json run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed wall time slow-down over the baseline before failing.')
+    args = parser.parse_args()
+
+    reports = []
+    for name in args.entry_points:
+        report = run(name, ENTRY_POINTS[name], args.runs, args.top)
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(reports, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import json
+import resource
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Optional
+import duckdb
+from pydantic_ai import ModelRetry
+from benchmarks.data import create_database
+from benchmarks.fakes import ToolStep, TurnPlan, latency_distribution, scripted_guard_rail, scripted_model
+from app.agents.real_estate_agent import real_state_agent
+from app.models.user_models import UserInput
+from app.tools import real_estate_tools
+from app.tools.real_estate_tools import search_properties, get_property_slots, book_property_slot, cancel_property_slot
+from app.utils.database import Database
+from app.utils.guard_rail import run_guarded
+
+ROW_COUNTS  = [1_000, 100_000]
+N_CALLS     = 200
+N_TURNS     = 50
+SLOTS_PER_PROPERTY = 8
+
+# Searches the agent typically makes, cycled through during the run
+SEARCHES = [
+    {"cidade": "Curitiba", "preco_min": 500000.0, "preco_max": 600000.0},
+    {"cidade": "curitiba", "n_quartos": 2, "tamanho_min": 250.0},
+    {"bairro": "Agua Verde", "preco_max": 400000.0},
+    {"tamanho_min": 80.0, "n_quartos": 3, "n_banheiros": 2, "rua": "Rua 4321"},
+    {"cidade": "Sao Paulo", "n_garagem": 1, "pagina": 2},
+]
+
+# User inputs of the per-turn benchmark and what the scripted model does with each
+TURNS = {
+    "Oi, tudo bem?": TurnPlan(response="Olá! Como posso ajudar?"),
+    "Quero um apartamento de 2 quartos em Curitiba": TurnPlan([ToolStep("search_properties", {"cidade": "Curitiba", "n_quartos": 2})]),
+    "Algo no Batel até 600 mil?": TurnPlan([ToolStep("search_properties", {"bairro": "Batel", "preco_max": 600000.0})]),
+    "Quais os horários do imóvel p42?": TurnPlan([ToolStep("get_property_slots", {"property_id": "p42"})]),
+}
+
+
+def percentile(samples: list[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[round(q * (len(samples) - 1))] if samples else 0.0
+
+
+def summarize(samples: list[float], elapsed: float) -> dict[str, float]:
+    return {
+        "calls": len(samples),
+        "p50_ms": statistics.median(samples) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "max_ms": max(samples) * 1000,
+        "per_second": len(samples) / elapsed,
+    }
+
+
+async def measure(call: Callable[[int], Awaitable[object]], n: int, before: Optional[Callable[[], None]] = None) -> dict[str, float]:
+    samples = []
+    started = time.perf_counter()
+    for i in range(n):
+        if before is not None:
+            before()
+        call_started = time.perf_counter()
+        await call(i)
+        samples.append(time.perf_counter() - call_started)
+    return summarize(samples, time.perf_counter() - started)
+
+
+def clear_caches() -> None:
+    real_estate_tools.search_cache.clear()
+    real_estate_tools.slot_cache.clear()
+
+
+async def bench_tools(deps: UserInput, n_rows: int, n_calls: int) -> dict[str, dict]:
+    """
+    Latency of each tool called directly, as the agent would. "cold" clears the result
+    caches before every call, so it measures the queries; "warm" repeats cached calls.
+    """
+    ctx = SimpleNamespace(deps=deps)
+    property_id = lambda i: f"p{(i * 7919) % n_rows}"
+
+    async def search(i: int):
+        try:
+            return await search_properties(ctx, **SEARCHES[i % len(SEARCHES)])
+        except ModelRetry:
+            return None
+
+    async def slots(i: int):
+        return await get_property_slots(ctx, property_id(i))
+
+    async def book_and_cancel(i: int):
+        slot_start = (await deps.database.fetchone(
+            "SELECT slot_start FROM property_slots WHERE property_id = ? AND status = 'free' LIMIT 1", [property_id(i)]
+        ))[0].isoformat()
+        await book_property_slot(ctx, property_id(i), slot_start)
+        await cancel_property_slot(ctx, property_id(i), slot_start)
+
+    for i in range(len(SEARCHES)):
+        await search(i)
+    results = {
+        "search_properties (cold)": await measure(search, n_calls, clear_caches),
+        "search_properties (warm)": await measure(lambda i: search(i % len(SEARCHES)), n_calls),
+        "get_property_slots (cold)": await measure(slots, n_calls, clear_caches),
+        "get_property_slots (warm)": await measure(lambda i: slots(i % 10), n_calls),
+        "book + cancel": await measure(book_and_cancel, n_calls),
+    }
+    clear_caches()
+    return results
+
+
+async def bench_turns(deps: UserInput, n_turns: int, llm_latency: float) -> dict[str, dict]:
+    """
+    Latency of whole agent turns, guard rail included, with both LLMs scripted. With
+    `llm_latency` 0 this is the overhead of the application itself.
+    """
+    inputs = list(TURNS)
+    latency = latency_distribution(llm_latency, seed=0)
+    guard_rail = scripted_guard_rail(latency)
+    model = scripted_model(lambda user_input: TURNS[user_input], latency)
+
+    results = {}
+    with real_state_agent.override(model=model):
+        for mode in ("sequential", "speculative"):
+            async def turn(i: int):
+                user_input = inputs[i % len(inputs)]
+                run_agent = lambda verdict: real_state_agent.run(user_input, deps=deps.model_copy(update={"guard_rail_verdict": verdict}))
+                return await run_guarded(guard_rail, {"input": user_input, "history": ""}, run_agent, speculative=mode == "speculative")
+
+            clear_caches()
+            results[f"turn ({mode})"] = await measure(turn, n_turns)
+    return results
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(n_rows: int, args: argparse.Namespace) -> dict:
+    con = duckdb.connect(args.db_path or ":memory:")
+    started = time.perf_counter()
+    create_database(con, n_rows, SLOTS_PER_PROPERTY)
+    build_seconds = time.perf_counter() - started
+    database = Database(con)
+    deps = UserInput(connection=con, database=database, user_name="benchmark")
+    try:
+        results = {
+            **await bench_tools(deps, n_rows, args.calls),
+            **await bench_turns(deps, args.turns, args.llm_latency),
+        }
+    finally:
+        database.close()
+        con.close()
+    return {"rows": n_rows, "build_seconds": build_seconds, "peak_rss_mb": peak_rss_mb(), "results": results}
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['rows']:,} properties (built in {report['build_seconds']:.1f} s), peak RSS {report['peak_rss_mb']:.0f} MB")
+    print(f"  {'':<28} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'per s':>9}")
+    for name, stats in report["results"].items():
+        print(f"  {name:<28} {stats['p50_ms']:9.3f} {stats['p95_ms']:9.3f} {stats['max_ms']:9.3f} {stats['per_second']:9.1f}")
+
+
+def regressions(reports: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    Benchmarks whose p50 grew more than `tolerance` (0.25 = 25%) over the baseline run.
+    """
+    found = []
+    baseline_by_rows = {report["rows"]: report for report in baseline}
+    for report in reports:
+        previous = baseline_by_rows.get(report["rows"])
+        if previous is None:
+            continue
+        for name, stats in report["results"].items():
+            before = previous["results"].get(name)
+            if before and stats["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+                found.append(f"{report['rows']:,} rows, {name}: p50 {before['p50_ms']:.3f} -> {stats['p50_ms']:.3f} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency benchmarks of the agent tools and turns, with scripted LLMs.")
+    parser.add_argument('--rows', type=int, nargs='+', default=ROW_COUNTS, help='Sizes of the synthetic properties table, one run each.')
+    parser.add_argument('--calls', type=int, default=N_CALLS, help='Calls per tool benchmark.')
+    parser.add_argument('--turns', type=int, default=N_TURNS, help='Agent turns per turn benchmark.')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='Mean seconds slept per scripted LLM call.')
+    parser.add_argument('--db-path', default=None, help='DuckDB file for the synthetic database, instead of memory. It is overwritten.')
+    parser.add_argument('--json', default=None, help='Write the results to this file.')
+    parser.add_argument('--baseline', default=None, help='Results of an earlier --json run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed p50 slow-down over the baseline before failing.')
+    args = parser.parse_args()
+
+    reports = []
+    for n_rows in args.rows:
+        report = asyncio.run(run(n_rows, args))
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(reports, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
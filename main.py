@@ -1,17 +1,15 @@
 import asyncio
 import duckdb
-import mlflow
-from app.agents.real_estate_agent import real_state_agent
+from app.agents import real_estate_agent
 from app.agents.guard_rail_agent import guard_rail_agent
 from app.models.user_models import UserInput
-from app.utils.general import load_config
+from app.utils.general import load_config, setup_mlflow
+from app.utils.database import Database
+from app.utils.guard_rail import run_guarded
+from app.utils.history import compact_history, guard_rail_window, DEFAULT_KEEP_TURNS, DEFAULT_MAX_TURNS, DEFAULT_GUARD_RAIL_TURNS
 from pydantic_ai.messages import ToolCallPart
 
 
-mlflow.pydantic_ai.autolog()
-mlflow.set_experiment("imovel-match")
-
-
 async def main(user_name: str = "Pedro", execution_mode: str = "default", use_guard_rail: bool = True):
     """
     Main function to run the chat interface for the real estate agent.
@@ -21,7 +19,11 @@ async def main(user_name: str = "Pedro", execution_mode: str = "default", use_gu
     print("--------------------")
 
     config = await load_config("config/config.yml")
+    setup_mlflow(config, "imovel-match")
+    # The agent and its tools are built in the background while the first input is typed
+    agent_warm_up = real_estate_agent.warm_up(asyncio.get_running_loop())
     connection = duckdb.connect(config["database"])
+    database = Database.for_connection(connection, max_workers=config.get("database_workers"))
     message_history = []
 
     while True:
@@ -29,45 +31,61 @@ async def main(user_name: str = "Pedro", execution_mode: str = "default", use_gu
             user_input = str(input("You: "))
             
             if user_input.lower() == "exit":
+                from app.tools.real_estate_tools import cache_stats
+                print(f"Tool result cache: {cache_stats()}")
+                print(f"Guard rail: {guard_rail_agent.stats()}")
                 print("Exiting chat. Goodbye!")
                 break
 
             if not user_input.strip():
                 continue
 
+            stream_output = []
+            async def run_agent(guard_rail_verdict):
+                # Waits for the warm-up without blocking the loop; after a failed one the build is retried here
+                await asyncio.wait([agent_warm_up])
+                real_state_agent = real_estate_agent.real_state_agent
+                deps = UserInput(connection=connection, database=database, user_name=user_name, guard_rail_verdict=guard_rail_verdict)
+                if execution_mode == "default":
+                    return await real_state_agent.run(user_input, deps=deps, message_history=message_history)
+
+                elif execution_mode == "stream":
+                    async with real_state_agent.run_stream(user_input, deps=deps, message_history=message_history) as stream:
+                        stream_output.append(await stream.get_output())
+                    return stream
+
+                elif execution_mode == "debug":
+                    async with real_state_agent.iter(user_input, deps=deps, message_history=message_history) as agent_run:
+                        async for node in agent_run:
+                            if real_state_agent.is_call_tools_node(node):
+                                for tool_call in node.model_response.parts:
+                                    if isinstance(tool_call, ToolCallPart) and tool_call.tool_name != "final_result":
+                                        print("Agent is making a tool call:")
+                                        print(f"  - Tool: {tool_call.tool_name}")
+                                        print(f"    Args: {tool_call.args}")
+                    return agent_run.result
+
             if use_guard_rail:
-                guard_rail_response = await guard_rail_agent.ainvoke({"input": user_input, "history": message_history})
-                if guard_rail_response.rules_are_being_broken:
+                agent_response = await run_guarded(
+                    guard_rail_agent,
+                    {"input": user_input, "history": guard_rail_window(message_history, config.get("guard_rail_history_turns", DEFAULT_GUARD_RAIL_TURNS))},
+                    run_agent,
+                    speculative=config.get("guard_rail_mode") == "speculative",
+                )
+                if agent_response is None:
                     print("Agent: I'm sorry, I can only help with real estate inquiries.")
                     continue
-            
-            if execution_mode == "default":
-                agent_response = await real_state_agent.run(user_input, deps=UserInput(connection=connection, user_name=user_name), message_history=message_history)
+            else:
+                agent_response = await run_agent(None)
 
-            elif execution_mode == "stream":
-                print("Agent:")
-                async with real_state_agent.run_stream(user_input, deps=UserInput(connection=connection, user_name=user_name), message_history=message_history) as stream:
-                    print(await stream.get_output())
-
-                agent_response = stream
-
-            elif execution_mode == "debug":
-                async with real_state_agent.iter(user_input, deps=UserInput(connection=connection, user_name=user_name), message_history=message_history) as agent_run:
-                    async for node in agent_run:
-                        if real_state_agent.is_call_tools_node(node):
-                            for tool_call in node.model_response.parts:
-                                if isinstance(tool_call, ToolCallPart) and tool_call.tool_name != "final_result":
-                                    print("Agent is making a tool call:")
-                                    print(f"  - Tool: {tool_call.tool_name}")
-                                    print(f"    Args: {tool_call.args}")
-                
-                agent_response = agent_run.result
-            
             if agent_response:
-                message_history.extend(agent_response.new_messages())
-                if execution_mode != "stream":
-                    print("Agent:")
-                    print(agent_response)
+                message_history = compact_history(
+                    [*message_history, *agent_response.new_messages()],
+                    keep_turns=config.get("history_keep_turns", DEFAULT_KEEP_TURNS),
+                    max_turns=config.get("history_max_turns", DEFAULT_MAX_TURNS),
+                )
+                print("Agent:")
+                print(stream_output[0] if execution_mode == "stream" else agent_response)
 
 
         except (KeyboardInterrupt, EOFError):
@@ -1,16 +1,25 @@
 
 import asyncio
 import duckdb
-import mlflow
+import multiprocessing
 import re
+from typing import Optional
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from app.agents.real_estate_agent import real_state_agent
+from app.agents import real_estate_agent
 from app.agents.guard_rail_agent import guard_rail_agent
 from app.models.user_models import UserInput
 from app.models.real_estate_models import RealStateAgentOutput
-from app.utils.general import load_config
+from app.utils.general import load_config, setup_mlflow
+from app.utils.database import Database
+from app.utils.remote_database import RemoteDatabase, start_database_server
+from app.utils.guard_rail import run_guarded, verdict_passed
+from app.utils.telegram_stream import ProgressiveReply, DEFAULT_EDIT_INTERVAL
+from app.utils.scheduler import ChatUpdateProcessor, DEFAULT_MAX_CONCURRENT_CHATS, DEFAULT_MAX_PENDING, DEFAULT_MAX_PENDING_PER_CHAT
+from app.utils.sessions import CachedSessionStore, DuckDBSessionStore, SQLiteSessionStore, DEFAULT_MAX_SESSIONS, DEFAULT_IDLE_SECONDS, DEFAULT_SESSIONS_DATABASE
+from app.utils.webhook import build_webhook_app, start_webhook_server, DEFAULT_PATH, DEFAULT_HOST, DEFAULT_PORT
+from app.utils.history import compact_history, guard_rail_window, DEFAULT_KEEP_TURNS, DEFAULT_MAX_TURNS, DEFAULT_GUARD_RAIL_TURNS
 
 
 def escape_markdown_v2(text: str) -> str:
@@ -19,10 +28,6 @@ def escape_markdown_v2(text: str) -> str:
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 
-mlflow.pydantic_ai.autolog()
-mlflow.set_experiment("imovel-match-telegram")
-
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message when the /start command is issued."""
     await update.message.reply_text("Olá! Eu sou seu assistente imobiliário. Como posso te ajudar a encontrar o imóvel dos seus sonhos hoje?")
@@ -38,54 +43,96 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
 
-    message_history = context.user_data.get("message_history", [])
+    database = context.bot_data["database"]
+    config = context.bot_data["config"]
+    sessions = context.bot_data["sessions"]
+    chat_id = str(update.effective_chat.id)
     
     try:
-        guard_rail_response = await guard_rail_agent.ainvoke({"input": user_input, "history": message_history})
-        if guard_rail_response.rules_are_being_broken:
+        session = await sessions.get(chat_id)
+        message_history = session.message_history
+
+        reply = ProgressiveReply(update.message, interval=config.get("stream_edit_interval", DEFAULT_EDIT_INTERVAL))
+
+        async def run_agent(guard_rail_verdict) -> tuple[RealStateAgentOutput, list]:
+            # Waits for the warm-up without blocking the loop; after a failed one the build is retried here
+            if "agent_warm_up" in context.bot_data:
+                await asyncio.wait([context.bot_data["agent_warm_up"]])
+            real_state_agent = real_estate_agent.real_state_agent
+            deps = UserInput(connection=database.connection, database=database, user_name=user_name, user_id=str(update.effective_user.id), guard_rail_verdict=guard_rail_verdict)
+            if not config.get("stream_responses", True):
+                agent_run = await real_state_agent.run(user_input, deps=deps, message_history=message_history)
+                return agent_run.output, agent_run.new_messages()
+
+            # Show the response while it is generated, but never before the guard rail passed it
+            async with real_state_agent.run_stream(user_input, deps=deps, message_history=message_history) as stream:
+                async for partial in stream.stream_output():
+                    if partial.response and verdict_passed(guard_rail_verdict):
+                        await reply.update(escape_markdown_v2(partial.response))
+                output = await stream.get_output()
+            return output, stream.new_messages()
+
+        agent_run = await run_guarded(
+            guard_rail_agent,
+            {"input": user_input, "history": guard_rail_window(message_history, config.get("guard_rail_history_turns", DEFAULT_GUARD_RAIL_TURNS))},
+            run_agent,
+            speculative=config.get("guard_rail_mode") == "speculative",
+        )
+        if agent_run is None:
             await update.message.reply_text("Desculpe, só posso ajudar com questões relacionadas a imóveis.")
             return
-            
-        agent_run = await real_state_agent.run(
-            user_input, 
-            deps=UserInput(connection=context.bot_data["db_connection"], user_name=user_name), 
-            message_history=message_history
+        output, new_messages = agent_run
+
+        session.message_history = compact_history(
+            [*message_history, *new_messages],
+            keep_turns=config.get("history_keep_turns", DEFAULT_KEEP_TURNS),
+            max_turns=config.get("history_max_turns", DEFAULT_MAX_TURNS),
         )
-        message_history.extend(agent_run.new_messages())
-        context.user_data["message_history"] = message_history
 
-        output: RealStateAgentOutput = agent_run.output
-        
         message_parts = []
         
         if output.response:
             message_parts.append(escape_markdown_v2(output.response))
 
-        if output.properties and output.properties != context.user_data.get("last_shown_properties"):
+        if output.properties and output.properties != session.last_shown_properties:
             message_parts.append("\n\n*Imóveis encontrados:*\n")
             message_parts.append(f"```\n{output.properties}\n```")
-            context.user_data["last_shown_properties"] = output.properties
+            session.last_shown_properties = output.properties
 
-        if output.slots and output.slots != context.user_data.get("last_shown_slots"):
+        if output.slots and output.slots != session.last_shown_slots:
             message_parts.append("\n\n*Horários disponíveis:*\n")
             message_parts.append(f"```\n{output.slots}\n```")
-            context.user_data["last_shown_slots"] = output.slots
+            session.last_shown_slots = output.slots
+
+        await sessions.save(chat_id, session)
             
         final_message = "".join(message_parts).strip()
 
         if final_message:
-            await update.message.reply_text(final_message, parse_mode=ParseMode.MARKDOWN_V2)
+            await reply.finish(final_message)
         else:
-            await update.message.reply_text("Não obtive uma resposta. Por favor, tente novamente.")
+            await reply.finish(escape_markdown_v2("Não obtive uma resposta. Por favor, tente novamente."))
             
     except Exception as e:
         print(f"An error occurred: {e}")
         await update.message.reply_text("Ocorreu um erro ao processar sua solicitação. Por favor, tente novamente mais tarde.")
 
 
-async def main() -> None:
-    """Starts the Telegram bot."""
+async def reject_busy(update: object) -> None:
+    """Tells the user their message was dropped because the bot is overloaded."""
+    if isinstance(update, Update) and update.effective_message is not None:
+        await update.effective_message.reply_text("Estou recebendo muitas mensagens agora. Por favor, aguarde a minha resposta e tente novamente em instantes.")
+
+
+async def main(worker: int = 0, database_server: Optional[tuple[tuple[str, int], bytes]] = None) -> None:
+    """
+    Starts the Telegram bot, or one of its webhook workers. Workers send their queries to
+    `database_server`, the address and key of the process owning the database.
+    """
     config = await load_config("config/config.yml")
+    # Traced from here rather than on import, so `handle_message` can be driven by the
+    # load generator without logging every simulated turn
+    setup_mlflow(config, "imovel-match-telegram")
     telegram_config = config.get("telegram", {})
     bot_token = telegram_config.get("bot_token")
 
@@ -93,32 +140,113 @@ async def main() -> None:
         print("Telegram bot token not found in config.yml")
         return
 
-    application = Application.builder().token(bot_token).build()
-    
-    application.bot_data["db_connection"] = duckdb.connect(config["database"])
+    mode = telegram_config.get("mode", "polling")
+    webhook_config = telegram_config.get("webhook", {})
+    workers = webhook_config.get("workers", 1) if mode == "webhook" else 1
+
+    update_processor = ChatUpdateProcessor(
+        max_concurrent_chats=config.get("max_concurrent_chats", DEFAULT_MAX_CONCURRENT_CHATS),
+        max_pending=config.get("max_pending_updates", DEFAULT_MAX_PENDING),
+        max_pending_per_chat=config.get("max_pending_per_chat", DEFAULT_MAX_PENDING_PER_CHAT),
+        on_reject=reject_busy,
+    )
+    builder = Application.builder().token(bot_token).concurrent_updates(update_processor)
+    if mode == "webhook":
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # DuckDB allows a single process to open the database for writing, so several workers
+    # query it through the server process that owns it, and share their sessions through SQLite
+    if database_server is not None:
+        database = RemoteDatabase(*database_server, max_workers=config.get("database_workers"))
+    else:
+        database = Database.for_connection(duckdb.connect(config["database"]), max_workers=config.get("database_workers"))
+    application.bot_data["database"] = database
+    application.bot_data["config"] = config
+    if workers > 1:
+        application.bot_data["sessions"] = SQLiteSessionStore(config.get("sessions_database", DEFAULT_SESSIONS_DATABASE))
+    else:
+        DuckDBSessionStore.create_table(database.connection)
+        application.bot_data["sessions"] = CachedSessionStore(
+            DuckDBSessionStore(database),
+            max_sessions=config.get("session_cache_size", DEFAULT_MAX_SESSIONS),
+            idle_seconds=config.get("session_idle_seconds", DEFAULT_IDLE_SECONDS),
+        )
+
+    # The agent and its tools are built in the background rather than on the first update
+    application.bot_data["agent_warm_up"] = real_estate_agent.warm_up(asyncio.get_running_loop())
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    print("Telegram bot is running...")
-    
+    runner = None
     try:
         await application.initialize()
         await application.start()
-        await application.updater.start_polling()
+        if mode == "webhook":
+            secret_token = webhook_config.get("secret_token")
+            if worker == 0:
+                await application.bot.set_webhook(url=webhook_config["url"], secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+            webhook_app = build_webhook_app(
+                application,
+                path=webhook_config.get("path", DEFAULT_PATH),
+                secret_token=secret_token,
+                ready=lambda: database.fetchone("SELECT 1"),
+            )
+            runner = await start_webhook_server(
+                webhook_app,
+                host=webhook_config.get("host", DEFAULT_HOST),
+                port=webhook_config.get("port", DEFAULT_PORT),
+                reuse_port=workers > 1,
+            )
+            print(f"Telegram bot worker {worker} is listening for webhooks...")
+        else:
+            await application.updater.start_polling()
+            print("Telegram bot is running...")
         # Keep the bot running until interrupted
         while True:
             await asyncio.sleep(3600) # Sleep for a long time
     finally:
-        if application.updater.is_running():
+        if runner is not None:
+            await runner.cleanup()
+        if application.updater is not None and application.updater.running:
             await application.updater.stop()
         if application.running:
             await application.stop()
         await application.shutdown()
+        print(f"Database: {database.stats()}")
+        database.close()
+        from app.tools.real_estate_tools import cache_stats, booking_stats
+        print(f"Tool result cache: {cache_stats()}")
+        print(f"Bookings: {booking_stats()}")
+        print(f"Guard rail: {guard_rail_agent.stats()}")
+        print(f"Update scheduler: {update_processor.stats()}")
 
 
-if __name__ == "__main__":
+def run_worker(worker: int, database_server: tuple[tuple[str, int], bytes]) -> None:
     try:
-        asyncio.run(main())
+        asyncio.run(main(worker, database_server))
     except KeyboardInterrupt:
-        print("Bot stopped by the user") 
\ No newline at end of file
+        print(f"Worker {worker} stopped by the user")
+
+
+if __name__ == "__main__":
+    config = asyncio.run(load_config("config/config.yml"))
+    telegram_config = config.get("telegram", {})
+    workers = telegram_config.get("webhook", {}).get("workers", 1) if telegram_config.get("mode") == "webhook" else 1
+    if workers > 1:
+        server = start_database_server(config["database"], max_workers=config.get("database_workers"))
+        database_server = (server.address, bytes(multiprocessing.current_process().authkey))
+        try:
+            processes = [multiprocessing.Process(target=run_worker, args=(worker, database_server)) for worker in range(workers)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        finally:
+            server.shutdown()
+    else:
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            print("Bot stopped by the user")